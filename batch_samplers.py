@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Length aware samplers of the training data loaders.
+
+A uniformly shuffled batch is padded to its longest example, on conversation data with a long tail of lengths
+most of the batch is padding. LengthBucketSampler shuffles the data, cuts it into buckets of some batches,
+sorts each bucket by length and cuts it into batches, then shuffles the order of all batches. Batches hold
+examples of similar length while the data of a batch and the order of batches still change every epoch.
+
+TokenBudgetBatchSampler cuts the sorted buckets by a budget of padded tokens instead of a number of examples,
+batches of short examples are large and batches of long ones small, so the memory of a step stays flat.
+"""
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+from torch.utils.data import DataLoader, Sampler
+
+
+def get_lengths(dataset, columns: Sequence[str], batch_size: int = 10000) -> np.ndarray:
+    """
+    Token lengths of the padded columns of a tokenized dataset.
+    :param dataset: datasets.Dataset or data_shards.CompiledDataset
+    :param columns: columns padded by the collator, e.g. input_ids, or prompt_ids, chosen_ids and rejected_ids
+    :param batch_size: rows read at a time from a datasets.Dataset
+    :return: int64 array [num_examples, len(columns)]
+    """
+    if hasattr(dataset, "column_lengths"):
+        return np.stack([dataset.column_lengths(c) for c in columns], axis=1)
+    lengths = []
+    for batch in dataset.select_columns(list(columns)).iter(batch_size=batch_size):
+        lengths.append(np.array([[len(x) for x in batch[c]] for c in columns], dtype=np.int64).T)
+    return np.concatenate(lengths) if lengths else np.zeros((0, len(columns)), dtype=np.int64)
+
+
+def padding_ratio(lengths: np.ndarray, batches: List[np.ndarray]) -> float:
+    """Fraction of padding tokens when each column of each batch is padded to its longest example."""
+    num_tokens = lengths.sum()
+    num_padded = sum(int(lengths[b].max(axis=0).sum()) * len(b) for b in batches)
+    return 1 - num_tokens / max(num_padded, 1)
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Yield the indices of batches of examples with similar lengths, batches are in random order.
+    Only the last batch may be partial, so the data loader cuts the index stream at the same boundaries.
+    """
+
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            batch_size: int,
+            bucket_size: int = 64,
+            seed: int = 42,
+            log_padding: bool = True,
+    ):
+        """
+        :param lengths: example lengths [num_examples] or [num_examples, num_padded_columns], see get_lengths
+        :param batch_size: batch size of the data loader
+        :param bucket_size: number of batches per bucket, larger buckets give less padding and less randomness
+        :param seed: random seed, the permutation of an epoch is seeded with seed + epoch
+        :param log_padding: log the padding ratio of each epoch against uniform shuffling
+        """
+        super().__init__()
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.lengths = lengths.reshape(len(lengths), -1)
+        self.sort_keys = self.lengths.sum(axis=1)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.log_padding = log_padding
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _bucket_len(self) -> int:
+        """Number of examples of a bucket."""
+        return self.bucket_size * self.batch_size
+
+    def _split(self, indices: np.ndarray) -> List[np.ndarray]:
+        return [indices[i: i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+    def batches(self, epoch: Optional[int] = None) -> List[np.ndarray]:
+        """Batches of an epoch, full batches are shuffled, the partial one is kept last."""
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng(self.seed + epoch)
+        perm = rng.permutation(len(self.lengths))
+        batches = []
+        bucket_len = self._bucket_len()
+        for start in range(0, len(perm), bucket_len):
+            bucket = perm[start: start + bucket_len]
+            bucket = bucket[np.argsort(-self.sort_keys[bucket], kind="stable")]
+            batches.extend(self._split(bucket))
+        batches = self._shuffle(batches, rng)
+        if self.log_padding:
+            uniform = padding_ratio(self.lengths, self._split(perm))
+            logger.info(f"{type(self).__name__} epoch {epoch}: {len(batches)} batches, "
+                        f"{len(perm) / max(len(batches), 1):.1f} examples per batch, padding ratio "
+                        f"{padding_ratio(self.lengths, batches):.2%}, uniform shuffle {uniform:.2%}")
+        return batches
+
+    def _shuffle(self, batches: List[np.ndarray], rng) -> List[np.ndarray]:
+        last = batches.pop() if batches and len(batches[-1]) < self.batch_size else None
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        if last is not None:
+            batches.append(last)
+        return batches
+
+    def __iter__(self) -> Iterator[int]:
+        batches = self.batches()
+        self.epoch += 1
+        for batch in batches:
+            yield from batch.tolist()
+
+
+class TokenBudgetBatchSampler(LengthBucketSampler):
+    """
+    Batch sampler yielding batches whose padded size, the longest example times the number of examples summed
+    over the padded columns, stays within max_tokens. An example longer than the budget is a batch by itself.
+    The batches of an epoch are cut when the epoch starts, len() is the number of batches of the current epoch.
+
+    Batches have no fixed number of examples, so the sampler has no batch_size and does the distributed sharding
+    itself: every process cuts the same batches from the same seed and takes every num_replicas-th one, the number
+    of batches is padded to a multiple of num_replicas with the first batches so all processes run as many steps.
+    """
+
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            max_tokens: int,
+            bucket_size: int = 64,
+            seed: int = 42,
+            log_padding: bool = True,
+            num_replicas: int = 1,
+            rank: int = 0,
+    ):
+        """
+        :param lengths: example lengths [num_examples] or [num_examples, num_padded_columns], see get_lengths
+        :param max_tokens: budget of padded tokens per batch
+        :param bucket_size: number of batches per bucket, larger buckets give less padding and less randomness
+        :param seed: random seed, the permutation of an epoch is seeded with seed + epoch
+        :param log_padding: log the padding ratio of each epoch against batching without sorting
+        :param num_replicas: number of distributed processes
+        :param rank: rank of this process
+        """
+        super().__init__(lengths, 1, bucket_size, seed, log_padding)
+        # Examples per batch at the average length, sets the number of examples of a bucket. Not exposed as
+        # batch_size, accelerate would take it for a fixed batch size
+        del self.batch_size
+        self._bucket_batch_examples = 1
+        if len(self.sort_keys):
+            self._bucket_batch_examples = max(1, int(max_tokens // max(self.sort_keys.mean(), 1)))
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self._epoch_batches = None
+
+    def _bucket_len(self) -> int:
+        return self.bucket_size * self._bucket_batch_examples
+
+    def _split(self, indices: np.ndarray) -> List[np.ndarray]:
+        batches = []
+        start = 0
+        batch_max = np.zeros(self.lengths.shape[1], dtype=np.int64)
+        for i, idx in enumerate(indices):
+            new_max = np.maximum(batch_max, self.lengths[idx])
+            if i > start and new_max.sum() * (i - start + 1) > self.max_tokens:
+                batches.append(indices[start:i])
+                start = i
+                new_max = self.lengths[idx]
+            batch_max = new_max
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def _shuffle(self, batches: List[np.ndarray], rng) -> List[np.ndarray]:
+        # The data loader takes the batches as they are, a partial batch may go anywhere
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def _current_batches(self) -> List[np.ndarray]:
+        if self._epoch_batches is None or self._epoch_batches[0] != self.epoch:
+            batches = self.batches()
+            if self.num_replicas > 1 and batches:
+                batches = batches + batches[:(-len(batches)) % self.num_replicas]
+                batches = batches[self.rank::self.num_replicas]
+            self._epoch_batches = (self.epoch, batches)
+        return self._epoch_batches[1]
+
+    def __len__(self):
+        return len(self._current_batches())
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._current_batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+
+def build_token_budget_dataloader(trainer, batch_sampler: TokenBudgetBatchSampler):
+    """
+    Train data loader of a transformers Trainer with its batch size replaced by batch_sampler.
+    With several processes the batch sampler already yields the batches of this rank, the loader is not prepared
+    by accelerate, whose batch sampler sharding assumes batches of batch_size examples. The Trainer moves the
+    inputs to the device and sets the gradient sync steps itself.
+    """
+    import datasets
+
+    train_dataset = trainer.train_dataset
+    data_collator = trainer.data_collator
+    if isinstance(train_dataset, datasets.Dataset):
+        train_dataset = trainer._remove_unused_columns(train_dataset, description="training")
+    else:
+        data_collator = trainer._get_collator_with_removed_columns(data_collator, description="training")
+    dataloader = DataLoader(
+        train_dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=data_collator,
+        num_workers=trainer.args.dataloader_num_workers,
+        pin_memory=trainer.args.dataloader_pin_memory,
+        persistent_workers=trainer.args.dataloader_persistent_workers and trainer.args.dataloader_num_workers > 0,
+    )
+    if batch_sampler.num_replicas > 1:
+        return dataloader
+    return trainer.accelerator.prepare(dataloader)
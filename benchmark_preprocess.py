@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Benchmark data preprocessing of the training scripts.
+
+usage:
+    # SFT tokenization, per turn encode vs batched encode
+    python benchmark_preprocess.py sft --tokenizer_name_or_path Qwen/Qwen2.5-0.5B-Instruct \
+        --train_file_dir data/finetune --template_name qwen
+    # PT text grouping, Python list concatenation vs numpy, on 1k/10k/100k documents per batch
+    python benchmark_preprocess.py group --block_size 1024 --num_docs 1000 10000 100000
+    # SFT packing, summed token loss of packed batches and unpacked conversations on a tiny random model, runs on
+    # CPU and exits with status 1 if they differ
+    python benchmark_preprocess.py packing --num_examples 32 --max_length 256
+"""
+import argparse
+import sys
+import time
+from glob import glob
+from itertools import chain
+
+import numpy as np
+
+from datasets import concatenate_datasets, load_dataset
+from loguru import logger
+from transformers import AutoTokenizer
+from transformers.trainer_pt_utils import LabelSmoother
+
+from template import get_conv_template
+
+
+def load_json_files(file_dir: str, repeat: int = 1):
+    files = glob(f'{file_dir}/**/*.json', recursive=True) + glob(f'{file_dir}/**/*.jsonl', recursive=True)
+    logger.info(f"files: {files}")
+    dataset = load_dataset('json', data_files=files)['train']
+    if repeat > 1:
+        dataset = concatenate_datasets([dataset] * repeat)
+    return dataset
+
+
+def benchmark_sft(args):
+    """Turns/s of SFT preprocessing, per turn `tokenizer.encode` vs one tokenizer call per batch."""
+    from supervised_finetuning import preprocess_function
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, trust_remote_code=True)
+    prompt_template = get_conv_template(args.template_name)
+    if tokenizer.eos_token_id is None:
+        tokenizer.add_special_tokens({"eos_token": prompt_template.stop_str})
+    dataset = load_json_files(args.train_file_dir, args.repeat)
+    num_turns = sum(len(x) for x in dataset['conversations']) // 2
+    outputs = {}
+    for name, batched_tokenize in [("per turn encode", False), ("batched encode", True)]:
+        t0 = time.time()
+        outputs[name] = dataset.map(
+            preprocess_function,
+            batched=True,
+            batch_size=args.batch_size,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=False,
+            keep_in_memory=True,
+            fn_kwargs={
+                "tokenizer": tokenizer,
+                "prompt_template": prompt_template,
+                "max_length": args.model_max_length,
+                "ignore_index": LabelSmoother.ignore_index,
+                "batched_tokenize": batched_tokenize,
+            },
+        )
+        spend_time = time.time() - t0
+        logger.info(f"{name}: {len(dataset)} conversations, {num_turns} turns in {spend_time:.2f}s, "
+                    f"{num_turns / spend_time:.1f} turns/s")
+    a, b = outputs.values()
+    same = a['input_ids'] == b['input_ids'] and a['labels'] == b['labels']
+    logger.info(f"Outputs are identical: {same}")
+
+
+def legacy_group_text_function(examples, block_size):
+    """group_text_function of pretraining.py before the numpy version, the reference of benchmark_group."""
+    concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
+    total_length = len(concatenated_examples[list(examples.keys())[0]])
+    if total_length >= block_size:
+        total_length = (total_length // block_size) * block_size
+    result = {
+        k: [t[i: i + block_size] for i in range(0, total_length, block_size)]
+        for k, t in concatenated_examples.items()
+    }
+    result["labels"] = result["input_ids"].copy()
+    return result
+
+
+def legacy_group_texts_builder(examples, max_seq_length):
+    """GroupTextsBuilder.__call__ of pretraining.py before the numpy version, quadratic in the number of texts."""
+    firsts = {k: examples[k][0][0] for k in examples.keys()}
+    lasts = {k: examples[k][0][-1] for k in examples.keys()}
+    contents = {k: sum([vi[1:-1] for vi in v], []) for k, v in examples.items()}
+    total_length = len(contents[list(examples.keys())[0]])
+    content_length = max_seq_length - 2
+    if total_length >= content_length:
+        total_length = (total_length // content_length) * content_length
+    return {
+        k: [[firsts[k]] + t[i: i + content_length] + [lasts[k]] for i in range(0, total_length, content_length)]
+        for k, t in contents.items()}
+
+
+def benchmark_group(args):
+    """Tokens/s of grouping a batch of tokenized documents in blocks, list based vs numpy on lists and arrow."""
+    import pyarrow as pa
+    from pretraining import GroupTextsBuilder, group_texts
+
+    rng = np.random.default_rng(42)
+    builder = GroupTextsBuilder(args.block_size)
+    for num_docs in args.num_docs:
+        lengths = np.maximum(1, rng.lognormal(np.log(args.mean_doc_length), 1.0, num_docs).astype(np.int64))
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+        values = rng.integers(0, 32000, offsets[-1], dtype=np.int64)
+        column = pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
+        table = pa.table({"input_ids": column, "attention_mask": pa.ListArray.from_arrays(
+            pa.array(offsets), pa.array(np.ones(len(values), dtype=np.int8)))})
+        examples = table.to_pydict()
+        num_tokens = int(offsets[-1])
+        runs = [
+            ("chain lists", lambda: legacy_group_text_function(examples, args.block_size)),
+            ("numpy lists", lambda: group_texts(examples, args.block_size)),
+            ("numpy arrow", lambda: group_texts(table, args.block_size)),
+            ("builder numpy arrow", lambda: builder(table)),
+        ]
+        if num_docs <= args.max_quadratic_docs:
+            runs.append(("builder sum lists", lambda: legacy_group_texts_builder(examples, args.block_size)))
+        outputs = {}
+        for name, fn in runs:
+            t0 = time.time()
+            outputs[name] = fn()
+            spend_time = time.time() - t0
+            logger.info(f"{num_docs} docs, {num_tokens} tokens, {name}: {spend_time:.3f}s, "
+                        f"{num_tokens / max(spend_time, 1e-9) / 1e6:.1f}M tokens/s")
+        same = all(
+            np.array_equal(np.asarray(outputs["chain lists"][k]), outputs[name][k])
+            for name in ("numpy lists", "numpy arrow") for k in ("input_ids", "attention_mask", "labels")
+        )
+        if "builder sum lists" in outputs:
+            same = same and np.array_equal(np.asarray(outputs["builder sum lists"]["input_ids"]),
+                                           np.asarray(outputs["builder numpy arrow"]["input_ids"]))
+        logger.info(f"{num_docs} docs, outputs are identical: {same}")
+
+
+def varlen_attention_forward(module, query, key, value, attention_mask, scaling=None, dropout=0.0,
+                             cu_seq_lens_q=None, **kwargs):
+    """
+    CPU reference of FlashAttention-2 on the inputs of PackedDataCollator, causal attention within the sequences
+    of cu_seq_lens_q over the flattened batch. Without cu_seq_lens_q each row is one sequence, like flash attention
+    of recent transformers versions on a batch of more than one packed row, so a collator that drops the varlen
+    kwargs lets the packed examples attend to each other and fails the check.
+    """
+    import torch
+    from transformers.models.llama.modeling_llama import repeat_kv
+
+    key = repeat_kv(key, module.num_key_value_groups)
+    value = repeat_kv(value, module.num_key_value_groups)
+    batch_size, _, seq_len, _ = query.shape
+    if cu_seq_lens_q is None:
+        segments = torch.arange(batch_size, device=query.device)[:, None].expand(batch_size, seq_len)
+    else:
+        starts = torch.zeros(batch_size * seq_len, dtype=torch.long, device=query.device)
+        starts[cu_seq_lens_q[1:-1].long()] = 1
+        segments = torch.cumsum(starts, dim=0).view(batch_size, seq_len)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=query.device).tril()
+    allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+    scores = torch.matmul(query, key.transpose(2, 3)) * (scaling or query.size(-1) ** -0.5)
+    scores = scores.masked_fill(~allowed[:, None], torch.finfo(scores.dtype).min)
+    probs = torch.softmax(scores.float(), dim=-1).to(query.dtype)
+    return torch.matmul(probs, value).transpose(1, 2).contiguous(), None
+
+
+def check_packing(args):
+    """
+    Summed token NLL of packed batches, as PackedDataCollator feeds them to the model in training, vs the same
+    conversations one by one. Exits with status 1 if they differ.
+    """
+    import torch
+    import torch.nn.functional as F
+    from transformers import LlamaConfig, LlamaForCausalLM
+    from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
+    from packing import PackedDataCollator
+    from supervised_finetuning import pack_examples
+
+    ignore_index = LabelSmoother.ignore_index
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=args.max_length,
+    )
+    if args.attn_implementation == "flash_attention_2":
+        config._attn_implementation = "flash_attention_2"
+        device, dtype = "cuda", torch.bfloat16
+    else:
+        device, dtype = "cpu", torch.float32
+    model = LlamaForCausalLM(config).to(device=device, dtype=dtype).eval()
+    if args.attn_implementation != "flash_attention_2":
+        ALL_ATTENTION_FUNCTIONS["varlen_reference"] = varlen_attention_forward
+        try:
+            # Newer transformers versions build the attention mask per attention implementation
+            from transformers.masking_utils import ALL_MASK_ATTENTION_FUNCTIONS
+            ALL_MASK_ATTENTION_FUNCTIONS["varlen_reference"] = ALL_MASK_ATTENTION_FUNCTIONS["eager"]
+        except ImportError:
+            pass
+        model.config._attn_implementation = "varlen_reference"
+
+    # Conversations with a prompt part without labels, like the output of preprocess_function
+    examples = {"input_ids": [], "labels": []}
+    for length in rng.integers(max(args.min_length, 2), args.max_length + 1, args.num_examples):
+        input_ids = rng.integers(1, args.vocab_size, length).tolist()
+        prompt_len = int(rng.integers(1, length))
+        examples["input_ids"].append(input_ids)
+        examples["labels"].append([ignore_index] * prompt_len + input_ids[prompt_len:])
+
+    def token_nll(logits, labels):
+        return F.cross_entropy(logits[:, :-1].float().transpose(1, 2), labels[:, 1:].to(logits.device),
+                               ignore_index=ignore_index, reduction="sum").item()
+
+    packed_examples = pack_examples(examples, args.max_length, ignore_index)
+    features = [{k: v[i] for k, v in packed_examples.items()} for i in range(len(packed_examples["input_ids"]))]
+    collator = PackedDataCollator(pad_token_id=0, label_pad_token_id=ignore_index)
+    batches = [collator(features[i: i + args.batch_size]) for i in range(0, len(features), args.batch_size)]
+    if args.batch_size < 2 or len(features) < 2:
+        logger.error(f"{len(features)} packed sequences in batches of {args.batch_size}, the check needs batches "
+                     f"of at least 2 packed sequences")
+        sys.exit(1)
+
+    with torch.no_grad():
+        t0 = time.time()
+        unpacked = 0.0
+        for input_ids, labels in zip(examples["input_ids"], examples["labels"]):
+            logits = model(input_ids=torch.tensor([input_ids], device=device)).logits
+            unpacked += token_nll(logits, torch.tensor([labels]))
+        unpacked_time = time.time() - t0
+
+        t0 = time.time()
+        packed = 0.0
+        for batch in batches:
+            labels = batch.pop("labels")
+            inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+            packed += token_nll(model(**inputs).logits, labels)
+        packed_time = time.time() - t0
+
+    num_tokens = sum(sum(label != ignore_index for label in labels[1:]) for labels in examples["labels"])
+    num_packed_tokens = sum(sum(label != ignore_index for label in labels[1:]) for labels in packed_examples["labels"])
+    logger.info(f"{args.num_examples} conversations in {len(features)} packed sequences, {len(batches)} batches "
+                f"of {args.batch_size}, label tokens: {num_tokens} unpacked, {num_packed_tokens} packed")
+    logger.info(f"unpacked loss: {unpacked / num_tokens:.6f} in {unpacked_time:.3f}s, "
+                f"packed loss: {packed / max(num_packed_tokens, 1):.6f} in {packed_time:.3f}s")
+    rel_diff = abs(packed - unpacked) / max(abs(unpacked), 1e-12)
+    same = num_tokens == num_packed_tokens and rel_diff <= args.rtol
+    logger.info(f"Packed and unpacked losses match: {same}, relative difference of the summed loss: {rel_diff:.2e}")
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sft_parser = subparsers.add_parser('sft', help='SFT conversation tokenization')
+    sft_parser.add_argument('--tokenizer_name_or_path', type=str, required=True)
+    sft_parser.add_argument('--train_file_dir', type=str, default='data/finetune')
+    sft_parser.add_argument('--template_name', type=str, default='vicuna')
+    sft_parser.add_argument('--model_max_length', type=int, default=2048)
+    sft_parser.add_argument('--batch_size', type=int, default=1000, help='datasets.map batch size')
+    sft_parser.add_argument('--repeat', type=int, default=1, help='Repeat the data to benchmark a larger set')
+    sft_parser.set_defaults(func=benchmark_sft)
+
+    group_parser = subparsers.add_parser('group', help='PT grouping of tokenized texts in blocks')
+    group_parser.add_argument('--block_size', type=int, default=1024)
+    group_parser.add_argument('--num_docs', type=int, nargs='+', default=[1000, 10000, 100000],
+                              help='Documents per map batch')
+    group_parser.add_argument('--mean_doc_length', type=int, default=256, help='Median tokens of a document')
+    group_parser.add_argument('--max_quadratic_docs', type=int, default=10000,
+                              help='Skip the quadratic list builder on larger batches')
+    group_parser.set_defaults(func=benchmark_group)
+
+    packing_parser = subparsers.add_parser('packing', help='SFT packing, packed vs unpacked loss of a tiny model')
+    packing_parser.add_argument('--num_examples', type=int, default=32)
+    packing_parser.add_argument('--min_length', type=int, default=8)
+    packing_parser.add_argument('--max_length', type=int, default=256, help='Length of the packed sequences')
+    packing_parser.add_argument('--batch_size', type=int, default=2, help='Packed sequences per batch, at least 2')
+    packing_parser.add_argument('--vocab_size', type=int, default=1000)
+    packing_parser.add_argument('--attn_implementation', type=str, default='varlen_reference',
+                                choices=['varlen_reference', 'flash_attention_2'],
+                                help='varlen_reference runs on CPU, flash_attention_2 on GPU')
+    packing_parser.add_argument('--rtol', type=float, default=1e-4,
+                                help='Relative tolerance of the summed loss, larger with bf16 flash attention')
+    packing_parser.add_argument('--seed', type=int, default=42)
+    packing_parser.set_defaults(func=check_packing)
+
+    args = parser.parse_args()
+    logger.info(args)
+    args.func(args)
@@ -7,12 +7,18 @@ pip install similarities PyPDF2 -U
 """
 import argparse
 import hashlib
+import json
 import os
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 from threading import Thread
-from typing import Union, List
+from typing import Union, List, Dict
 
 import jieba
+import numpy as np
 import torch
 from loguru import logger
 from peft import PeftModel
@@ -29,6 +35,8 @@ from transformers import (
     GenerationConfig,
 )
 
+from vector_index import TextStore, create_index, load_index, normalize
+
 jieba.setLogLevel("ERROR")
 
 RAG_PROMPT = """基于以下已知信息，简洁和专业的来回答用户的问题。
@@ -42,10 +50,24 @@ RAG_PROMPT = """基于以下已知信息，简洁和专业的来回答用户的
 """
 
 
+CHINESE_CHAR_RE = re.compile(r'[\u4e00-\u9fff]')
+# A sentence runs up to and including its ending punctuation, the last one may have none
+CHINESE_SENTENCE_RE = re.compile(r'[^\n。！？；…]*[\n。！？；…]+|[^\n。！？；…]+')
+ENGLISH_SENTENCE_BOUNDARY_RE = re.compile(r'(?<=[.!?])\s+')
+
+
 class SentenceSplitter:
-    def __init__(self, chunk_size: int = 250, chunk_overlap: int = 50):
+    def __init__(self, chunk_size: int = 250, chunk_overlap: int = 50, tokenizer=None):
+        """
+        Init sentence splitter, chunks are sized in characters, or in tokens if a tokenizer is given.
+        Each chunk but the last is followed by the head of the next one, which adds up to chunk_overlap to its size.
+        :param chunk_size: max chunk size, before the overlap
+        :param chunk_overlap: chunk overlap, in the unit of chunk_size
+        :param tokenizer: tokenizer to size chunks in tokens, default None
+        """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
 
     def split_text(self, text: str) -> List[str]:
         if self._is_has_chinese(text):
@@ -53,59 +75,345 @@ class SentenceSplitter:
         else:
             return self._split_english_text(text)
 
+    def _lengths(self, texts: List[str]) -> List[int]:
+        """Sizes of texts, tokenized as one batch if sizing in tokens."""
+        if self.tokenizer is None or not texts:
+            return [len(t) for t in texts]
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+    def _pack(self, text: str, pieces, stop_at_sentence_end: bool = True) -> List[tuple]:
+        """
+        Greedily pack consecutive pieces of text into chunks of at most chunk_size.
+        :param text: the original text
+        :param pieces: list of (start, end, size, is_sentence_end) spans of text
+        :param stop_at_sentence_end: close a chunk at a sentence end once it is longer than chunk_size - chunk_overlap
+        :return: list of (start, end) spans of chunks
+        """
+        spans = []
+        start, end, size = None, None, 0
+        for piece_start, piece_end, piece_size, is_sentence_end in pieces:
+            if start is not None and size + piece_size > self.chunk_size:
+                spans.append((start, end))
+                start, size = None, 0
+            if start is None:
+                start = piece_start
+            end = piece_end
+            size += piece_size
+            if stop_at_sentence_end and is_sentence_end and size > self.chunk_size - self.chunk_overlap:
+                spans.append((start, end))
+                start, size = None, 0
+        if start is not None:
+            spans.append((start, end))
+        return spans
+
     def _split_chinese_text(self, text: str) -> List[str]:
-        sentence_endings = {'\n', '。', '！', '？', '；', '…'}  # 句末标点符号
-        chunks, current_chunk = [], ''
-        for word in jieba.cut(text):
-            if len(current_chunk) + len(word) > self.chunk_size:
-                chunks.append(current_chunk.strip())
-                current_chunk = word
-            else:
-                current_chunk += word
-            if word[-1] in sentence_endings and len(current_chunk) > self.chunk_size - self.chunk_overlap:
-                chunks.append(current_chunk.strip())
-                current_chunk = ''
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        """
+        Pack whole sentences, a sentence that does not fit the rest of a chunk starts the next chunk. Only sentences
+        longer than chunk_size are cut into jieba words, so chunks end at sentence ends more often than when all of
+        the text was packed word by word, and may be shorter.
+        """
+        sentences = [m.span() for m in CHINESE_SENTENCE_RE.finditer(text)]
+        pieces = []
+        for (start, end), size in zip(sentences, self._lengths([text[s:e] for s, e in sentences])):
+            if size <= self.chunk_size:
+                pieces.append((start, end, size, True))
+                continue
+            # Only sentences longer than a chunk are cut into words
+            words = [(start + s, start + e) for _, s, e in jieba.tokenize(text[start:end])]
+            word_sizes = self._lengths([text[s:e] for s, e in words])
+            pieces.extend((s, e, n, i == len(words) - 1) for i, ((s, e), n) in enumerate(zip(words, word_sizes)))
+        chunks = [text[s:e].strip() for s, e in self._pack(text, pieces)]
+        chunks = [c for c in chunks if c]
         if self.chunk_overlap > 0 and len(chunks) > 1:
             chunks = self._handle_overlap(chunks)
         return chunks
 
     def _split_english_text(self, text: str) -> List[str]:
         # 使用正则表达式按句子分割英文文本
-        sentences = re.split(r'(?<=[.!?])\s+', text.replace('\n', ' '))
-        chunks, current_chunk = [], ''
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= self.chunk_size or not current_chunk:
-                current_chunk += (' ' if current_chunk else '') + sentence
-            else:
-                chunks.append(current_chunk)
-                current_chunk = sentence
-        if current_chunk:  # Add the last chunk
-            chunks.append(current_chunk)
+        sentences, start = [], 0
+        for m in ENGLISH_SENTENCE_BOUNDARY_RE.finditer(text):
+            sentences.append((start, m.start()))
+            start = m.end()
+        sentences.append((start, len(text)))
+        sizes = self._lengths([text[s:e] for s, e in sentences])
+        # Sentences are joined by a space
+        pieces = [(s, e, n + (1 if i else 0), True) for i, ((s, e), n) in enumerate(zip(sentences, sizes))]
+        chunks = [text[s:e].replace('\n', ' ') for s, e in self._pack(text, pieces, stop_at_sentence_end=False)]
 
         if self.chunk_overlap > 0 and len(chunks) > 1:
             chunks = self._handle_overlap(chunks)
 
         return chunks
 
-    def _is_has_chinese(self, text: str) -> bool:
+    @staticmethod
+    def _is_has_chinese(text: str) -> bool:
         # check if contains chinese characters
-        if any("\u4e00" <= ch <= "\u9fff" for ch in text):
-            return True
-        else:
-            return False
+        return CHINESE_CHAR_RE.search(text) is not None
+
+    def heads(self, texts: List[str]) -> List[str]:
+        """First chunk_overlap characters of texts, or first chunk_overlap tokens if sizing in tokens."""
+        n = self.chunk_overlap
+        if self.tokenizer is None:
+            return [t[:n] for t in texts]
+        if getattr(self.tokenizer, 'is_fast', False):
+            offsets = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+            return [t[:o[n - 1][1]] if len(o) > n else t for t, o in zip(texts, offsets)]
+        # Slow tokenizers have no offsets, the head tokens are decoded
+        ids = self.tokenizer(texts, add_special_tokens=False)['input_ids']
+        return [self.tokenizer.decode(i[:n]) if len(i) > n else t for t, i in zip(texts, ids)]
 
     def _handle_overlap(self, chunks: List[str]) -> List[str]:
         # 处理块间重叠
         overlapped_chunks = []
+        heads = self.heads(chunks[1:])
         for i in range(len(chunks) - 1):
-            chunk = chunks[i] + ' ' + chunks[i + 1][:self.chunk_overlap]
+            chunk = chunks[i] + ' ' + heads[i]
             overlapped_chunks.append(chunk.strip())
         overlapped_chunks.append(chunks[-1])
         return overlapped_chunks
 
 
+class VectorIndexSimilarity(SimilarityABC):
+    """
+    Dense retrieval backed by a vector index (flat or IVF), the index and the texts of the corpus, a TextStore,
+    are saved and loaded memory-mapped.
+    """
+
+    def __init__(
+            self,
+            encoder,
+            index_type: str = "ivf",
+            nlist: int = None,
+            nprobe: int = 16,
+            batch_size: int = 64,
+    ):
+        """
+        Init vector index similarity.
+        :param encoder: sentence embedding model with `encode(sentences, batch_size)`, e.g. text2vec SentenceModel,
+            or a BertSimilarity whose sentence model is used
+        :param index_type: flat or ivf, flat is exhaustive search
+        :param nlist: number of ivf clusters, default None, 4 * sqrt(corpus size)
+        :param nprobe: number of ivf clusters scanned per query
+        :param batch_size: encode batch size
+        """
+        self.encoder = getattr(encoder, 'sentence_model', encoder)
+        self.model_name = getattr(self.encoder, 'model_name_or_path', type(self.encoder).__name__)
+        self.index_type = index_type
+        self.index_kwargs = {'nlist': nlist, 'nprobe': nprobe} if index_type == 'ivf' else {}
+        self.batch_size = batch_size
+        self.corpus = TextStore()
+        self.index = None
+
+    def __str__(self):
+        return f"VectorIndexSimilarity: {self.index_type}, encoder: {self.encoder}, corpus size: {len(self.corpus)}"
+
+    def get_embeddings(self, sentences: Union[str, List[str]]) -> np.ndarray:
+        """Normalized sentence embeddings, [num_sentences, dim]."""
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        embeddings = self.encoder.encode(sentences, batch_size=self.batch_size)
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.float().cpu().numpy()
+        return normalize(embeddings)
+
+    def add_corpus(self, corpus: Union[List[str], Dict[int, str]]):
+        """Embed and index new documents, documents already in the corpus are skipped."""
+        if isinstance(corpus, dict):
+            new_corpus = {int(k): v for k, v in corpus.items() if int(k) not in self.corpus}
+        else:
+            docs = list(dict.fromkeys(corpus))
+            existing = self.corpus.contains_texts(docs)
+            start_id = self.corpus.max_id() + 1
+            new_corpus = {}
+            for doc, is_existing in zip(docs, existing):
+                if not is_existing:
+                    new_corpus[start_id + len(new_corpus)] = doc
+        if not new_corpus:
+            return
+        self.add_embeddings(new_corpus, self.get_embeddings(list(new_corpus.values())))
+
+    def add_embeddings(self, corpus: Dict[int, str], embeddings: np.ndarray):
+        """Index documents whose embeddings are already computed, e.g. loaded from a ChunkEmbeddingStore."""
+        if not corpus:
+            return
+        if self.index is None:
+            self.index = create_index(self.index_type, embeddings.shape[1], **self.index_kwargs)
+        self.index.add(normalize(embeddings), np.array(list(corpus.keys()), dtype=np.int64))
+        self.corpus.update(corpus)
+        logger.debug(f"Add {len(corpus)} docs to {self.index_type} index, corpus size: {len(self.corpus)}")
+
+    def remove_corpus(self, corpus_ids: List[int]):
+        """Remove documents from the corpus and the index."""
+        corpus_ids = [i for i in corpus_ids if i in self.corpus]
+        if not corpus_ids:
+            return
+        self.corpus.remove(corpus_ids)
+        self.index.remove_ids(np.array(corpus_ids, dtype=np.int64))
+        logger.debug(f"Remove {len(corpus_ids)} docs from {self.index_type} index, corpus size: {len(self.corpus)}")
+
+    def similarity(self, a: Union[str, List[str]], b: Union[str, List[str]]):
+        """Cosine similarity matrix of a and b."""
+        return self.get_embeddings(a) @ self.get_embeddings(b).T
+
+    def distance(self, a: Union[str, List[str]], b: Union[str, List[str]]):
+        return 1 - self.similarity(a, b)
+
+    def most_similar(self, queries: Union[str, List[str], Dict[int, str]], topn: int = 10):
+        """
+        Find the topn most similar corpus documents of each query.
+        :return: dict of {query_id: {corpus_id: score}}
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        if not isinstance(queries, dict):
+            queries = {i: q for i, q in enumerate(queries)}
+        result = {qid: {} for qid in queries}
+        if self.index is None or not self.corpus:
+            return result
+        scores, ids = self.index.search(self.get_embeddings(list(queries.values())), topk=topn)
+        for qid, row_scores, row_ids in zip(queries, scores, ids):
+            for score, corpus_id in zip(row_scores, row_ids):
+                if corpus_id >= 0:
+                    result[qid][int(corpus_id)] = float(score)
+        return result
+
+    def search(self, queries: Union[str, List[str], Dict[int, str]], topn: int = 10):
+        return self.most_similar(queries, topn=topn)
+
+    def save_corpus_embeddings(self, emb_dir: str):
+        """Save the index and the corpus texts."""
+        if self.index is None:
+            return
+        self.index.save(emb_dir)
+        self.corpus.save(emb_dir)
+
+    def load_corpus_embeddings(self, emb_dir: str):
+        """Load the index and the texts saved by save_corpus_embeddings, both are memory-mapped."""
+        self.index = load_index(emb_dir, mmap=True)
+        if TextStore.exists(emb_dir):
+            self.corpus = TextStore.load(emb_dir)
+        else:
+            # corpus.json of older saves
+            self.corpus = TextStore()
+            with open(os.path.join(emb_dir, "corpus.json"), "r", encoding="utf-8") as f:
+                self.corpus.update({int(k): v for k, v in json.load(f).items()})
+
+
+class ChunkEmbeddingStore:
+    """
+    Content addressed store of chunk embeddings, keyed by the md5 of the chunk text.
+
+    Embeddings are appended to a float32 file and never rewritten, the row of a chunk is its stable id.
+    The manifest maps chunk hashes to rows and files to their hash and chunks, so an unchanged file is neither
+    extracted nor embedded again, and a changed file only embeds its new chunks.
+    """
+
+    def __init__(self, store_dir: str, model_name: str = ""):
+        """
+        Init chunk embedding store.
+        :param store_dir: store dir, holds embeddings.bin and manifest.json
+        :param model_name: embedding model name, embeddings of another model are discarded
+        """
+        self.store_dir = store_dir
+        self.model_name = model_name
+        self.emb_path = os.path.join(store_dir, "embeddings.bin")
+        self.manifest_path = os.path.join(store_dir, "manifest.json")
+        self.dim = None
+        self.num_rows = 0
+        # chunk hash -> [row, text]
+        self.chunks = {}
+        # file path -> {"hash": file hash, "chunks": [chunk hash]}
+        self.files = {}
+        os.makedirs(store_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("model_name") == model_name:
+                self.dim = manifest["dim"]
+                self.num_rows = manifest["num_rows"]
+                self.chunks = manifest["chunks"]
+                self.files = manifest["files"]
+            else:
+                logger.warning(f"Embedding model changed from {manifest.get('model_name')} to {model_name}, "
+                               f"reset chunk store {store_dir}")
+                os.remove(self.manifest_path)
+        if os.path.exists(self.emb_path):
+            # Drop rows appended after the last saved manifest, e.g. an interrupted run
+            with open(self.emb_path, "r+b") as f:
+                f.truncate(self.num_rows * (self.dim or 0) * 4)
+
+    @staticmethod
+    def chunk_hash(text: str) -> str:
+        return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+    def __contains__(self, key: str):
+        return key in self.chunks
+
+    def text(self, key: str) -> str:
+        return self.chunks[key][1]
+
+    def row(self, key: str) -> int:
+        return self.chunks[key][0]
+
+    def put(self, keys: List[str], texts: List[str], embeddings: np.ndarray):
+        """Append embeddings of new chunks."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        with open(self.emb_path, "ab") as f:
+            f.write(embeddings.tobytes())
+        for key, text in zip(keys, texts):
+            self.chunks[key] = [self.num_rows, text]
+            self.num_rows += 1
+
+    def get(self, keys: List[str]) -> np.ndarray:
+        """Embeddings of the given chunks, [num_keys, dim]."""
+        if not keys:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        embeddings = np.memmap(self.emb_path, dtype=np.float32, mode="r", shape=(self.num_rows, self.dim))
+        return np.asarray(embeddings[[self.chunks[k][0] for k in keys]])
+
+    def set_file(self, path: str, file_hash: str, keys: List[str]):
+        self.files[path] = {"hash": file_hash, "chunks": keys}
+
+    def remove_file(self, path: str) -> List[str]:
+        """Remove a file, return the chunks no other file refers to."""
+        record = self.files.pop(path, None)
+        if not record:
+            return []
+        live = {k for f in self.files.values() for k in f["chunks"]}
+        return [k for k in dict.fromkeys(record["chunks"]) if k not in live]
+
+    def save(self):
+        manifest = {
+            "model_name": self.model_name,
+            "dim": self.dim,
+            "num_rows": self.num_rows,
+            "chunks": self.chunks,
+            "files": self.files,
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def compact(self):
+        """
+        Rewrite the embeddings file with only the chunks of current files.
+        Rows are renumbered, so run it before building an index from the store, not while one is loaded.
+        """
+        live = list(dict.fromkeys(k for f in self.files.values() for k in f["chunks"]))
+        embeddings = self.get(live)
+        tmp_path = self.emb_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        os.replace(tmp_path, self.emb_path)
+        self.chunks = {k: [row, self.chunks[k][1]] for row, k in enumerate(live)}
+        self.num_rows = len(live)
+        self.save()
+        logger.debug(f"Compacted chunk store {self.store_dir}, {self.num_rows} chunks")
+
+
 class ChatPDF:
     def __init__(
             self,
@@ -120,6 +428,9 @@ class ChatPDF:
             chunk_size: int = 250,
             chunk_overlap: int = 30,
             prompt_template_name: str = None,
+            num_workers: int = 1,
+            embed_batch_size: int = 256,
+            split_by_tokens: bool = False,
     ):
         """
         Init RAG model.
@@ -132,8 +443,12 @@ class ChatPDF:
         :param int8: use int8 quantization, default False
         :param int4: use int4 quantization, default False
         :param chunk_size: chunk size, default 250
-        :param chunk_overlap: chunk overlap, default 50
+        :param chunk_overlap: chunk overlap, in characters or tokens like chunk_size, default 30
         :param prompt_template_name: prompt template name, default None, if set, inplace tokenizer.apply_chat_template
+        :param num_workers: number of processes extracting and splitting corpus files, default 1
+        :param embed_batch_size: number of chunks embedded together, default 256
+        :param split_by_tokens: chunk_size and chunk_overlap count tokens of the generate model tokenizer instead of
+            characters
         """
         if torch.cuda.is_available():
             default_device = torch.device(0)
@@ -142,7 +457,6 @@ class ChatPDF:
         else:
             default_device = torch.device('cpu')
         self.device = device or default_device
-        self.text_splitter = SentenceSplitter(chunk_size, chunk_overlap)
         if similarity_model is not None:
             self.sim_model = similarity_model
         else:
@@ -156,12 +470,27 @@ class ChatPDF:
             int8=int8,
             int4=int4,
         )
+        self.text_splitter = SentenceSplitter(
+            chunk_size, chunk_overlap, tokenizer=self.tokenizer if split_by_tokens else None)
         self.history = []
+        self.save_corpus_emb_dir = save_corpus_emb_dir
+        self.prompt_template_name = prompt_template_name
+        # token counts of reference chunks, used to fit references in the context length
+        self._token_counts = OrderedDict()
+        self.max_token_count_cache = 100000
+        # tokens of the source number and quotes around each reference, "[1]\t \"...\"\n"
+        self.source_number_tokens = 8
+        self.num_workers = num_workers
+        self.embed_batch_size = embed_batch_size
+        self.chunk_store = None
+        if isinstance(self.sim_model, VectorIndexSimilarity) and save_corpus_emb_dir:
+            self.chunk_store = ChunkEmbeddingStore(
+                os.path.join(save_corpus_emb_dir, "chunk_store"),
+                model_name=self.sim_model.model_name,
+            )
         self.corpus_files = corpus_files
         if corpus_files:
             self.add_corpus(corpus_files)
-        self.save_corpus_emb_dir = save_corpus_emb_dir
-        self.prompt_template_name = prompt_template_name
 
     def __str__(self):
         return f"Similarity model: {self.sim_model}, Generate model: {self.gen_model}"
@@ -203,25 +532,27 @@ class ChatPDF:
         model.eval()
         return model, tokenizer
 
-    def _get_chat_input(self):
-        messages = []
+    def _get_prompt_ids(self, history: List[List[str]]) -> List[int]:
+        """Token ids of the chat prompt of a history, list of [query, answer], the last answer is empty."""
         if self.prompt_template_name:
             from template import get_conv_template
             prompt_template = get_conv_template(self.prompt_template_name)
-            prompt = prompt_template.get_prompt(messages=self.history)
-            input_ids = self.tokenizer(prompt, return_tensors='pt').input_ids
-        else:
-            for conv in self.history:
-                if conv and len(conv) > 0 and conv[0]:
-                    messages.append({'role': 'user', 'content': conv[0]})
-                if conv and len(conv) > 1 and conv[1]:
-                    messages.append({'role': 'assistant', 'content': conv[1]})
-            input_ids = self.tokenizer.apply_chat_template(
-                conversation=messages,
-                tokenize=True,
-                add_generation_prompt=True,
-                return_tensors='pt'
-            )
+            # History turns are tokenized once and cached by the template
+            return prompt_template.get_prompt_ids(self.tokenizer, messages=history)
+        messages = []
+        for conv in history:
+            if conv and len(conv) > 0 and conv[0]:
+                messages.append({'role': 'user', 'content': conv[0]})
+            if conv and len(conv) > 1 and conv[1]:
+                messages.append({'role': 'assistant', 'content': conv[1]})
+        return self.tokenizer.apply_chat_template(
+            conversation=messages,
+            tokenize=True,
+            add_generation_prompt=True,
+        )
+
+    def _get_chat_input(self):
+        input_ids = torch.tensor([self._get_prompt_ids(self.history)], dtype=torch.long)
         return input_ids.to(self.gen_model.device)
 
     @torch.inference_mode()
@@ -235,7 +566,7 @@ class ChatPDF:
         streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
         input_ids = self._get_chat_input()
         max_src_len = context_len - max_new_tokens - 8
-        input_ids = input_ids[-max_src_len:]
+        input_ids = input_ids[:, -max_src_len:]
         generation_kwargs = dict(
             input_ids=input_ids,
             max_new_tokens=max_new_tokens,
@@ -249,37 +580,128 @@ class ChatPDF:
 
         yield from streamer
 
-    def add_corpus(self, files: Union[str, List[str]]):
-        """Load document files."""
+    @staticmethod
+    def extract_text(doc_file: str) -> List[str]:
+        """Extract text content from a document file by its extension."""
+        if doc_file.endswith('.pdf'):
+            return ChatPDF.extract_text_from_pdf(doc_file)
+        elif doc_file.endswith('.docx'):
+            return ChatPDF.extract_text_from_docx(doc_file)
+        elif doc_file.endswith('.md'):
+            return ChatPDF.extract_text_from_markdown(doc_file)
+        else:
+            return ChatPDF.extract_text_from_txt(doc_file)
+
+    def add_corpus(self, files: Union[str, List[str]], num_workers: int = None, batch_size: int = None):
+        """
+        Load document files.
+        :param files: document files
+        :param num_workers: number of processes extracting and splitting files, 1 is do it in this process,
+            default self.num_workers
+        :param batch_size: number of chunks embedded together, chunks are embedded as soon as a batch is full,
+            default self.embed_batch_size
+        :return: ingestion stats, number of files, pages, chunks and pages/s, chunks/s
+        """
         if isinstance(files, str):
             files = [files]
-        for doc_file in files:
-            if doc_file.endswith('.pdf'):
-                corpus = self.extract_text_from_pdf(doc_file)
-            elif doc_file.endswith('.docx'):
-                corpus = self.extract_text_from_docx(doc_file)
-            elif doc_file.endswith('.md'):
-                corpus = self.extract_text_from_markdown(doc_file)
+        num_workers = num_workers or self.num_workers
+        batch_size = batch_size or self.embed_batch_size
+        t0 = time.time()
+        store = self.chunk_store
+        stats = {'num_files': len(files), 'num_unchanged_files': 0, 'num_pages': 0, 'num_chunks': 0,
+                 'num_embedded_chunks': 0}
+        # chunks waiting to be embedded, with their chunk store keys if the store is used
+        batch_keys, batch_texts = [], []
+
+        def flush():
+            if not batch_texts:
+                return
+            if store is not None:
+                embeddings = self.sim_model.get_embeddings(batch_texts)
+                store.put(batch_keys, batch_texts, embeddings)
+                self.sim_model.add_embeddings({store.row(k): t for k, t in zip(batch_keys, batch_texts)}, embeddings)
             else:
-                corpus = self.extract_text_from_txt(doc_file)
-            full_text = '\n'.join(corpus)
-            chunks = self.text_splitter.split_text(full_text)
-            self.sim_model.add_corpus(chunks)
+                self.sim_model.add_corpus(list(batch_texts))
+            stats['num_embedded_chunks'] += len(batch_texts)
+            batch_keys.clear()
+            batch_texts.clear()
+
+        todo_files = files
+        if store is not None:
+            # Files deleted from disk since the last run are removed from the store and the index
+            for path in [p for p in store.files if not os.path.exists(p)]:
+                self.remove_corpus(path)
+            todo_files = []
+            for doc_file in files:
+                path = os.path.abspath(doc_file)
+                record = store.files.get(path)
+                if record and record['hash'] == self.get_file_hash(path):
+                    stats['num_unchanged_files'] += 1
+                    self._index_stored_chunks(record['chunks'])
+                else:
+                    todo_files.append(doc_file)
+        for doc_file, num_pages, chunks in iter_split_files(todo_files, self.text_splitter, num_workers=num_workers):
+            stats['num_pages'] += num_pages
+            stats['num_chunks'] += len(chunks)
+            if store is not None:
+                path = os.path.abspath(doc_file)
+                keys = [store.chunk_hash(c) for c in chunks]
+                # Chunks the old version of the file had and no file has anymore leave the index
+                stale = set(store.remove_file(path)) - set(keys)
+                self.sim_model.remove_corpus([store.row(k) for k in stale])
+                store.set_file(path, self.get_file_hash(path), keys)
+                self._index_stored_chunks([k for k in keys if k in store])
+                pending = set(batch_keys)
+                for key, chunk in zip(keys, chunks):
+                    if key not in store and key not in pending:
+                        pending.add(key)
+                        batch_keys.append(key)
+                        batch_texts.append(chunk)
+            else:
+                batch_texts.extend(chunks)
+            while len(batch_texts) >= batch_size:
+                rest_keys, rest_texts = batch_keys[batch_size:], batch_texts[batch_size:]
+                del batch_keys[batch_size:], batch_texts[batch_size:]
+                flush()
+                batch_keys.extend(rest_keys)
+                batch_texts.extend(rest_texts)
+        flush()
+        if store is not None:
+            store.save()
         self.corpus_files = files
-        logger.debug(f"files: {files}, corpus size: {len(self.sim_model.corpus)}, top3: "
-                     f"{list(self.sim_model.corpus.values())[:3]}")
+        spend_time = max(time.time() - t0, 1e-6)
+        stats.update({'time': spend_time, 'pages_per_second': stats['num_pages'] / spend_time,
+                      'chunks_per_second': stats['num_chunks'] / spend_time})
+        logger.info(f"Ingest stats: {stats}, corpus size: {len(self.sim_model.corpus)}")
+        logger.debug(f"files: {files}, top3: {list(islice(self.sim_model.corpus.values(), 3))}")
+        return stats
+
+    def _index_stored_chunks(self, keys: List[str]):
+        """Add chunks of the store missing in the index, their embeddings are read from the store."""
+        store = self.chunk_store
+        keys = [k for k in dict.fromkeys(keys) if store.row(k) not in self.sim_model.corpus]
+        self.sim_model.add_embeddings({store.row(k): store.text(k) for k in keys}, store.get(keys))
+
+    def remove_corpus(self, files: Union[str, List[str]]):
+        """Remove document files, their chunks leave the index unless another file has them too."""
+        if self.chunk_store is None:
+            raise ValueError("remove_corpus needs a VectorIndexSimilarity with save_corpus_emb_dir")
+        if isinstance(files, str):
+            files = [files]
+        for doc_file in files:
+            keys = self.chunk_store.remove_file(os.path.abspath(doc_file))
+            self.sim_model.remove_corpus([self.chunk_store.row(k) for k in keys])
+        self.chunk_store.save()
 
     @staticmethod
     def get_file_hash(fpaths):
         hasher = hashlib.md5()
-        target_file_data = bytes()
         if isinstance(fpaths, str):
             fpaths = [fpaths]
         for fpath in fpaths:
             with open(fpath, 'rb') as file:
-                chunk = file.read(1024 * 1024)  # read only first 1MB
-                hasher.update(chunk)
-                target_file_data += chunk
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    hasher.update(chunk)
 
         hash_name = hasher.hexdigest()[:32]
         return hash_name
@@ -287,11 +709,16 @@ class ChatPDF:
     @staticmethod
     def extract_text_from_pdf(file_path: str):
         """Extract text content from a PDF file."""
+        return [text for page_contents in ChatPDF.extract_pages_from_pdf(file_path) for text in page_contents]
+
+    @staticmethod
+    def extract_pages_from_pdf(file_path: str):
+        """Extract text content from a PDF file, yield the contents of each page."""
         import PyPDF2
-        contents = []
         with open(file_path, 'rb') as f:
             pdf_reader = PyPDF2.PdfReader(f)
             for page in pdf_reader.pages:
+                contents = []
                 page_text = page.extract_text().strip()
                 raw_text = [text.strip() for text in page_text.splitlines() if text.strip()]
                 new_text = ''
@@ -303,7 +730,7 @@ class ChatPDF:
                         new_text = ''
                 if new_text:
                     contents.append(new_text)
-        return contents
+                yield contents
 
     @staticmethod
     def extract_text_from_txt(file_path: str):
@@ -337,6 +764,75 @@ class ChatPDF:
         """Add source numbers to a list of strings."""
         return [f'[{idx + 1}]\t "{item}"' for idx, item in enumerate(lst)]
 
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        """
+        Token counts of texts, counts of chunks are cached since the same chunks are retrieved again and again.
+        The cache is LRU, texts of this call are marked as used and never evicted by it.
+        """
+        counts = {}
+        for text in dict.fromkeys(texts):
+            if text in self._token_counts:
+                self._token_counts.move_to_end(text)
+                counts[text] = self._token_counts[text]
+        missing = [t for t in dict.fromkeys(texts) if t not in counts]
+        if missing:
+            for text, ids in zip(missing, self.tokenizer(missing, add_special_tokens=False)['input_ids']):
+                counts[text] = len(ids)
+                self._token_counts[text] = len(ids)
+            # Least recently used first, the texts of this call are at the end
+            num_evict = min(len(self._token_counts) - self.max_token_count_cache, len(self._token_counts) - len(counts))
+            for _ in range(max(num_evict, 0)):
+                self._token_counts.popitem(last=False)
+        return [counts[t] for t in texts]
+
+    def _dedupe_references(self, reference_results: List[str]) -> List[str]:
+        """
+        Drop references contained in a higher ranked one and cut the overlap of neighbouring chunks. The splitter
+        appends a space and the head of the next chunk, its first chunk_overlap characters or tokens, to a chunk,
+        so only a reference ending with exactly that head of another one overlaps it.
+        """
+        heads = [''] * len(reference_results)
+        if self.text_splitter.chunk_overlap > 0:
+            heads = [h.rstrip() for h in self.text_splitter.heads(reference_results)]
+        # (text, head of the text if it still starts with it)
+        selected = []
+        for text, head in zip(reference_results, heads):
+            if any(text in s for s, _ in selected):
+                continue
+            for s, s_head in selected:
+                if head and text.startswith(head) and s.endswith(' ' + head):
+                    text = text[len(head):]
+                if s_head and text.endswith(' ' + s_head):
+                    text = text[:-len(s_head)]
+            text = text.strip()
+            if text:
+                selected.append((text, head if head and text.startswith(head) else ''))
+        return [text for text, _ in selected]
+
+    def _build_rag_prompt(self, query: str, reference_results: List[str], context_len: int, max_length: int):
+        """
+        Fill the RAG prompt with as many top ranked references as fit in the tokens left by the prompt and the
+        answer, references are kept whole, only a top reference longer than the whole budget is truncated.
+        :return: prompt, and the numbered references in it
+        """
+        prompt_len = len(self.tokenizer(RAG_PROMPT.format(context_str='', query_str=query),
+                                        add_special_tokens=False)['input_ids'])
+        # 8 tokens for the chat template and special tokens, like stream_generate_answer
+        budget = context_len - max_length - 8 - prompt_len
+        references = self._dedupe_references(reference_results)
+        selected = []
+        for text, size in zip(references, self._count_tokens(references)):
+            size += self.source_number_tokens
+            if size <= budget:
+                selected.append(text)
+                budget -= size
+            elif not selected and budget > self.source_number_tokens:
+                ids = self.tokenizer(text, add_special_tokens=False)['input_ids'][:budget - self.source_number_tokens]
+                selected.append(self.tokenizer.decode(ids, skip_special_tokens=True))
+                break
+        reference_results = self._add_source_numbers(selected)
+        return RAG_PROMPT.format(context_str='\n'.join(reference_results), query_str=query), reference_results
+
     def predict_stream(
             self,
             query: str,
@@ -357,9 +853,7 @@ class ChatPDF:
             if not reference_results:
                 yield '没有提供足够的相关信息', reference_results
             self.history = []
-            reference_results = self._add_source_numbers(reference_results)
-            context_str = '\n'.join(reference_results)[:(context_len - len(RAG_PROMPT))]
-            prompt = RAG_PROMPT.format(context_str=context_str, query_str=query)
+            prompt, reference_results = self._build_rag_prompt(query, reference_results, context_len, max_length)
             # logger.debug(f"prompt: {prompt}")
         else:
             prompt = query
@@ -395,9 +889,7 @@ class ChatPDF:
             if not reference_results:
                 return '没有提供足够的相关信息', reference_results
             self.history = []
-            reference_results = self._add_source_numbers(reference_results)
-            context_str = '\n'.join(reference_results)[:(context_len - len(RAG_PROMPT))]
-            prompt = RAG_PROMPT.format(context_str=context_str, query_str=query)
+            prompt, reference_results = self._build_rag_prompt(query, reference_results, context_len, max_length)
             # logger.debug(f"prompt: {prompt}")
         else:
             prompt = query
@@ -417,6 +909,68 @@ class ChatPDF:
         self.history[-1][1] = response
         return response, reference_results
 
+    @torch.inference_mode()
+    def predict_batch(
+            self,
+            queries: List[str],
+            topn: int = 5,
+            max_length: int = 512,
+            context_len: int = 2048,
+            temperature: float = 0.7,
+            batch_size: int = 8,
+    ):
+        """
+        Query from corpus for many queries, e.g. offline evaluation.
+        Retrieves for all queries with one most_similar call and generates the answers in left padded batches,
+        the chat history is neither used nor changed.
+        :param queries: list of queries
+        :param topn: number of references per query
+        :param max_length: max new tokens of each answer
+        :param context_len: context length of the generate model
+        :param temperature: sampling temperature, 0 is greedy decoding
+        :param batch_size: number of prompts generated together
+        :return: list of (response, reference_results), one per query
+        """
+        results = [None] * len(queries)
+        references = [[] for _ in queries]
+        if self.sim_model.corpus:
+            sim_contents = self.sim_model.most_similar(queries, topn=topn)
+            for i in range(len(queries)):
+                references[i] = [self.sim_model.corpus[corpus_id] for corpus_id in sim_contents.get(i, {})]
+        prompts = {}
+        for i, query in enumerate(queries):
+            if not self.sim_model.corpus:
+                prompts[i] = query
+            elif not references[i]:
+                results[i] = ('没有提供足够的相关信息', references[i])
+            else:
+                prompts[i], references[i] = self._build_rag_prompt(query, references[i], context_len, max_length)
+
+        max_src_len = context_len - max_length - 8
+        prompt_ids = {i: self._get_prompt_ids([[prompt, '']])[-max_src_len:] for i, prompt in prompts.items()}
+        # Prompts of similar length are batched together to waste less compute on padding
+        order = sorted(prompt_ids, key=lambda i: len(prompt_ids[i]))
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        generation_kwargs = dict(max_new_tokens=max_length, do_sample=temperature > 0.0, pad_token_id=pad_token_id)
+        if temperature > 0.0:
+            generation_kwargs['temperature'] = temperature
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            max_len = max(len(prompt_ids[i]) for i in batch)
+            input_ids = [[pad_token_id] * (max_len - len(prompt_ids[i])) + prompt_ids[i] for i in batch]
+            attention_mask = [[0] * (max_len - len(prompt_ids[i])) + [1] * len(prompt_ids[i]) for i in batch]
+            outputs = self.gen_model.generate(
+                input_ids=torch.tensor(input_ids, dtype=torch.long, device=self.gen_model.device),
+                attention_mask=torch.tensor(attention_mask, dtype=torch.long, device=self.gen_model.device),
+                **generation_kwargs,
+            )
+            responses = self.tokenizer.batch_decode(outputs[:, max_len:], skip_special_tokens=True)
+            for i, response in zip(batch, responses):
+                results[i] = (response.strip(), references[i])
+        return results
+
     def save_corpus_emb(self):
         dir_name = self.get_file_hash(self.corpus_files)
         save_dir = os.path.join(self.save_corpus_emb_dir, dir_name)
@@ -431,6 +985,91 @@ class ChatPDF:
             self.sim_model.load_corpus_embeddings(emb_dir)
 
 
+def split_file(doc_file: str, text_splitter: SentenceSplitter):
+    """Extract and split one document file, return (doc_file, number of pages, chunks)."""
+    if doc_file.endswith('.pdf'):
+        pages = list(ChatPDF.extract_pages_from_pdf(doc_file))
+        corpus = [text for page_contents in pages for text in page_contents]
+        num_pages = len(pages)
+    else:
+        corpus = ChatPDF.extract_text(doc_file)
+        num_pages = 1
+    chunks = text_splitter.split_text('\n'.join(corpus))
+    return doc_file, num_pages, chunks
+
+
+_worker_text_splitter = None
+
+
+def _init_split_worker(text_splitter: SentenceSplitter):
+    # The splitter, with its tokenizer if any, is sent once per worker process instead of once per file
+    global _worker_text_splitter
+    _worker_text_splitter = text_splitter
+
+
+def _split_file_in_worker(doc_file: str):
+    return split_file(doc_file, _worker_text_splitter)
+
+
+def iter_split_files(
+        files: List[str],
+        text_splitter: SentenceSplitter,
+        num_workers: int = 1,
+        max_pending_files: int = None,
+):
+    """
+    Extract and split files in a process pool, yield (doc_file, number of pages, chunks) in completion order.
+    :param files: document files
+    :param text_splitter: sentence splitter
+    :param num_workers: number of processes, 1 is run in this process
+    :param max_pending_files: max number of files submitted and not yet consumed, bounds memory,
+        default 2 * num_workers
+    """
+    if num_workers <= 1:
+        for doc_file in files:
+            yield split_file(doc_file, text_splitter)
+        return
+    max_pending_files = max_pending_files or 2 * num_workers
+    files = iter(files)
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_split_worker,
+            initargs=(text_splitter,),
+    ) as executor:
+        pending = set()
+        while True:
+            for doc_file in files:
+                pending.add(executor.submit(_split_file_in_worker, doc_file))
+                if len(pending) >= max_pending_files:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def benchmark_ingestion(files: List[str], sim_model, num_workers: int, batch_size: int,
+                        text_splitter: SentenceSplitter):
+    """Throughput of extract and split with 1 and num_workers processes, and of embedding the chunks."""
+    for workers in sorted({1, num_workers}):
+        t0 = time.time()
+        num_pages, chunks = 0, []
+        for _, pages, file_chunks in iter_split_files(files, text_splitter, num_workers=workers):
+            num_pages += pages
+            chunks.extend(file_chunks)
+        spend_time = max(time.time() - t0, 1e-6)
+        logger.info(f"extract and split, {workers} workers: {len(files)} files, {num_pages} pages, "
+                    f"{len(chunks)} chunks in {spend_time:.2f}s, {num_pages / spend_time:.1f} pages/s, "
+                    f"{len(chunks) / spend_time:.1f} chunks/s")
+    if sim_model is not None and hasattr(sim_model, 'get_embeddings'):
+        t0 = time.time()
+        for start in range(0, len(chunks), batch_size):
+            sim_model.get_embeddings(chunks[start:start + batch_size])
+        spend_time = max(time.time() - t0, 1e-6)
+        logger.info(f"embed, batch size {batch_size}: {len(chunks) / spend_time:.1f} chunks/s")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--sim_model", type=str, default="shibing624/text2vec-base-multilingual")
@@ -444,9 +1083,29 @@ if __name__ == "__main__":
     parser.add_argument("--int8", action='store_true', help="use int8 quantization")
     parser.add_argument("--chunk_size", type=int, default=100)
     parser.add_argument("--chunk_overlap", type=int, default=5)
+    parser.add_argument("--split_by_tokens", action='store_true',
+                        help="Chunk size and overlap count tokens of the generate model tokenizer, not characters")
+    parser.add_argument("--index_type", type=str, default=None, choices=["flat", "ivf"],
+                        help="Vector index of the corpus embeddings, None is use BertSimilarity exhaustive search.")
+    parser.add_argument("--nprobe", type=int, default=16, help="Number of clusters scanned per query of ivf index")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of processes extracting corpus files")
+    parser.add_argument("--embed_batch_size", type=int, default=256, help="Number of chunks embedded together")
+    parser.add_argument("--benchmark_ingestion", action='store_true',
+                        help="Report pages/s and chunks/s of corpus ingestion and exit")
     args = parser.parse_args()
     print(args)
     sim_model = BertSimilarity(model_name_or_path=args.sim_model, device=args.device)
+    if args.index_type:
+        sim_model = VectorIndexSimilarity(sim_model, index_type=args.index_type, nprobe=args.nprobe)
+    if args.benchmark_ingestion:
+        benchmark_ingestion(
+            args.corpus_files.split(','),
+            sim_model if args.index_type else VectorIndexSimilarity(sim_model, index_type='flat'),
+            num_workers=args.num_workers,
+            batch_size=args.embed_batch_size,
+            text_splitter=SentenceSplitter(args.chunk_size, args.chunk_overlap),
+        )
+        exit(0)
     m = ChatPDF(
         similarity_model=sim_model,
         generate_model_name_or_path=args.gen_model,
@@ -458,6 +1117,9 @@ if __name__ == "__main__":
         chunk_overlap=args.chunk_overlap,
         corpus_files=args.corpus_files.split(','),
         prompt_template_name=args.prompt_template_name,
+        num_workers=args.num_workers,
+        embed_batch_size=args.embed_batch_size,
+        split_by_tokens=args.split_by_tokens,
     )
     query = [
         "维胺酯维E乳膏能治理什么疾病",
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Continuous batching scheduler for serving causal LMs.
+
+Incoming requests are queued and merged into one shared decoding batch at token granularity: a request joins
+the batch as soon as its prompt is prefilled and leaves it as soon as it finishes, so one long generation does
+not block everyone else. Each request gets its own stream of generated token ids.
+
+usage:
+    # benchmark on CPU with a tiny random-weight model
+    python continuous_batching.py --num_clients 16 --max_new_tokens 64
+"""
+import argparse
+import asyncio
+import queue
+import threading
+import time
+from typing import Iterable, List, Optional, Union
+
+import torch
+from loguru import logger
+
+
+def to_legacy_cache(past_key_values):
+    """Convert a transformers Cache object to the legacy tuple of (key, value) per layer."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def from_legacy_cache(past_key_values):
+    """Convert the legacy tuple of (key, value) per layer to a transformers Cache object if supported."""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def _left_pad_cache(past_key_values, pad_len: int):
+    """Left pad every key/value tensor of shape [batch, heads, seq_len, head_dim] along seq_len."""
+    return tuple(
+        (torch.nn.functional.pad(k, (0, 0, pad_len, 0)), torch.nn.functional.pad(v, (0, 0, pad_len, 0)))
+        for k, v in past_key_values
+    )
+
+
+class GenerationRequest:
+    """A single generation request: prompt ids, sampling params and the stream of generated token ids."""
+
+    def __init__(
+            self,
+            input_ids: List[int],
+            max_new_tokens: int = 512,
+            do_sample: bool = True,
+            temperature: float = 1.0,
+            top_p: float = 1.0,
+            top_k: int = 0,
+            stop_token_ids: Optional[Iterable[int]] = None,
+            loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        """
+        Init generation request.
+        :param input_ids: prompt token ids
+        :param max_new_tokens: max number of tokens to generate
+        :param do_sample: sample from the distribution, greedy decoding if False
+        :param temperature: sampling temperature
+        :param top_p: nucleus sampling probability
+        :param top_k: top-k sampling, 0 to disable
+        :param stop_token_ids: generation stops once one of these tokens is produced
+        :param loop: event loop of the consumer, if set the request is consumed with `async for`
+        """
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.output_ids = []
+        self.finish_reason = None
+        # number of real (non-padding) tokens of this request held in the kv cache
+        self.num_cached = 0
+        self.next_token_id = None
+        self.cancelled = False
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+
+    def cancel(self):
+        """Stop generating for this request, e.g. the client disconnected or a stop word was found."""
+        self.cancelled = True
+
+    def _emit(self, item):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        else:
+            self._queue.put(item)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class IncrementalDecoder:
+    """Turn a stream of token ids into text deltas, holding back incomplete multi-byte characters."""
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_cache = []
+        self.print_len = 0
+
+    def push(self, token_id: int) -> str:
+        self.token_cache.append(token_id)
+        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=self.skip_special_tokens)
+        if text.endswith("\n"):
+            delta = text[self.print_len:]
+            self.token_cache = []
+            self.print_len = 0
+        elif text.endswith("\ufffd"):
+            delta = ""
+        else:
+            delta = text[self.print_len:]
+            self.print_len += len(delta)
+        return delta
+
+    def flush(self) -> str:
+        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=self.skip_special_tokens)
+        delta = text[self.print_len:]
+        self.token_cache = []
+        self.print_len = 0
+        return delta
+
+
+class ContinuousBatchingScheduler:
+    """
+    Schedule generation requests into a shared decoding batch.
+
+    A background thread owns the model. Each iteration it admits waiting requests (prefill one by one),
+    then runs a single decode step for all active requests. Requests have different lengths, so the batched
+    kv cache is left padded and an attention mask marks the padding.
+    """
+
+    def __init__(
+            self,
+            model,
+            max_batch_size: int = 16,
+            max_prefill_per_step: int = 4,
+            prefix_cache=None,
+    ):
+        """
+        Init scheduler.
+        :param model: causal lm model, must accept past_key_values, attention_mask and position_ids
+        :param max_batch_size: max number of requests decoded together
+        :param max_prefill_per_step: max number of new requests prefilled between two decode steps
+        :param prefix_cache: optional PrefixKVCache, prefill only runs the prompt tokens after the cached prefix
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_prefill_per_step = max_prefill_per_step
+        self.prefix_cache = prefix_cache
+        self._waiting = queue.Queue()
+        self._active: List[GenerationRequest] = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self.num_requests = 0
+        self.num_generated_tokens = 0
+        self.num_decode_steps = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queue a request, its tokens are streamed back through the request itself."""
+        self._waiting.put(request)
+        return request
+
+    def stats(self) -> dict:
+        return {
+            "num_requests": self.num_requests,
+            "num_generated_tokens": self.num_generated_tokens,
+            "num_decode_steps": self.num_decode_steps,
+            "num_active": len(self._active),
+            "num_waiting": self._waiting.qsize(),
+            "avg_tokens_per_step": self.num_generated_tokens / max(self.num_decode_steps, 1),
+        }
+
+    def _run(self):
+        while True:
+            pending = []
+            if not self._active:
+                # Block until there is work to do
+                pending.append(self._waiting.get())
+            while (len(self._active) + len(pending) < self.max_batch_size
+                   and len(pending) < self.max_prefill_per_step):
+                try:
+                    pending.append(self._waiting.get_nowait())
+                except queue.Empty:
+                    break
+            for request in pending:
+                try:
+                    self._admit(request)
+                except Exception as e:
+                    logger.error(f"Prefill failed: {e}")
+                    request._emit(e)
+            if not self._active:
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                logger.error(f"Decode step failed: {e}")
+                for request in self._active:
+                    request._emit(e)
+                self._active = []
+                self._past_key_values = None
+                self._attention_mask = None
+
+    @torch.inference_mode()
+    def _prefill(self, request: GenerationRequest):
+        """Run the prompt through the model, return its kv cache and the logits of the last position."""
+        cached_len, past_key_values = 0, None
+        if self.prefix_cache is not None:
+            cached_len, past_key_values = self.prefix_cache.lookup(request.input_ids)
+        input_ids = torch.tensor([request.input_ids[cached_len:]], dtype=torch.long, device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=from_legacy_cache(past_key_values) if past_key_values is not None else None,
+            use_cache=True,
+        )
+        past_key_values = to_legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.input_ids, past_key_values)
+        return past_key_values, outputs.logits[:, -1, :]
+
+    def _admit(self, request: GenerationRequest):
+        self.num_requests += 1
+        past_key_values, logits = self._prefill(request)
+        request.num_cached = len(request.input_ids)
+        next_token_id = self._sample(logits, [request])[0]
+        if self._append_token(request, next_token_id):
+            return
+        self._merge(past_key_values, request.num_cached)
+        self._active.append(request)
+
+    def _merge(self, past_key_values, seq_len: int):
+        """Add the kv cache of one prefilled request to the batched kv cache."""
+        attention_mask = torch.ones(1, seq_len, dtype=torch.long, device=self.device)
+        if self._past_key_values is None:
+            self._past_key_values, self._attention_mask = past_key_values, attention_mask
+            return
+        cur_len = self._attention_mask.shape[1]
+        if seq_len < cur_len:
+            past_key_values = _left_pad_cache(past_key_values, cur_len - seq_len)
+            attention_mask = torch.nn.functional.pad(attention_mask, (cur_len - seq_len, 0))
+        elif seq_len > cur_len:
+            self._past_key_values = _left_pad_cache(self._past_key_values, seq_len - cur_len)
+            self._attention_mask = torch.nn.functional.pad(self._attention_mask, (seq_len - cur_len, 0))
+        self._past_key_values = tuple(
+            (torch.cat([k0, k1], dim=0), torch.cat([v0, v1], dim=0))
+            for (k0, v0), (k1, v1) in zip(self._past_key_values, past_key_values)
+        )
+        self._attention_mask = torch.cat([self._attention_mask, attention_mask], dim=0)
+
+    def _evict(self, finished: List[int]):
+        """Remove finished requests from the batch and drop padding columns no request needs anymore."""
+        keep = [i for i in range(len(self._active)) if i not in set(finished)]
+        self._active = [self._active[i] for i in keep]
+        if not keep:
+            self._past_key_values = None
+            self._attention_mask = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        start = int(attention_mask.any(dim=0).long().argmax())
+        self._attention_mask = attention_mask[:, start:]
+        self._past_key_values = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self._past_key_values
+        )
+
+    @torch.inference_mode()
+    def _step(self):
+        """Decode one token for every active request."""
+        batch = self._active
+        input_ids = torch.tensor([[r.next_token_id] for r in batch], dtype=torch.long, device=self.device)
+        position_ids = torch.tensor([[r.num_cached] for r in batch], dtype=torch.long, device=self.device)
+        attention_mask = torch.nn.functional.pad(self._attention_mask, (0, 1), value=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self._past_key_values),
+            use_cache=True,
+        )
+        self._past_key_values = to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self.num_decode_steps += 1
+        next_token_ids = self._sample(outputs.logits[:, -1, :], batch)
+        finished = []
+        for i, (request, token_id) in enumerate(zip(batch, next_token_ids)):
+            request.num_cached += 1
+            if self._append_token(request, token_id):
+                finished.append(i)
+        if finished:
+            self._evict(finished)
+
+    def _append_token(self, request: GenerationRequest, token_id: int) -> bool:
+        """Stream a new token to its request, return True if the request is finished."""
+        if request.cancelled or token_id in request.stop_token_ids:
+            request.finish_reason = "stop"
+        else:
+            request.output_ids.append(token_id)
+            request.next_token_id = token_id
+            request._emit(token_id)
+            self.num_generated_tokens += 1
+            if len(request.output_ids) >= request.max_new_tokens:
+                request.finish_reason = "length"
+        if request.finish_reason is not None:
+            request._emit(None)
+            return True
+        return False
+
+    @staticmethod
+    def _sample(logits: torch.Tensor, requests: List[GenerationRequest]) -> List[int]:
+        """Pick the next token of each row with the sampling params of its request."""
+        logits = logits.float()
+        if not any(r.do_sample for r in requests):
+            return logits.argmax(dim=-1).tolist()
+        token_ids = []
+        for scores, request in zip(logits, requests):
+            if not request.do_sample or request.temperature < 1e-5:
+                token_ids.append(int(scores.argmax()))
+                continue
+            scores = scores / request.temperature
+            if request.top_k > 0:
+                kth_score = torch.topk(scores, min(request.top_k, scores.size(-1)))[0][-1]
+                scores = scores.masked_fill(scores < kth_score, float("-inf"))
+            if request.top_p < 1.0:
+                sorted_scores, sorted_indices = torch.sort(scores, descending=True)
+                sorted_probs = sorted_scores.softmax(dim=-1)
+                # Remove tokens once the cumulative probability before them exceeds top_p
+                sorted_to_remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > request.top_p
+                scores = scores.index_fill(0, sorted_indices[sorted_to_remove], float("-inf"))
+            token_ids.append(int(torch.multinomial(scores.softmax(dim=-1), num_samples=1)))
+        return token_ids
+
+
+def get_stop_token_ids(model, tokenizer=None) -> List[int]:
+    """Collect eos token ids from the generation config and the tokenizer."""
+    eos_token_id: Union[int, List[int], None] = getattr(model.generation_config, "eos_token_id", None)
+    stop_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+    if tokenizer is not None:
+        stop_token_ids.add(tokenizer.eos_token_id)
+    stop_token_ids.discard(None)
+    return sorted(stop_token_ids)
+
+
+def benchmark(num_clients: int, max_new_tokens: int, prompt_len: int, max_batch_size: int):
+    """Compare tokens/s of serialized `model.generate` calls with the continuous batching scheduler."""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=prompt_len + max_new_tokens + 8,
+    )
+    model = LlamaForCausalLM(config).eval()
+    prompts = [
+        torch.randint(3, config.vocab_size, (int(torch.randint(prompt_len // 2, prompt_len + 1, (1,))),)).tolist()
+        for _ in range(num_clients)
+    ]
+
+    # One request after the other, like one `model.generate` per HTTP request serialized on the model
+    t0 = time.time()
+    for prompt in prompts:
+        model.generate(
+            torch.tensor([prompt]),
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+    serial_time = time.time() - t0
+    total_tokens = num_clients * max_new_tokens
+    logger.info(f"serial generate: {total_tokens} tokens in {serial_time:.2f}s, "
+                f"{total_tokens / serial_time:.1f} tokens/s")
+
+    scheduler = ContinuousBatchingScheduler(model, max_batch_size=max_batch_size)
+    results = [0] * num_clients
+
+    def client(i):
+        request = scheduler.submit(GenerationRequest(prompts[i], max_new_tokens=max_new_tokens, do_sample=False))
+        results[i] = sum(1 for _ in request)
+
+    t0 = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batch_time = time.time() - t0
+    total_tokens = sum(results)
+    logger.info(f"continuous batching, {num_clients} concurrent clients: {total_tokens} tokens in "
+                f"{batch_time:.2f}s, {total_tokens / batch_time:.1f} tokens/s, "
+                f"speedup: {serial_time / batch_time:.2f}x, stats: {scheduler.stats()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_clients', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--max_new_tokens', type=int, default=64)
+    parser.add_argument('--prompt_len', type=int, default=128, help='Max prompt length, min is half of it')
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    args = parser.parse_args()
+    logger.info(args)
+    benchmark(args.num_clients, args.max_new_tokens, args.prompt_len, args.max_batch_size)
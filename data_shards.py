@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Compile training data to pre-tokenized, memory-mapped shards shared by the trainers.
+
+Every trainer reads the json/txt files and tokenizes them again at startup. `compile` runs the tokenization of
+a training stage once and writes each column of each split as a flat token id array plus an offset index:
+
+    output_dir/
+        meta.json                   # stage, tokenizer hash, template name, max length, dtypes, split sizes
+        train/input_ids.bin         # uint16 if the vocab fits, else uint32, all examples back to back
+        train/input_ids.idx         # int64 offsets, example i is bin[idx[i]:idx[i + 1]]
+        validation/...
+
+The trainers load them with `--compiled_data_dir output_dir`, an example is a slice of the memmap, no json
+parsing or tokenization is done at startup. SFT labels are stored as a uint8 loss mask over input_ids.
+The tokenizer hash and template name are checked on load, shards of another tokenizer raise an error.
+
+usage:
+    python data_shards.py --stage sft --tokenizer_name_or_path Qwen/Qwen2.5-0.5B-Instruct \
+        --train_file_dir data/finetune --template_name qwen --model_max_length 2048 --output_dir data/compiled/sft
+    python data_shards.py --stage pt --tokenizer_name_or_path Qwen/Qwen2.5-0.5B \
+        --train_file_dir data/pretrain --model_max_length 1024 --output_dir data/compiled/pt
+    python data_shards.py --stage rm --tokenizer_name_or_path Qwen/Qwen2.5-0.5B-Instruct \
+        --train_file_dir data/reward --template_name qwen --model_max_length 1280 --output_dir data/compiled/rm
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from glob import glob
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch.utils.data
+from loguru import logger
+
+SHARD_VERSION = 2
+META_FILE = "meta.json"
+
+
+def token_dtype(vocab_size: int):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """Hash of the vocab, merges, normalizer and added tokens, ids of another tokenizer are meaningless."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        content = backend.to_str()
+    else:
+        content = json.dumps(tokenizer.get_vocab(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def setup_special_tokens(tokenizer, prompt_template):
+    """Add the eos, bos and pad tokens the same way as the SFT and RM trainers, the hash covers added tokens."""
+    if tokenizer.eos_token_id is None:
+        tokenizer.eos_token = prompt_template.stop_str
+        tokenizer.add_special_tokens({"eos_token": tokenizer.eos_token})
+    if tokenizer.bos_token_id is None:
+        tokenizer.add_special_tokens({"bos_token": tokenizer.eos_token})
+        tokenizer.bos_token_id = tokenizer.eos_token_id
+    if tokenizer.pad_token_id is None:
+        if tokenizer.unk_token_id is not None:
+            tokenizer.pad_token = tokenizer.unk_token
+        else:
+            tokenizer.pad_token = tokenizer.eos_token
+
+
+class ShardWriter:
+    """Append variable length examples of some columns to flat .bin files, offsets are written on close."""
+
+    def __init__(self, split_dir: str, dtypes: Dict[str, np.dtype]):
+        os.makedirs(split_dir, exist_ok=True)
+        self.split_dir = split_dir
+        self.dtypes = dtypes
+        self._files = {k: open(os.path.join(split_dir, f"{k}.bin"), "wb") for k in dtypes}
+        self._offsets = {k: [0] for k in dtypes}
+
+    def add_batch(self, columns: Dict[str, List[List[int]]]):
+        for k, values in columns.items():
+            offsets = self._offsets[k]
+            for v in values:
+                offsets.append(offsets[-1] + len(v))
+            if values:
+                self._files[k].write(np.concatenate(values).astype(self.dtypes[k]).tobytes())
+
+    def __len__(self):
+        return len(next(iter(self._offsets.values()))) - 1
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(self._offsets[k][-1] for k in self.dtypes if k.endswith("_ids") and k != "position_ids")
+
+    def close(self):
+        for k, f in self._files.items():
+            f.close()
+            np.array(self._offsets[k], dtype=np.int64).tofile(os.path.join(self.split_dir, f"{k}.idx"))
+
+
+class CompiledDataset(torch.utils.data.Dataset):
+    """
+    Map style dataset over a compiled split, example i of a column is a slice of its memmap.
+    Memmaps are opened lazily, so the dataset is cheap to pickle to dataloader workers.
+    """
+
+    def __init__(self, split_dir: str, meta: dict, ignore_index: int = -100, indices: Optional[np.ndarray] = None):
+        """
+        :param split_dir: directory of one split, e.g. output_dir/train
+        :param meta: meta of the compiled data
+        :param ignore_index: label of the tokens masked out of the loss
+        :param indices: optional subset of the examples, see `select`
+        """
+        self.split_dir = split_dir
+        self.meta = meta
+        self.stage = meta["stage"]
+        self.ignore_index = ignore_index
+        self.columns = meta["splits"][os.path.basename(os.path.normpath(split_dir))]["columns"]
+        self.indices = indices
+        self._data = None
+        self._offsets = None
+
+    def _open(self):
+        self._data, self._offsets = {}, {}
+        for k, dtype in self.columns.items():
+            self._data[k] = np.memmap(os.path.join(self.split_dir, f"{k}.bin"), dtype=np.dtype(dtype), mode="r")
+            self._offsets[k] = np.fromfile(os.path.join(self.split_dir, f"{k}.idx"), dtype=np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        state["_offsets"] = None
+        return state
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        if self._offsets is None:
+            self._open()
+        return len(next(iter(self._offsets.values()))) - 1
+
+    def _column(self, k: str, i: int) -> np.ndarray:
+        offsets = self._offsets[k]
+        return self._data[k][offsets[i]:offsets[i + 1]].astype(np.int64)
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        if self._data is None:
+            self._open()
+        if self.indices is not None:
+            i = int(self.indices[i])
+        if self.stage == "rm":
+            return {k: self._column(k, i) for k in ("prompt_ids", "chosen_ids", "rejected_ids")}
+        input_ids = self._column("input_ids", i)
+        if self.stage == "pt":
+            return {"input_ids": input_ids, "attention_mask": np.ones_like(input_ids), "labels": input_ids.copy()}
+        loss_mask = self._data["loss_mask"][self._offsets["loss_mask"][i]:self._offsets["loss_mask"][i + 1]]
+        example = {"input_ids": input_ids, "labels": np.where(loss_mask, input_ids, self.ignore_index)}
+        if "position_ids" in self.columns:
+            example["position_ids"] = self._column("position_ids", i)
+        else:
+            example["attention_mask"] = np.ones_like(input_ids)
+        return example
+
+    def column_lengths(self, column: str) -> np.ndarray:
+        """Number of tokens of a column of each example."""
+        if self._offsets is None:
+            self._open()
+        lengths = np.diff(self._offsets[column])
+        return lengths if self.indices is None else lengths[self.indices]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of tokens of each example, prompt + the longer one of chosen and rejected for rm."""
+        if self.stage == "rm":
+            return self.column_lengths("prompt_ids") + np.maximum(self.column_lengths("chosen_ids"),
+                                                                  self.column_lengths("rejected_ids"))
+        return self.column_lengths("input_ids")
+
+    def select(self, indices) -> "CompiledDataset":
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return CompiledDataset(self.split_dir, self.meta, self.ignore_index, indices)
+
+
+def load_compiled_datasets(
+        data_dir: str,
+        tokenizer,
+        stage: str,
+        template_name: Optional[str] = None,
+        ignore_index: int = -100,
+        max_length: Optional[int] = None,
+) -> Dict[str, CompiledDataset]:
+    """
+    Load the splits of compiled data, checking they were compiled for this stage, tokenizer and template.
+    :param data_dir: output_dir of `compile`
+    :param tokenizer: tokenizer of the trainer, after its special tokens are set up
+    :param stage: pt, sft or rm
+    :param template_name: prompt template of the trainer, not checked for pt
+    :param ignore_index: label of the tokens masked out of the loss
+    :param max_length: drop longer examples, for data compiled with a larger max length
+    :return: dict of split name to CompiledDataset
+    """
+    with open(os.path.join(data_dir, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != SHARD_VERSION:
+        raise ValueError(f"Compiled data version {meta.get('version')} of {data_dir} is not {SHARD_VERSION}, "
+                         f"please compile it again")
+    if meta["stage"] != stage:
+        raise ValueError(f"Compiled data of {data_dir} is for stage {meta['stage']}, not {stage}")
+    if meta["tokenizer_hash"] != tokenizer_hash(tokenizer):
+        raise ValueError(f"Compiled data of {data_dir} was tokenized by another tokenizer "
+                         f"({meta['tokenizer_name_or_path']}), please compile it again")
+    if stage != "pt" and meta["template_name"] != template_name:
+        raise ValueError(f"Compiled data of {data_dir} uses template {meta['template_name']}, not {template_name}")
+    datasets = {}
+    for split, info in meta["splits"].items():
+        dataset = CompiledDataset(os.path.join(data_dir, split), meta, ignore_index)
+        logger.info(f"Loaded compiled {split} data: {info['num_examples']} examples, {info['num_tokens']} tokens")
+        if max_length is not None and max_length < meta["max_length"]:
+            dataset = dataset.select(np.flatnonzero(dataset.lengths <= max_length))
+            logger.info(f"Kept {len(dataset)} {split} examples of at most {max_length} tokens")
+        datasets[split] = dataset
+    return datasets
+
+
+def load_raw_datasets(stage: str, train_file_dir: str, validation_file_dir: Optional[str],
+                      validation_split_percentage: int):
+    from datasets import load_dataset
+
+    patterns = ["**/*.json", "**/*.jsonl"] + (["**/*.txt"] if stage == "pt" else [])
+    data_files = {}
+    for split, file_dir in [("train", train_file_dir), ("validation", validation_file_dir)]:
+        if file_dir is not None and os.path.exists(file_dir):
+            files = sum([glob(os.path.join(file_dir, p), recursive=True) for p in patterns], [])
+            logger.info(f"{split} files: {files}")
+            data_files[split] = files
+    extension = "text" if data_files["train"][0].endswith("txt") else "json"
+    raw_datasets = load_dataset(extension, data_files=data_files)
+    if "validation" not in raw_datasets and validation_split_percentage > 0:
+        split = raw_datasets["train"].shuffle(seed=42).train_test_split(
+            test_size=validation_split_percentage / 100, seed=42)
+        raw_datasets["train"] = split["train"]
+        raw_datasets["validation"] = split["test"]
+    return raw_datasets
+
+
+def tokenize_text(examples, tokenizer):
+    return {"input_ids": tokenizer(examples["text"])["input_ids"]}
+
+
+def _write_split(writer: ShardWriter, dataset, stage: str, max_length: int, ignore_index: int, batch_size: int):
+    buffer = np.zeros(0, dtype=np.int64)
+    for batch in dataset.iter(batch_size=batch_size):
+        if stage == "pt":
+            # Concatenate all texts and cut blocks of max_length, like group_text_function of pretraining.py,
+            # the remainder is carried to the next batch so only the last one of the split is dropped
+            buffer = np.concatenate([buffer] + [np.asarray(x, dtype=np.int64) for x in batch["input_ids"]])
+            num_blocks = len(buffer) // max_length
+            writer.add_batch({"input_ids": list(buffer[:num_blocks * max_length].reshape(-1, max_length))})
+            buffer = buffer[num_blocks * max_length:]
+        elif stage == "sft":
+            columns = {"input_ids": batch["input_ids"], "loss_mask": []}
+            for input_ids, labels in zip(batch["input_ids"], batch["labels"]):
+                input_ids, labels = np.asarray(input_ids), np.asarray(labels)
+                loss_mask = labels != ignore_index
+                if not np.array_equal(labels[loss_mask], input_ids[loss_mask]):
+                    raise ValueError("SFT labels must be the input_ids or ignore_index to be stored as a loss mask")
+                columns["loss_mask"].append(loss_mask)
+            if "position_ids" in batch:
+                columns["position_ids"] = batch["position_ids"]
+            writer.add_batch(columns)
+        else:
+            writer.add_batch({k: batch[k] for k in ("prompt_ids", "chosen_ids", "rejected_ids")})
+
+
+def compile_data(args):
+    from transformers import AutoTokenizer
+    from transformers.trainer_pt_utils import LabelSmoother
+
+    from template import get_conv_template
+
+    t0 = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, trust_remote_code=True)
+    prompt_template = None
+    if args.stage != "pt":
+        prompt_template = get_conv_template(args.template_name)
+        setup_special_tokens(tokenizer, prompt_template)
+    ignore_index = LabelSmoother.ignore_index
+    raw_datasets = load_raw_datasets(args.stage, args.train_file_dir, args.validation_file_dir,
+                                     args.validation_split_percentage)
+    logger.info(f"Raw datasets: {raw_datasets}")
+
+    if args.stage == "pt":
+        map_kwargs = {"function": tokenize_text, "fn_kwargs": {"tokenizer": tokenizer}}
+    elif args.stage == "sft":
+        from supervised_finetuning import preprocess_function
+
+        map_kwargs = {"function": preprocess_function, "fn_kwargs": {
+            "tokenizer": tokenizer,
+            "prompt_template": prompt_template,
+            "max_length": args.model_max_length,
+            "ignore_index": ignore_index,
+            "train_on_inputs": args.train_on_inputs,
+        }}
+    else:
+        from reward_modeling import preprocess_reward_function
+
+        map_kwargs = {"function": preprocess_reward_function,
+                      "fn_kwargs": {"tokenizer": tokenizer, "prompt_template": prompt_template}}
+
+    vocab_dtype = token_dtype(len(tokenizer))
+    dtypes = {
+        "pt": {"input_ids": vocab_dtype},
+        "sft": {"input_ids": vocab_dtype, "loss_mask": np.uint8},
+        "rm": {"prompt_ids": vocab_dtype, "chosen_ids": vocab_dtype, "rejected_ids": vocab_dtype},
+    }[args.stage]
+
+    meta = {
+        "version": SHARD_VERSION,
+        "stage": args.stage,
+        "tokenizer_name_or_path": args.tokenizer_name_or_path,
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "vocab_size": len(tokenizer),
+        "template_name": args.template_name if args.stage != "pt" else None,
+        "max_length": args.model_max_length,
+        "packing": args.stage == "sft" and args.packing,
+        "splits": {},
+    }
+    for split, dataset in raw_datasets.items():
+        dataset = dataset.map(
+            batched=True,
+            num_proc=args.num_workers,
+            remove_columns=dataset.column_names,
+            desc=f"Tokenizing {split}",
+            **map_kwargs,
+        )
+        if args.stage == "sft":
+            dataset = dataset.filter(lambda x: any(label != ignore_index for label in x["labels"]),
+                                     num_proc=args.num_workers)
+            # Only the train split is packed, the same as supervised_finetuning.py
+            if args.packing and split == "train":
+                from supervised_finetuning import pack_examples
+
+                dataset = dataset.map(
+                    pack_examples,
+                    batched=True,
+                    batch_size=args.packing_batch_size,
+                    num_proc=args.num_workers,
+                    remove_columns=dataset.column_names,
+                    fn_kwargs={"max_length": args.model_max_length, "ignore_index": ignore_index},
+                    desc=f"Packing {split}",
+                )
+        elif args.stage == "rm":
+            from reward_modeling import is_valid_pair
+
+            dataset = dataset.filter(is_valid_pair, fn_kwargs={"max_length": args.model_max_length},
+                                     num_proc=args.num_workers)
+        split_dtypes = dict(dtypes)
+        if "position_ids" in dataset.column_names:
+            split_dtypes["position_ids"] = token_dtype(args.model_max_length)
+        writer = ShardWriter(os.path.join(args.output_dir, split), split_dtypes)
+        _write_split(writer, dataset, args.stage, args.model_max_length, ignore_index, args.batch_size)
+        writer.close()
+        meta["splits"][split] = {
+            "num_examples": len(writer),
+            "num_tokens": writer.num_tokens,
+            "columns": {k: np.dtype(v).name for k, v in split_dtypes.items()},
+        }
+        logger.info(f"Compiled {split}: {len(writer)} examples, {writer.num_tokens} tokens")
+    with open(os.path.join(args.output_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    logger.info(f"Saved compiled data to {args.output_dir}, spend time: {time.time() - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stage', type=str, required=True, choices=['pt', 'sft', 'rm'])
+    parser.add_argument('--tokenizer_name_or_path', type=str, required=True)
+    parser.add_argument('--train_file_dir', type=str, required=True)
+    parser.add_argument('--validation_file_dir', type=str, default=None)
+    parser.add_argument('--validation_split_percentage', type=int, default=1,
+                        help='Percentage of the train data used for validation if there is no validation_file_dir')
+    parser.add_argument('--template_name', type=str, default='vicuna', help='Prompt template of sft and rm')
+    parser.add_argument('--model_max_length', type=int, default=2048,
+                        help='pt: block size, sft: max length, rm: max length of chosen and rejected')
+    parser.add_argument('--train_on_inputs', action='store_true', help='sft: also compute loss on inputs')
+    parser.add_argument('--packing', action='store_true', help='sft: pack examples, see supervised_finetuning.py')
+    parser.add_argument('--packing_batch_size', type=int, default=2000)
+    parser.add_argument('--num_workers', type=int, default=None, help='Processes of tokenization')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Examples written per batch')
+    parser.add_argument('--output_dir', type=str, required=True)
+    args = parser.parse_args()
+    logger.info(args)
+    compile_data(args)
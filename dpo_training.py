@@ -3,15 +3,21 @@
 @author:XuMing(xuming624@qq.com)
 @description: Train a model from SFT using DPO
 """
+import hashlib
+import json
+import math
 import os
 from copy import deepcopy
 from dataclasses import dataclass, field
 from glob import glob
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
+import numpy as np
 import torch
-from datasets import load_dataset
+from datasets import Dataset, Features, Value, concatenate_datasets, load_dataset
 from loguru import logger
+from torch.utils.data import DataLoader
+from tqdm import tqdm
 from peft import LoraConfig, TaskType
 from transformers import (
     AutoConfig,
@@ -149,10 +155,26 @@ class ScriptArguments:
         metadata={"help": "Remove unused columns from the dataset if `datasets.Dataset` is used"},
     )
     report_to: Optional[str] = field(default="tensorboard", metadata={"help": "Report to wandb or tensorboard"})
+    ref_logps_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of precomputed reference model log probs, train reads them instead of "
+                          "keeping a reference model"}
+    )
+    precompute_ref_logps: bool = field(
+        default=False,
+        metadata={"help": "Only compute the reference log probs of the train and eval data into ref_logps_dir "
+                          "and exit, an interrupted run resumes from the finished chunks"}
+    )
+    precompute_batch_size: int = field(default=8, metadata={"help": "Batch size of precomputing ref log probs"})
+    precompute_chunk_size: int = field(
+        default=2048, metadata={"help": "Number of pairs of each saved chunk of precomputed ref log probs"}
+    )
 
     def __post_init__(self):
         if self.model_name_or_path is None:
             raise ValueError("You must specify a valid model_name_or_path to run training.")
+        if self.precompute_ref_logps and self.ref_logps_dir is None:
+            raise ValueError("--precompute_ref_logps requires --ref_logps_dir")
 
 
 def print_trainable_parameters(model):
@@ -192,6 +214,132 @@ def find_all_linear_names(peft_model, int4=False, int8=False):
     return sorted(lora_module_names)
 
 
+def pair_keys(dataset, batch_size: int = 1000) -> np.ndarray:
+    """64-bit hash of the prompt, chosen and rejected token ids of each pair tokenized by DPOTrainer."""
+    columns = ["prompt_input_ids", "chosen_input_ids", "rejected_input_ids"]
+    keys = []
+    for batch in dataset.select_columns(columns).iter(batch_size=batch_size):
+        for ids in zip(*(batch[c] for c in columns)):
+            h = hashlib.blake2b(digest_size=8)
+            for x in ids:
+                h.update(np.asarray(x, dtype=np.int64).tobytes())
+                h.update(b"|")
+            keys.append(int.from_bytes(h.digest(), "little", signed=True))
+    return np.array(keys, dtype=np.int64)
+
+
+def precompute_ref_logps(trainer, dataset, output_dir: str, batch_size: int, chunk_size: int):
+    """
+    Compute the reference log probs of chosen and rejected of every pair, saved in chunks of part-xxxxx.npz
+    holding the pair keys and float32 [n, 2] log probs. Pairs are chunked in key order, so a rerun skips the
+    saved chunks even if the dataset is shuffled, processes of a distributed run take every world_size-th chunk.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    trainer.model.eval()
+    keys = pair_keys(dataset)
+    order = np.argsort(keys, kind="stable")
+    num_chunks = math.ceil(len(order) / chunk_size)
+    for i in range(trainer.args.process_index, num_chunks, trainer.args.world_size):
+        path = os.path.join(output_dir, f"part-{i:05d}.npz")
+        if os.path.exists(path):
+            continue
+        indices = order[i * chunk_size: (i + 1) * chunk_size]
+        loader = DataLoader(dataset.select(indices), batch_size=batch_size, collate_fn=trainer.data_collator)
+        chosen_logps, rejected_logps = [], []
+        for batch in tqdm(loader, desc=f"Reference log probs of chunk {i + 1}/{num_chunks}"):
+            chosen, rejected = trainer.compute_ref_log_probs(trainer._prepare_inputs(batch))
+            chosen_logps.append(chosen.float().cpu())
+            rejected_logps.append(rejected.float().cpu())
+        logps = torch.stack([torch.cat(chosen_logps), torch.cat(rejected_logps)], dim=1).numpy()
+        tmp_path = os.path.join(output_dir, f"part-{i:05d}.tmp.npz")
+        np.savez(tmp_path, keys=keys[indices], logps=logps.astype(np.float32))
+        os.replace(tmp_path, path)
+    logger.info(f"Saved reference log probs of {len(keys)} pairs to {output_dir}")
+
+
+def load_ref_logps(ref_logps_dir: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted pair keys and their [n, 2] reference log probs of all chunks under ref_logps_dir."""
+    keys, logps = [], []
+    for path in sorted(glob(os.path.join(ref_logps_dir, "**", "part-*.npz"), recursive=True)):
+        if path.endswith(".tmp.npz"):
+            continue
+        with np.load(path) as data:
+            keys.append(data["keys"])
+            logps.append(data["logps"])
+    if not keys:
+        raise ValueError(f"No precomputed reference log probs in {ref_logps_dir}, run with --precompute_ref_logps")
+    keys, logps = np.concatenate(keys), np.concatenate(logps)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], logps[order]
+
+
+def add_ref_logps(dataset, sorted_keys: np.ndarray, sorted_logps: np.ndarray):
+    """Add float32 ref_chosen_logps and ref_rejected_logps columns, DPOTrainer uses them in place of a ref model."""
+    keys = pair_keys(dataset)
+    pos = np.clip(np.searchsorted(sorted_keys, keys), 0, max(len(sorted_keys) - 1, 0))
+    missing = int((sorted_keys[pos] != keys).sum())
+    if missing:
+        raise ValueError(f"{missing} of {len(keys)} pairs have no precomputed reference log probs, "
+                         f"run with --precompute_ref_logps to compute them")
+    logps = sorted_logps[pos]
+    columns = Dataset.from_dict(
+        {"ref_chosen_logps": logps[:, 0], "ref_rejected_logps": logps[:, 1]},
+        features=Features({"ref_chosen_logps": Value("float32"), "ref_rejected_logps": Value("float32")}),
+    )
+    return concatenate_datasets([dataset, columns], axis=1)
+
+
+def tokenize_pairs(examples, tokenizer) -> Dict[str, list]:
+    """
+    Token ids and token lengths of prompt, chosen and rejected, one batched call of the fast tokenizer per column.
+    Tokenized without special tokens as DPOTrainer does, the trainer appends the eos token to the responses.
+    """
+    outputs = {}
+    for column in ("prompt", "chosen", "rejected"):
+        input_ids = tokenizer(examples[column], add_special_tokens=False)["input_ids"]
+        outputs[f"{column}_input_ids"] = input_ids
+        outputs[f"{column}_length"] = [len(ids) for ids in input_ids]
+    return outputs
+
+
+def filter_pair_lengths(prompt_length, chosen_length, rejected_length, max_source_length, max_target_length):
+    """Batched filter, keep pairs whose prompt and responses plus eos fit max_source_length and max_target_length."""
+    return [
+        0 < p <= max_source_length and c < max_target_length and r < max_target_length
+        for p, c, r in zip(prompt_length, chosen_length, rejected_length)
+    ]
+
+
+class TokenizedDPOTrainer(DPOTrainer):
+    """DPOTrainer reusing the prompt, chosen and rejected token ids of tokenize_pairs instead of tokenizing again."""
+
+    @staticmethod
+    def tokenize_row(features, processing_class, max_prompt_length, max_completion_length, add_special_tokens):
+        if "prompt_input_ids" not in features:
+            return DPOTrainer.tokenize_row(
+                features, processing_class, max_prompt_length, max_completion_length, add_special_tokens
+            )
+        tokenizer = processing_class
+        prompt_input_ids = list(features["prompt_input_ids"])
+        if add_special_tokens:
+            if tokenizer.bos_token_id is not None:
+                prompt_input_ids = [tokenizer.bos_token_id] + prompt_input_ids
+            if tokenizer.eos_token_id is not None:
+                prompt_input_ids = prompt_input_ids + [tokenizer.eos_token_id]
+        chosen_input_ids = list(features["chosen_input_ids"]) + [tokenizer.eos_token_id]
+        rejected_input_ids = list(features["rejected_input_ids"]) + [tokenizer.eos_token_id]
+        if max_prompt_length is not None:
+            prompt_input_ids = prompt_input_ids[-max_prompt_length:]
+        if max_completion_length is not None:
+            chosen_input_ids = chosen_input_ids[:max_completion_length]
+            rejected_input_ids = rejected_input_ids[:max_completion_length]
+        return {
+            "prompt_input_ids": prompt_input_ids,
+            "chosen_input_ids": chosen_input_ids,
+            "rejected_input_ids": rejected_input_ids,
+        }
+
+
 def main():
     parser = HfArgumentParser(ScriptArguments)
     args = parser.parse_args_into_dataclasses()[0]
@@ -283,7 +431,7 @@ def main():
     max_target_length = args.max_target_length
     full_max_length = max_source_length + max_target_length
 
-    def return_prompt_and_responses(examples) -> Dict[str, str]:
+    def return_prompt_and_responses(examples) -> Dict[str, list]:
         """Load the paired dataset and convert it to the necessary format.
 
         The dataset is converted to a dictionary with the following structure:
@@ -292,6 +440,7 @@ def main():
             'chosen': List[str],
             'rejected': List[str],
         }
+        plus the token ids and token lengths of each column, see tokenize_pairs.
 
         Prompts are structured as follows:
           system_prompt + history[[q,a], [q,a]...] + question
@@ -301,11 +450,22 @@ def main():
             system_prompt = system or ""
             history_with_question = history + [[question, '']] if history else [[question, '']]
             prompts.append(prompt_template.get_prompt(messages=history_with_question, system_prompt=system_prompt))
-        return {
+        outputs = {
             "prompt": prompts,
             "chosen": examples["response_chosen"],
             "rejected": examples["response_rejected"],
         }
+        outputs.update(tokenize_pairs(outputs, tokenizer))
+        return outputs
+
+    length_filter_kwargs = {
+        "batched": True,
+        "input_columns": ["prompt_length", "chosen_length", "rejected_length"],
+        "fn_kwargs": {"max_source_length": max_source_length, "max_target_length": max_target_length},
+        "num_proc": args.preprocessing_num_workers,
+        "load_from_cache_file": not args.overwrite_cache,
+        "desc": "Filtering pairs by token length",
+    }
 
     # Preprocess the dataset
     train_dataset = None
@@ -327,10 +487,7 @@ def main():
             load_from_cache_file=not args.overwrite_cache,
             desc="Running tokenizer on dataset",
         )
-        train_dataset = tokenized_dataset.filter(
-            lambda x: 0 < len(x['prompt'] + x['chosen']) <= full_max_length
-                      and 0 < len(x['prompt'] + x['rejected']) <= full_max_length
-        )
+        train_dataset = tokenized_dataset.filter(filter_pair_lengths, **length_filter_kwargs)
         logger.debug(f"Num train_samples: {len(train_dataset)}")
         logger.debug("First train example:")
         first_example = train_dataset[0]
@@ -357,10 +514,7 @@ def main():
             load_from_cache_file=not args.overwrite_cache,
             desc="Running tokenizer on dataset",
         )
-        eval_dataset = eval_dataset.filter(
-            lambda x: 0 < len(x['prompt'] + x['chosen']) <= full_max_length
-                      and 0 < len(x['prompt'] + x['rejected']) <= full_max_length
-        )
+        eval_dataset = eval_dataset.filter(filter_pair_lengths, **length_filter_kwargs)
         logger.debug(f"Num eval_samples: {len(eval_dataset)}")
         logger.debug("First eval example:")
         first_example = eval_dataset[0]
@@ -437,6 +591,8 @@ def main():
         fp16=args.fp16,
         remove_unused_columns=args.remove_unused_columns,
         run_name=f"dpo_v1",
+        # No reference model copy is made, the log probs are precomputed or read from ref_logps_dir
+        precompute_ref_log_probs=args.ref_logps_dir is not None,
     )
 
     # Initialize DPO trainer
@@ -457,9 +613,9 @@ def main():
         )
     else:
         logger.info("Fine-tuning method: Full parameters training")
-    trainer = DPOTrainer(
+    trainer = TokenizedDPOTrainer(
         model,
-        ref_model=None if args.use_peft else deepcopy(model),
+        ref_model=None if args.use_peft or args.ref_logps_dir is not None else deepcopy(model),
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
@@ -468,6 +624,39 @@ def main():
     )
     print_trainable_parameters(trainer.model)
 
+    if args.ref_logps_dir is not None:
+        meta = {
+            "model_name_or_path": args.model_name_or_path,
+            "peft_path": args.peft_path,
+            "template_name": args.template_name,
+            "max_source_length": args.max_source_length,
+            "max_target_length": args.max_target_length,
+        }
+        meta_file = os.path.join(args.ref_logps_dir, "meta.json")
+        if args.precompute_ref_logps:
+            if trainer.is_world_process_zero():
+                os.makedirs(args.ref_logps_dir, exist_ok=True)
+                with open(meta_file, "w", encoding="utf-8") as f:
+                    json.dump(meta, f, ensure_ascii=False, indent=2)
+            for split, dataset in [("train", trainer.train_dataset), ("eval", trainer.eval_dataset)]:
+                if dataset is not None:
+                    precompute_ref_logps(trainer, dataset, os.path.join(args.ref_logps_dir, split),
+                                         args.precompute_batch_size, args.precompute_chunk_size)
+            return
+        if os.path.exists(meta_file):
+            with open(meta_file, "r", encoding="utf-8") as f:
+                saved_meta = json.load(f)
+            if saved_meta != meta:
+                logger.warning(f"Reference log probs were computed with {saved_meta}, training with {meta}")
+        sorted_keys, sorted_logps = load_ref_logps(args.ref_logps_dir)
+        if trainer.train_dataset is not None:
+            trainer.train_dataset = add_ref_logps(trainer.train_dataset, sorted_keys, sorted_logps)
+            trainer._precomputed_train_ref_log_probs = True
+        if trainer.eval_dataset is not None:
+            trainer.eval_dataset = add_ref_logps(trainer.eval_dataset, sorted_keys, sorted_logps)
+            trainer._precomputed_eval_ref_log_probs = True
+        logger.info(f"Loaded {len(sorted_keys)} precomputed reference log probs from {args.ref_logps_dir}")
+
     # Training
     if args.do_train:
         if trainer.is_world_process_zero():
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Token accuracy and perplexity of causal LM evaluation without full vocab tensors on the host.
+
+preprocess_logits_for_metrics reduces the [batch, seq, vocab] logits of an eval step on device, in chunks of the
+sequence, to [batch, 3] counters: number of label tokens, correctly predicted tokens and summed token NLL.
+TokenMetrics adds them up over the eval steps. With `batch_eval_metrics` the Trainer calls it after each step and
+keeps no predictions or labels, otherwise it gets the counters of all steps at once, [num_samples, 3] either way.
+"""
+import math
+from typing import Dict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers.trainer_pt_utils import LabelSmoother
+
+
+@torch.no_grad()
+def token_stats(
+        logits: torch.Tensor,
+        labels: torch.Tensor,
+        chunk_size: int = 256,
+        ignore_index: int = LabelSmoother.ignore_index,
+) -> torch.Tensor:
+    """
+    Per sample label tokens, correct argmax predictions and summed NLL of next token prediction.
+    :param logits: [batch, seq, vocab] logits
+    :param labels: [batch, seq] labels, not shifted
+    :param chunk_size: number of positions upcast to float32 at a time
+    :param ignore_index: label of the tokens without loss
+    :return: float32 [batch, 3]
+    """
+    logits = logits[:, :-1]
+    labels = labels[:, 1:].to(logits.device)
+    stats = torch.zeros(logits.size(0), 3, dtype=torch.float32, device=logits.device)
+    for start in range(0, logits.size(1), chunk_size):
+        chunk_logits = logits[:, start: start + chunk_size].float()
+        chunk_labels = labels[:, start: start + chunk_size]
+        mask = chunk_labels != ignore_index
+        nll = F.cross_entropy(chunk_logits.transpose(1, 2), chunk_labels, ignore_index=ignore_index,
+                              reduction="none")
+        stats[:, 0] += mask.sum(dim=1)
+        stats[:, 1] += ((chunk_logits.argmax(dim=-1) == chunk_labels) & mask).sum(dim=1)
+        stats[:, 2] += nll.sum(dim=1)
+    return stats
+
+
+def preprocess_logits_for_metrics(logits, labels):
+    if isinstance(logits, tuple):
+        # Depending on the model and config, logits may contain extra tensors,
+        # like past_key_values, but logits always come first
+        logits = logits[0]
+    return token_stats(logits, labels)
+
+
+class TokenMetrics:
+    """
+    compute_metrics of the Trainer, token accuracy, mean token NLL and perplexity from the counters of
+    preprocess_logits_for_metrics. Counters are accumulated until compute_result, then reset.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_tokens = 0.0
+        self.num_correct = 0.0
+        self.nll = 0.0
+
+    def __call__(self, eval_preds, compute_result: bool = True) -> Dict[str, float]:
+        stats = eval_preds.predictions
+        if isinstance(stats, torch.Tensor):
+            stats = stats.detach().double().sum(dim=0).cpu().numpy()
+        else:
+            stats = np.asarray(stats, dtype=np.float64).reshape(-1, 3).sum(axis=0)
+        self.num_tokens += float(stats[0])
+        self.num_correct += float(stats[1])
+        self.nll += float(stats[2])
+        if not compute_result:
+            return {}
+        num_tokens = max(self.num_tokens, 1.0)
+        token_nll = self.nll / num_tokens
+        try:
+            token_perplexity = math.exp(token_nll)
+        except OverflowError:
+            token_perplexity = float("inf")
+        metrics = {
+            "accuracy": self.num_correct / num_tokens,
+            "token_nll": token_nll,
+            "token_perplexity": token_perplexity,
+            "num_tokens": self.num_tokens,
+        }
+        self.reset()
+        return metrics
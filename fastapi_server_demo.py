@@ -48,7 +48,8 @@ def stream_generate_answer(
         stop_str="</s>",
 ):
     streamer = TextIteratorStreamer(tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
-    input_ids = tokenizer(prompt).input_ids
+    # prompt is a string or token ids already built by the template
+    input_ids = tokenizer(prompt).input_ids if isinstance(prompt, str) else prompt
     max_src_len = context_len - max_new_tokens - 8
     input_ids = input_ids[-max_src_len:]
     generation_kwargs = dict(
@@ -158,11 +159,11 @@ def main():
 
     def predict(sentence):
         history = [[sentence, '']]
-        prompt = prompt_template.get_prompt(messages=history, system_prompt=args.system_prompt)
+        prompt_ids = prompt_template.get_prompt_ids(tokenizer, messages=history, system_prompt=args.system_prompt)
         response = stream_generate_answer(
             model,
             tokenizer,
-            prompt,
+            prompt_ids,
             device,
             do_print=False,
             max_new_tokens=args.max_new_tokens,
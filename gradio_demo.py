@@ -82,9 +82,8 @@ def main():
     def predict(message, history):
         """Generate answer from prompt with GPT and stream the output"""
         history_messages = history + [[message, ""]]
-        prompt = prompt_template.get_prompt(messages=history_messages, system_prompt=system_prompt)
+        input_ids = prompt_template.get_prompt_ids(tokenizer, messages=history_messages, system_prompt=system_prompt)
         streamer = TextIteratorStreamer(tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
-        input_ids = tokenizer(prompt).input_ids
         context_len = 2048
         max_new_tokens = 512
         max_src_len = context_len - max_new_tokens - 8
@@ -3,10 +3,14 @@
 @author:XuMing(xuming624@qq.com)
 @description: Train R1 model with GRPO rl algo.
 """
+import math
+import multiprocessing as mp
 import os
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, wait
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 import re
 from datasets import load_dataset
 import torch
@@ -41,6 +45,25 @@ class ScriptArguments:
     dataset_splits: Optional[str] = field(default="train", metadata={"help": "Split name"})
     preprocessing_num_workers: Optional[int] = field(default=10,
                                                      metadata={"help": "Number of workers for preprocessing"})
+    reward_num_workers: int = field(
+        default=0,
+        metadata={"help": "Number of processes verifying the answers of accuracy_reward, 0 to verify in the trainer"}
+    )
+    reward_timeout: int = field(
+        default=5,
+        metadata={"help": "Seconds each parse and verify of a completion may take, a timed out answer gets reward 0"}
+    )
+
+
+# Precompiled patterns of the reward functions, they run on every completion of every step
+WHITESPACE_PATTERN = re.compile(r'\s+')
+ANSWER_PATTERN = re.compile(r'<answer>(.*?)</answer>', re.DOTALL)
+FORMAT_PATTERN = re.compile(r"<think>.*?</think><answer>.*?</answer>$")
+
+# Process pool of accuracy_reward, set by setup_reward_workers
+_reward_executor: Optional[ProcessPoolExecutor] = None
+_reward_num_workers: int = 0
+_reward_timeout: int = 5
 
 
 def normalize_text(text):
@@ -48,7 +71,7 @@ def normalize_text(text):
     if text is None:
         return ""
     # Remove extra whitespace and convert to lowercase
-    text = re.sub(r'\s+', ' ', text.strip().lower())
+    text = WHITESPACE_PATTERN.sub(' ', text.strip().lower())
     return text
 
 
@@ -56,53 +79,120 @@ def extract_answer(text):
     """Extract content between <answer> tags."""
     if text is None:
         return ""
-    match = re.search(r'<answer>(.*?)</answer>', text, re.DOTALL)
+    match = ANSWER_PATTERN.search(text)
     if match:
         return match.group(1).strip()
     return text.strip()
 
 
+@lru_cache(maxsize=4096)
+def parse_gold_answer(sol: str, timeout: int = 5):
+    """Parse the ground truth once per prompt and process, all completions of a group share it."""
+    if '####' in sol:
+        # for GSM8K
+        return parse(sol.split("####", 1)[-1].strip(), parsing_timeout=timeout)
+    # First try latex parsing
+    return parse(
+        sol,
+        extraction_mode="first_match",
+        extraction_config=[LatexExtractionConfig()],
+        parsing_timeout=timeout,
+    )
+
+
+def verify_answer(content: str, sol: str, timeout: int = 5) -> Tuple[float, str, str]:
+    """
+    Check the answer of one completion against the ground truth, parsing and verification give up after timeout
+    seconds each. Runs in the reward worker processes, returns the reward and the parsed answers as text.
+    """
+    gold_parsed = parse_gold_answer(sol, timeout)
+    if '####' in sol:
+        answer_parsed = parse(extract_answer(content), parsing_timeout=timeout)
+    else:
+        # We require the answer to be provided in correct latex (no malformed operators)
+        answer_parsed = parse(
+            content,
+            extraction_config=[
+                LatexExtractionConfig(
+                    normalization_config=NormalizationConfig(
+                        nits=False,
+                        malformed_operators=False,
+                        basic_latex=True,
+                        equations=True,
+                        boxed="all",
+                        units=True,
+                    ),
+                    # Ensures that boxed is tried first
+                    boxed_match_priority=0,
+                    try_extract_without_anchor=False,
+                )
+            ],
+            extraction_mode="first_match",
+            parsing_timeout=timeout,
+        )
+    try:
+        reward = float(verify(answer_parsed, gold_parsed, timeout_seconds=timeout))
+    except Exception as e:
+        logger.warning(f"Error in verification: {e}")
+        reward = 0.0
+    return reward, str(answer_parsed), str(gold_parsed)
+
+
+def setup_reward_workers(num_workers: int, timeout: int = 5):
+    """
+    Verify the completions of accuracy_reward in a pool of num_workers processes, 0 verifies in this process.
+    :param num_workers: number of worker processes
+    :param timeout: seconds each parse and verify call of a completion may take before its reward is 0
+    """
+    global _reward_executor, _reward_num_workers, _reward_timeout
+    shutdown_reward_workers()
+    _reward_num_workers = num_workers
+    _reward_timeout = timeout
+    if num_workers > 0:
+        # spawn, the workers only run sympy and must not inherit the CUDA state of the trainer
+        _reward_executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context("spawn"))
+
+
+def shutdown_reward_workers():
+    """Stop the reward worker processes, including those stuck in a verification."""
+    global _reward_executor
+    if _reward_executor is None:
+        return
+    processes = list((_reward_executor._processes or {}).values())
+    _reward_executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    _reward_executor = None
+
+
 def accuracy_reward(completions, answer, **kwargs):
     """Reward function that checks if the completion is the same as the ground truth."""
     contents = [completion[0]["content"] for completion in completions]
+    if _reward_executor is None:
+        results = [verify_answer(content, sol, _reward_timeout) for content, sol in zip(contents, answer)]
+    else:
+        futures = [_reward_executor.submit(verify_answer, content, sol, _reward_timeout)
+                   for content, sol in zip(contents, answer)]
+        # Parse of the gold answer, parse of the completion and verify each stop after the timeout, the deadline
+        # only catches a worker hung outside of them
+        rounds = math.ceil(len(futures) / _reward_num_workers)
+        done, not_done = wait(futures, timeout=3 * _reward_timeout * rounds + 10)
+        broken = any(isinstance(f.exception(), BrokenExecutor) for f in done)
+        if not_done or broken:
+            logger.warning(f"{len(not_done)} of {len(futures)} verifications timed out, broken pool: {broken}, "
+                           f"restart the reward workers")
+            setup_reward_workers(_reward_num_workers, _reward_timeout)
+        results = []
+        for future in futures:
+            if future in done and future.exception() is None:
+                results.append(future.result())
+            else:
+                if future in done:
+                    logger.warning(f"Error in verification: {future.exception()}")
+                results.append((0.0, "", ""))
     rewards = []
-    for content, sol in zip(contents, answer):
-        if '####' in sol:
-            # for GSM8K
-            gold_parsed = parse(sol.split("####", 1)[-1].strip())
-            answer_parsed = parse(extract_answer(content))
-        else:
-            # First try latex parsing
-            gold_parsed = parse(
-                sol,
-                extraction_mode="first_match",
-                extraction_config=[LatexExtractionConfig()],
-            )
-            # We require the answer to be provided in correct latex (no malformed operators)
-            answer_parsed = parse(
-                content,
-                extraction_config=[
-                    LatexExtractionConfig(
-                        normalization_config=NormalizationConfig(
-                            nits=False,
-                            malformed_operators=False,
-                            basic_latex=True,
-                            equations=True,
-                            boxed="all",
-                            units=True,
-                        ),
-                        # Ensures that boxed is tried first
-                        boxed_match_priority=0,
-                        try_extract_without_anchor=False,
-                    )
-                ],
-                extraction_mode="first_match",
-            )
-        try:
-            reward = float(verify(answer_parsed, gold_parsed))
-        except Exception as e:
-            logger.warning(f"Error in verification: {e}")
-            reward = 0.0
+    for content, sol, (reward, answer_parsed, gold_parsed) in zip(contents, answer, results):
         logger.debug(f"predict_answer: {content}, \nground_truth: {sol}, \n"
                      f"answer_parsed: {answer_parsed}, gold_parsed: {gold_parsed}, reward: {reward}\n\n")
         rewards.append(reward)
@@ -112,9 +202,8 @@ def accuracy_reward(completions, answer, **kwargs):
 
 def format_reward(completions, **kwargs):
     """Reward function that checks if the completion has a specific format."""
-    pattern = r"<think>.*?</think><answer>.*?</answer>$"
     completion_contents = [completion[0]["content"] for completion in completions]
-    matches = [re.match(pattern, content) for content in completion_contents]
+    matches = [FORMAT_PATTERN.match(content) for content in completion_contents]
 
     rewards = [1.0 if match else 0.0 for match in matches]
     logger.debug(f'format rewards: {rewards}')
@@ -267,6 +356,8 @@ def grpo_train(
         model.config.use_cache = True
         logger.info("Gradient checkpointing disabled.")
 
+    setup_reward_workers(script_args.reward_num_workers, script_args.reward_timeout)
+
     # Initialize GRPO trainer with distributed training support
     trainer = GRPOTrainer(
         model=model,
@@ -294,7 +385,10 @@ def grpo_train(
             f'{training_args.num_train_epochs} epochs ***'
         )
 
-    train_result = trainer.train(resume_from_checkpoint=last_checkpoint)
+    try:
+        train_result = trainer.train(resume_from_checkpoint=last_checkpoint)
+    finally:
+        shutdown_reward_workers()
 
     # Log and save metrics on main process
     if is_main_process:
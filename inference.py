@@ -37,7 +37,8 @@ def stream_generate_answer(
 ):
     """Generate answer from prompt with GPT and stream the output"""
     streamer = TextIteratorStreamer(tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
-    input_ids = tokenizer(prompt).input_ids
+    # prompt is a string or token ids already built by the template
+    input_ids = tokenizer(prompt).input_ids if isinstance(prompt, str) else prompt
     max_src_len = context_len - max_new_tokens - 8
     input_ids = input_ids[-max_src_len:]
     generation_kwargs = dict(
@@ -89,8 +90,9 @@ def batch_generate_answer(
         do_sample=True if temperature > 0.0 else False,
         repetition_penalty=repetition_penalty,
     )
-    prompts = [prompt_template.get_prompt(messages=[[s, '']], system_prompt=system_prompt) for s in sentences]
-    inputs_tokens = tokenizer(prompts, return_tensors="pt", padding=True)
+    prompt_ids = [prompt_template.get_prompt_ids(tokenizer, messages=[[s, '']], system_prompt=system_prompt)
+                  for s in sentences]
+    inputs_tokens = tokenizer.pad({'input_ids': prompt_ids}, return_tensors="pt", padding=True)
     input_ids = inputs_tokens['input_ids'].to(device)
     outputs = model.generate(input_ids=input_ids, **generation_kwargs)
     for gen_sequence in outputs:
@@ -209,11 +211,12 @@ def main():
                 history = []
 
             history.append([query, ''])
-            prompt = prompt_template.get_prompt(messages=history, system_prompt=system_prompt)
+            # Only the new turn is tokenized, previous turns come from the template token cache
+            prompt_ids = prompt_template.get_prompt_ids(tokenizer, messages=history, system_prompt=system_prompt)
             response = stream_generate_answer(
                 model,
                 tokenizer,
-                prompt,
+                prompt_ids,
                 model.device,
                 do_print=True,
                 max_new_tokens=args.max_new_tokens,
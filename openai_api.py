@@ -4,6 +4,7 @@
 #   python openai_api.py
 # Visit http://localhost:8000/docs for documents.
 
+import asyncio
 import base64
 import copy
 import json
@@ -20,12 +21,22 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from loguru import logger
 from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import Response
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding
 from transformers import GenerationConfig, TextIteratorStreamer
 
+from continuous_batching import (
+    ContinuousBatchingScheduler,
+    GenerationRequest,
+    IncrementalDecoder,
+    from_legacy_cache,
+    get_stop_token_ids,
+    to_legacy_cache,
+)
+from prefix_cache import PrefixKVCache
 from template import get_conv_template
 
 
@@ -159,6 +170,16 @@ async def list_models():
     return ModelList(data=[model_card])
 
 
+@app.get('/v1/stats')
+async def get_stats():
+    """Serving stats, e.g. tokens generated by the continuous batching scheduler."""
+    global scheduler, prefix_cache
+    return {
+        'scheduler': scheduler.stats() if scheduler is not None else None,
+        'prefix_cache': prefix_cache.stats() if prefix_cache is not None else None,
+    }
+
+
 # To work around that unpleasant leading-\n tokenization issue!
 def add_extra_stop_words(stop_words):
     _stop_words = []
@@ -371,7 +392,9 @@ def prepare_chat(tokenizer, query, history, system):
     """Prepare model inputs for chat completion."""
     if prompt_template:
         history_messages = history + [[query, ""]]
-        prompt = prompt_template.get_prompt(messages=history_messages, system_prompt=system)
+        # Turns already seen in previous requests of the conversation are not tokenized again
+        input_ids = prompt_template.get_prompt_ids(tokenizer, messages=history_messages, system_prompt=system)
+        return BatchEncoding({'input_ids': [input_ids], 'attention_mask': [[1] * len(input_ids)]}, tensor_type='pt')
     else:
         messages = [
             {"role": "system", "content": system}
@@ -387,14 +410,28 @@ def prepare_chat(tokenizer, query, history, system):
             tokenize=False,
             add_generation_prompt=True
         )
-    model_inputs = tokenizer([prompt], return_tensors='pt')
-    return model_inputs
+        model_inputs = tokenizer([prompt], return_tensors='pt')
+        return model_inputs
+
+
+def generate_with_prefix_cache(model, input_ids, **gen_kwargs):
+    """Call model.generate, reusing the kv cache of the longest cached prompt prefix if the prefix cache is on."""
+    global prefix_cache
+    if prefix_cache is None:
+        return model.generate(input_ids, **gen_kwargs)
+    _, past_key_values = prefix_cache.lookup(input_ids[0].tolist())
+    if past_key_values is not None:
+        gen_kwargs['past_key_values'] = from_legacy_cache(past_key_values)
+    outputs = model.generate(input_ids, return_dict_in_generate=True, **gen_kwargs)
+    # Cache prompt and response, the next turn of the conversation resends both as history
+    prefix_cache.insert(outputs.sequences[0].tolist(), to_legacy_cache(outputs.past_key_values))
+    return outputs.sequences
 
 
 def model_chat(model, tokenizer, query, history, gen_kwargs, system):
     """Generate chat completion from the model."""
     model_inputs = prepare_chat(tokenizer, query, history, system).to(model.device)
-    generated_ids = model.generate(model_inputs.input_ids, **gen_kwargs)
+    generated_ids = generate_with_prefix_cache(model, model_inputs.input_ids, **gen_kwargs)
     generated_ids = [
         output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
     ]
@@ -407,20 +444,80 @@ def model_chat(model, tokenizer, query, history, gen_kwargs, system):
 def stream_model_chat(model, tokenizer, query, history, gen_kwargs, system):
     """Generate chat completion from the model in stream mode."""
     model_inputs = prepare_chat(tokenizer, query, history, system).to(model.device)
-    gen_kwargs['inputs'] = model_inputs.input_ids
 
     streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
     gen_kwargs['streamer'] = streamer
-    thread = Thread(target=model.generate, kwargs=gen_kwargs, daemon=True)
+    thread = Thread(
+        target=generate_with_prefix_cache,
+        args=(model, model_inputs.input_ids),
+        kwargs=gen_kwargs,
+        daemon=True
+    )
     thread.start()
 
     yield from streamer
 
 
+def build_generation_request(model, tokenizer, input_ids, gen_kwargs, loop=None):
+    """Build a scheduler request, sampling params not set by the client come from the generation config."""
+    generation_config = model.generation_config
+    if gen_kwargs.get('max_length'):
+        max_new_tokens = gen_kwargs['max_length'] - len(input_ids)
+    elif generation_config.max_new_tokens:
+        max_new_tokens = generation_config.max_new_tokens
+    else:
+        max_new_tokens = generation_config.max_length - len(input_ids)
+    return GenerationRequest(
+        input_ids,
+        max_new_tokens=max(max_new_tokens, 1),
+        do_sample=generation_config.do_sample,
+        temperature=gen_kwargs.get('temperature', generation_config.temperature or 1.0),
+        top_p=gen_kwargs.get('top_p', generation_config.top_p or 1.0),
+        top_k=gen_kwargs.get('top_k', generation_config.top_k or 0),
+        stop_token_ids=get_stop_token_ids(model, tokenizer),
+        loop=loop,
+    )
+
+
+async def batch_model_chat(model, tokenizer, query, history, gen_kwargs, system):
+    """Generate chat completion with the continuous batching scheduler."""
+    global scheduler
+    input_ids = prepare_chat(tokenizer, query, history, system).input_ids[0].tolist()
+    request = build_generation_request(model, tokenizer, input_ids, gen_kwargs, loop=asyncio.get_running_loop())
+    scheduler.submit(request)
+    try:
+        async for _ in request:
+            pass
+    finally:
+        request.cancel()
+    response = tokenizer.decode(request.output_ids, skip_special_tokens=True)
+    return response, len(input_ids), len(request.output_ids)
+
+
+async def batch_stream_model_chat(model, tokenizer, query, history, gen_kwargs, system):
+    """Generate chat completion with the continuous batching scheduler in stream mode."""
+    global scheduler
+    input_ids = prepare_chat(tokenizer, query, history, system).input_ids[0].tolist()
+    request = build_generation_request(model, tokenizer, input_ids, gen_kwargs, loop=asyncio.get_running_loop())
+    scheduler.submit(request)
+    decoder = IncrementalDecoder(tokenizer)
+    try:
+        async for token_id in request:
+            new_text = decoder.push(token_id)
+            if new_text:
+                yield new_text
+        new_text = decoder.flush()
+        if new_text:
+            yield new_text
+    finally:
+        # The client may stop reading early (stop word or disconnect), free its slot in the batch
+        request.cancel()
+
+
 @app.post('/v1/chat/completions', response_model=ChatCompletionResponse)
 async def create_chat_completion(request: ChatCompletionRequest):
     """Generate chat completion."""
-    global model, tokenizer
+    global model, tokenizer, scheduler
 
     gen_kwargs = {}
     if request.top_k is not None:
@@ -460,14 +557,24 @@ async def create_chat_completion(request: ChatCompletionRequest):
         )
         return StreamingResponse(generate, media_type='text/event-stream')
 
-    response, prompt_length, response_length = model_chat(
-        model,
-        tokenizer,
-        query,
-        history,
-        gen_kwargs=gen_kwargs,
-        system=system
-    )
+    if scheduler is not None:
+        response, prompt_length, response_length = await batch_model_chat(
+            model,
+            tokenizer,
+            query,
+            history,
+            gen_kwargs=gen_kwargs,
+            system=system
+        )
+    else:
+        response, prompt_length, response_length = model_chat(
+            model,
+            tokenizer,
+            query,
+            history,
+            gen_kwargs=gen_kwargs,
+            system=system
+        )
     logger.debug(f'*** history begin ***\n{history}\n*** history end ***\n'
                  f'question: {query}\nresponse: {response}\n')
     _gc()
@@ -513,31 +620,44 @@ async def stream_chat_completion(
         system: str,
 ):
     """Generate chat completion in stream mode."""
-    global model, tokenizer
+    global model, tokenizer, scheduler
     choice_data = ChatCompletionResponseStreamChoice(
         index=0, delta=DeltaMessage(role='assistant', content=""), finish_reason=None)
     chunk = ChatCompletionStreamResponse(model=model_id, choices=[choice_data])
     yield jsonify(chunk)
 
     stop_words = [x for x in stop_words if x]
-    response_generator = stream_model_chat(
-        model,
-        tokenizer,
-        query,
-        history,
-        gen_kwargs,
-        system
-    )
-    for token_output in response_generator:
-        # Check if any stop word is in the token output
-        if any(stop_word in token_output for stop_word in stop_words):
-            break
-
-        # Send the current token as part of the response
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0, delta=DeltaMessage(content=token_output), finish_reason=None)
-        chunk = ChatCompletionStreamResponse(model=model_id, choices=[choice_data])
-        yield jsonify(chunk)
+    if scheduler is not None:
+        response_generator = batch_stream_model_chat(
+            model,
+            tokenizer,
+            query,
+            history,
+            gen_kwargs,
+            system
+        )
+    else:
+        response_generator = iterate_in_threadpool(stream_model_chat(
+            model,
+            tokenizer,
+            query,
+            history,
+            gen_kwargs,
+            system
+        ))
+    try:
+        async for token_output in response_generator:
+            # Check if any stop word is in the token output
+            if any(stop_word in token_output for stop_word in stop_words):
+                break
+
+            # Send the current token as part of the response
+            choice_data = ChatCompletionResponseStreamChoice(
+                index=0, delta=DeltaMessage(content=token_output), finish_reason=None)
+            chunk = ChatCompletionStreamResponse(model=model_id, choices=[choice_data])
+            yield jsonify(chunk)
+    finally:
+        await response_generator.aclose()
 
     choice_data = ChatCompletionResponseStreamChoice(
         index=0, delta=DeltaMessage(), finish_reason='stop'
@@ -563,6 +683,12 @@ if __name__ == '__main__':
                               'If you want other computers to access your server, use 0.0.0.0 instead.')
                         )
     parser.add_argument('--disable_gc', action='store_true', help='Disable GC after each response generated.')
+    parser.add_argument('--continuous_batching', action='store_true',
+                        help='Merge concurrent requests into a shared decoding batch instead of one generate each.')
+    parser.add_argument('--max_batch_size', type=int, default=16,
+                        help='Max number of requests decoded together with --continuous_batching.')
+    parser.add_argument('--prefix_cache_mb', type=float, default=0,
+                        help='Memory budget in MB of the prefix kv cache reused across multi-turn requests, 0 to disable.')
 
     args = parser.parse_args()
     logger.info(args)
@@ -606,5 +732,16 @@ if __name__ == '__main__':
         prompt_template = get_conv_template(args.template_name)
     else:
         prompt_template = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixKVCache(max_memory_mb=args.prefix_cache_mb)
+        logger.info(f'Prefix kv cache enabled, memory budget: {args.prefix_cache_mb}MB')
+    else:
+        prefix_cache = None
+    if args.continuous_batching:
+        scheduler = ContinuousBatchingScheduler(
+            model, max_batch_size=args.max_batch_size, prefix_cache=prefix_cache)
+        logger.info(f'Continuous batching enabled, max_batch_size: {args.max_batch_size}')
+    else:
+        scheduler = None
 
     uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
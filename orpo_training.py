@@ -196,6 +196,22 @@ def find_all_linear_names(peft_model, int4=False, int8=False):
     return sorted(lora_module_names)
 
 
+def pair_token_lengths(examples, tokenizer) -> Dict[str, list]:
+    """Token lengths of prompt, chosen and rejected, one batched call of the fast tokenizer per column."""
+    return {
+        f"{column}_length": [len(ids) for ids in tokenizer(examples[column], add_special_tokens=False)["input_ids"]]
+        for column in ("prompt", "chosen", "rejected")
+    }
+
+
+def filter_pair_lengths(prompt_length, chosen_length, rejected_length, max_source_length, max_target_length):
+    """Batched filter, keep pairs whose prompt and responses plus eos fit max_source_length and max_target_length."""
+    return [
+        0 < p <= max_source_length and c < max_target_length and r < max_target_length
+        for p, c, r in zip(prompt_length, chosen_length, rejected_length)
+    ]
+
+
 def main():
     parser = HfArgumentParser(ScriptArguments)
     args = parser.parse_args_into_dataclasses()[0]
@@ -297,7 +313,7 @@ def main():
     max_target_length = args.max_target_length
     full_max_length = max_source_length + max_target_length
 
-    def return_prompt_and_responses(examples) -> Dict[str, str]:
+    def return_prompt_and_responses(examples) -> Dict[str, list]:
         """Load the paired dataset and convert it to the necessary format.
 
         The dataset is converted to a dictionary with the following structure:
@@ -306,6 +322,7 @@ def main():
             'chosen': List[str],
             'rejected': List[str],
         }
+        plus the token length of each column, see pair_token_lengths.
 
         Prompts are structured as follows:
           system_prompt + history[[q,a], [q,a]...] + question
@@ -315,11 +332,23 @@ def main():
             system_prompt = system or ""
             history_with_question = history + [[question, '']] if history else [[question, '']]
             prompts.append(prompt_template.get_prompt(messages=history_with_question, system_prompt=system_prompt))
-        return {
+        outputs = {
             "prompt": prompts,
             "chosen": examples["response_chosen"],
             "rejected": examples["response_rejected"],
         }
+        outputs.update(pair_token_lengths(outputs, tokenizer))
+        return outputs
+
+    length_columns = ["prompt_length", "chosen_length", "rejected_length"]
+    length_filter_kwargs = {
+        "batched": True,
+        "input_columns": length_columns,
+        "fn_kwargs": {"max_source_length": max_source_length, "max_target_length": max_target_length},
+        "num_proc": args.preprocessing_num_workers,
+        "load_from_cache_file": not args.overwrite_cache,
+        "desc": "Filtering pairs by token length",
+    }
 
     # Preprocess the dataset
     train_dataset = None
@@ -344,10 +373,8 @@ def main():
             load_from_cache_file=not args.overwrite_cache,
             desc="Running tokenizer on dataset" if is_main_process else None,
         )
-        train_dataset = tokenized_dataset.filter(
-            lambda x: 0 < len(x['prompt'] + x['chosen']) <= full_max_length
-                      and 0 < len(x['prompt'] + x['rejected']) <= full_max_length
-        )
+        train_dataset = tokenized_dataset.filter(filter_pair_lengths, **length_filter_kwargs)
+        train_dataset = train_dataset.remove_columns(length_columns)
         
         if is_main_process:
             logger.debug(f"Num train_samples: {len(train_dataset)}")
@@ -376,10 +403,8 @@ def main():
             load_from_cache_file=not args.overwrite_cache,
             desc="Running tokenizer on dataset",
         )
-        eval_dataset = eval_dataset.filter(
-            lambda x: 0 < len(x['prompt'] + x['chosen']) <= full_max_length
-                      and 0 < len(x['prompt'] + x['rejected']) <= full_max_length
-        )
+        eval_dataset = eval_dataset.filter(filter_pair_lengths, **length_filter_kwargs)
+        eval_dataset = eval_dataset.remove_columns(length_columns)
         logger.debug(f"Num eval_samples: {len(eval_dataset)}")
         logger.debug("First eval example:")
         first_example = eval_dataset[0]
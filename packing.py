@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Collator of packed sequences, shared by PT with --document_boundaries and SFT with --packing.
+
+A packed sequence holds several documents or conversations, its position_ids restart at 0 at each of them.
+The collator pads the batch without attention_mask and passes the cumulative sequence lengths of the flattened
+batch, cu_seq_lens_q/k and max_length_q/k, to the attention layers. FlashAttention-2 then runs varlen attention
+over the documents of all rows, also with more than one sequence per batch, instead of detecting the packing
+from position_ids, which recent transformers versions only do for a batch of one sequence.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from transformers.trainer_pt_utils import LabelSmoother
+
+
+@dataclass
+class PackedDataCollator:
+    """
+    Pad packed sequences with position_ids and flash attention varlen kwargs, see the module docstring.
+    Padding gets its own position ids, a sequence of its own that is never attended by real tokens.
+    Features without position_ids, e.g. the unpacked eval dataset, are collated by unpacked_collator.
+    """
+    pad_token_id: int = 0
+    label_pad_token_id: int = LabelSmoother.ignore_index
+    unpacked_collator: Optional[Callable[[List[Dict[str, Any]]], Dict[str, Any]]] = None
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if "position_ids" not in features[0]:
+            if self.unpacked_collator is None:
+                raise ValueError("PackedDataCollator got features without position_ids and has no unpacked_collator")
+            return self.unpacked_collator(features)
+        max_len = max(len(f["input_ids"]) for f in features)
+        input_ids = torch.full((len(features), max_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), max_len), self.label_pad_token_id, dtype=torch.long)
+        position_ids = torch.arange(max_len, dtype=torch.long).repeat(len(features), 1)
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[i, :n] = torch.as_tensor(np.asarray(f["input_ids"]), dtype=torch.long)
+            labels[i, :n] = torch.as_tensor(np.asarray(f["labels"]), dtype=torch.long)
+            position_ids[i, :n] = torch.as_tensor(np.asarray(f["position_ids"]), dtype=torch.long)
+            position_ids[i, n:] -= n
+        flat = position_ids.view(-1)
+        starts = torch.nonzero(flat == 0).view(-1)
+        cu_seq_lens = torch.cat([starts, torch.tensor([flat.numel()])]).to(torch.int32)
+        max_length = int((cu_seq_lens[1:] - cu_seq_lens[:-1]).max())
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "cu_seq_lens_q": cu_seq_lens,
+            "cu_seq_lens_k": cu_seq_lens,
+            "max_length_q": max_length,
+            "max_length_k": max_length,
+        }
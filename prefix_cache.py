@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Prefix kv cache, reuse past_key_values of shared prompt prefixes across requests.
+
+Multi-turn chat resends the system prompt and all previous turns on every request. The cache keeps the kv of
+recent prompts in a radix tree over token ids, a new prompt only runs the tokens after its longest cached prefix
+through the model. Attention is causal, so the kv of a longer sequence is also the kv of each of its prefixes:
+it is cropped to the matched length on lookup, and storing a sequence drops the kv stored for its ancestors.
+Entries are evicted least recently used first once the memory budget is exceeded.
+
+usage:
+    # time to first token of a growing multi-turn conversation on CPU, tiny random-weight model
+    python prefix_cache.py --num_turns 8 --turn_len 256
+"""
+import argparse
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+class _Node:
+    __slots__ = ("tokens", "parent", "children", "kv", "nbytes", "last_access")
+
+    def __init__(self, tokens: Tuple[int, ...] = (), parent: Optional["_Node"] = None):
+        # token ids on the edge from the parent to this node
+        self.tokens = tokens
+        self.parent = parent
+        self.children = {}
+        # legacy kv cache of all tokens from the root to this node, batch size 1
+        self.kv = None
+        self.nbytes = 0
+        self.last_access = 0
+
+
+def _common_prefix_len(a, b) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _kv_nbytes(past_key_values) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+
+
+def _crop_kv(past_key_values, length: int):
+    """Keep the kv of the first `length` tokens, tensors are [batch, heads, seq_len, head_dim]."""
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+class PrefixKVCache:
+    """Radix tree over prompt token ids storing the kv cache of recent prompts, LRU evicted by memory budget."""
+
+    def __init__(self, max_memory_mb: float = 1024, min_prefix_len: int = 16):
+        """
+        Init prefix kv cache.
+        :param max_memory_mb: memory budget of all stored kv tensors, in MB
+        :param min_prefix_len: shorter matched prefixes are not worth a lookup and count as misses
+        """
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.min_prefix_len = min_prefix_len
+        self._root = _Node()
+        self._entries = set()
+        self._lock = threading.Lock()
+        self._clock = 0
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.query_tokens = 0
+
+    def _touch(self, node: _Node):
+        self._clock += 1
+        node.last_access = self._clock
+
+    def lookup(self, input_ids: List[int]):
+        """
+        Find the longest cached prefix of input_ids, at least one token is always left to run through the model.
+        :param input_ids: prompt token ids
+        :return: (number of cached tokens, legacy kv cache of those tokens), (0, None) on a miss
+        """
+        input_ids = list(input_ids)
+        with self._lock:
+            self.query_tokens += len(input_ids)
+            node = self._root
+            matched = 0
+            while matched < len(input_ids):
+                child = node.children.get(input_ids[matched])
+                if child is None:
+                    break
+                n = _common_prefix_len(child.tokens, input_ids[matched:])
+                matched += n
+                node = child
+                if n < len(child.tokens):
+                    break
+            matched = min(matched, len(input_ids) - 1)
+            if node is self._root or matched < max(self.min_prefix_len, 1):
+                self.misses += 1
+                return 0, None
+            # Every leaf holds a kv, any kv below the match point covers the matched prefix
+            while node.kv is None:
+                node = next(iter(node.children.values()))
+            self._touch(node)
+            self.hits += 1
+            self.hit_tokens += matched
+            return matched, _crop_kv(node.kv, matched)
+
+    def insert(self, input_ids: List[int], past_key_values):
+        """
+        Store the kv cache of input_ids.
+        :param input_ids: token ids the kv cache was computed for
+        :param past_key_values: legacy kv cache, tuple of (key, value) per layer, batch size 1
+        """
+        input_ids = tuple(input_ids)
+        if not input_ids or not past_key_values:
+            return
+        seq_len = past_key_values[0][0].shape[2]
+        if seq_len < len(input_ids):
+            input_ids = input_ids[:seq_len]
+        elif seq_len > len(input_ids):
+            past_key_values = _crop_kv(past_key_values, len(input_ids))
+        nbytes = _kv_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            node = self._root
+            i = 0
+            while i < len(input_ids):
+                child = node.children.get(input_ids[i])
+                if child is None:
+                    child = _Node(input_ids[i:], parent=node)
+                    node.children[input_ids[i]] = child
+                    node = child
+                    break
+                n = _common_prefix_len(child.tokens, input_ids[i:])
+                if n < len(child.tokens):
+                    # Split the edge at the first differing token
+                    mid = _Node(child.tokens[:n], parent=node)
+                    node.children[input_ids[i]] = mid
+                    child.tokens = child.tokens[n:]
+                    child.parent = mid
+                    mid.children[child.tokens[0]] = child
+                    child = mid
+                i += n
+                node = child
+            if node.kv is not None or node.children:
+                # Already covered by this entry or a longer one below it
+                target = node
+                while target.kv is None:
+                    target = next(iter(target.children.values()))
+                self._touch(target)
+                return
+            node.kv = past_key_values
+            node.nbytes = nbytes
+            self._touch(node)
+            self._entries.add(node)
+            self.num_bytes += nbytes
+            ancestor = node.parent
+            while ancestor is not None:
+                if ancestor.kv is not None:
+                    self._drop(ancestor)
+                ancestor = ancestor.parent
+            while self.num_bytes > self.max_bytes:
+                self._remove(min(self._entries, key=lambda x: x.last_access))
+
+    def _drop(self, node: _Node):
+        self._entries.discard(node)
+        self.num_bytes -= node.nbytes
+        node.kv = None
+        node.nbytes = 0
+
+    def _remove(self, node: _Node):
+        """Drop the kv of a node and prune the branch that no longer leads to any kv."""
+        self._drop(node)
+        while node is not self._root and node.kv is None and not node.children:
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            node = parent
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node()
+            self._entries = set()
+            self.num_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "hit_tokens": self.hit_tokens,
+            "token_hit_rate": self.hit_tokens / max(self.query_tokens, 1),
+            "num_entries": len(self._entries),
+            "memory_mb": self.num_bytes / 1024 / 1024,
+        }
+
+
+def benchmark(num_turns: int, turn_len: int):
+    """Time to first token of every turn of a multi-turn chat, with and without the prefix cache."""
+    import torch
+    from loguru import logger
+    from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=num_turns * turn_len + 8,
+    )
+    model = LlamaForCausalLM(config).eval()
+    turns = [torch.randint(3, config.vocab_size, (turn_len,)).tolist() for _ in range(num_turns)]
+    cache = PrefixKVCache(max_memory_mb=1024)
+    history = []
+    with torch.inference_mode():
+        for i, turn in enumerate(turns):
+            history = history + turn
+            t0 = time.time()
+            model(input_ids=torch.tensor([history]), use_cache=True)
+            full_time = time.time() - t0
+
+            t0 = time.time()
+            cached_len, past_key_values = cache.lookup(history)
+            outputs = model(
+                input_ids=torch.tensor([history[cached_len:]]),
+                past_key_values=DynamicCache.from_legacy_cache(past_key_values) if past_key_values else None,
+                use_cache=True,
+            )
+            cache.insert(history, outputs.past_key_values.to_legacy_cache())
+            cached_time = time.time() - t0
+            logger.info(f"turn {i + 1}, prompt tokens: {len(history)}, reused: {cached_len}, "
+                        f"ttft without cache: {full_time * 1000:.1f}ms, with cache: {cached_time * 1000:.1f}ms")
+    logger.info(f"Prefix cache stats: {cache.stats()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_turns', type=int, default=8)
+    parser.add_argument('--turn_len', type=int, default=256, help='Tokens added to the conversation per turn')
+    args = parser.parse_args()
+    benchmark(args.num_turns, args.turn_len)
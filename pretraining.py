@@ -21,15 +21,14 @@ import math
 import os
 from dataclasses import dataclass, field
 from glob import glob
-from itertools import chain
-from typing import Optional, List, Dict, Any, Mapping
+from typing import Optional, List, Dict, Any, Mapping, Tuple
 
 import numpy as np
+import pyarrow as pa
 import torch
 from datasets import load_dataset
 from loguru import logger
 from peft import LoraConfig, TaskType, get_peft_model, PeftModel, prepare_model_for_kbit_training
-from sklearn.metrics import accuracy_score
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
@@ -44,6 +43,21 @@ from transformers import (
 from transformers.trainer import TRAINING_ARGS_NAME
 from transformers.utils.versions import require_version
 from transformers.integrations import is_deepspeed_zero3_enabled
+from transformers.trainer_pt_utils import LabelSmoother
+
+is_flash_attn_2_available = False
+try:
+    from flash_attn import flash_attn_func, flash_attn_varlen_func
+
+    is_flash_attn_2_available = True
+except ImportError:
+    is_flash_attn_2_available = False
+
+from batch_samplers import get_lengths
+from data_shards import load_compiled_datasets
+from eval_metrics import TokenMetrics, preprocess_logits_for_metrics
+from packing import PackedDataCollator
+from streaming_data import StreamingPackedDataset, list_data_files, packed_labels, packed_position_ids
 
 
 @dataclass
@@ -101,6 +115,10 @@ class ModelArguments:
         default=True,
         metadata={"help": "Whether to trust remote code when loading a model from a remote checkpoint."},
     )
+    flash_attn: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Enable FlashAttention-2 for faster training."}
+    )
 
     def __post_init__(self):
         if self.model_name_or_path is None:
@@ -142,7 +160,28 @@ class DataArguments:
             )
         },
     )
-    streaming: bool = field(default=False, metadata={"help": "Enable streaming mode"})
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Enable streaming mode. Files of train_file_dir are read lazily, tokenized in the dataloader workers "
+                "and packed in blocks of block_size, requires max_steps."
+            )
+        },
+    )
+    document_boundaries: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Restart position_ids at each document of a packed block and ignore the label of its first token, "
+                "requires --flash_attn to keep attention within each document. Used with --group_by_length or "
+                "--streaming, which pack documents in blocks."
+            )
+        },
+    )
+    streaming_batch_size: int = field(
+        default=1000, metadata={"help": "Number of documents per tokenizer call in streaming mode."}
+    )
     block_size: Optional[int] = field(
         default=1024,
         metadata={
@@ -169,6 +208,10 @@ class DataArguments:
     keep_linebreaks: bool = field(
         default=True, metadata={"help": "Whether to keep line breaks when using TXT files or not."}
     )
+    compiled_data_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Pre-tokenized data compiled by `python data_shards.py --stage pt`, skips tokenization."},
+    )
 
     def __post_init__(self):
         if self.streaming:
@@ -187,70 +230,198 @@ class ScriptArguments:
     qlora: bool = field(default=False, metadata={"help": "Whether to use qlora"})
 
 
-def accuracy(predictions, references, normalize=True, sample_weight=None):
-    return {
-        "accuracy": float(accuracy_score(references, predictions, normalize=normalize, sample_weight=sample_weight))
-    }
+@dataclass
+class FaultTolerantDataCollator:
+    """
+    Collate features of numpy arrays, lists or tensors into batch tensors allocated once per key, each example is
+    copied straight into its row. Examples of different lengths are padded, input_ids with pad_token_id, labels with
+    label_pad_token_id and other keys with 0, instead of being replaced by copies of the first example.
+    Counts the batches of each path, stacked or padded, and logs them every log_steps batches of a process.
+    """
+    pad_token_id: int = 0
+    label_pad_token_id: int = LabelSmoother.ignore_index
+    log_steps: int = 1000
+    path_counts: Dict[str, int] = field(default_factory=lambda: {"stacked": 0, "padded": 0}, init=False)
+
+    def _pad_value(self, k: str) -> int:
+        if k == "input_ids":
+            return self.pad_token_id
+        if k == "labels":
+            return self.label_pad_token_id
+        return 0
+
+    @staticmethod
+    def _dtype(array: np.ndarray) -> torch.dtype:
+        if array.dtype == np.bool_:
+            return torch.bool
+        if np.issubdtype(array.dtype, np.integer):
+            return torch.long
+        return torch.float
+
+    def _collate(self, k: str, values: List[Any]) -> Tuple[torch.Tensor, bool]:
+        """Batch tensor of one key and whether it was padded."""
+        arrays = [v.numpy() if isinstance(v, torch.Tensor) else np.asarray(v) for v in values]
+        shapes = {a.shape for a in arrays}
+        if len(shapes) == 1:
+            batch = torch.empty((len(arrays),) + arrays[0].shape, dtype=self._dtype(arrays[0]))
+            out = batch.numpy()
+            for i, a in enumerate(arrays):
+                out[i] = a
+            return batch, False
+        if any(a.ndim != 1 for a in arrays):
+            raise ValueError(f"Can not collate `{k}` of shapes {sorted(shapes)}, only 1-D sequences are padded")
+        max_len = max(len(a) for a in arrays)
+        batch = torch.full((len(arrays), max_len), self._pad_value(k), dtype=self._dtype(arrays[0]))
+        out = batch.numpy()
+        for i, a in enumerate(arrays):
+            out[i, :len(a)] = a
+        return batch, True
+
+    def __call__(self, features: List) -> Dict[str, Any]:
+        if not isinstance(features[0], Mapping):
+            features = [vars(f) for f in features]
+        first = features[0]
+        batch = {}
+        padded = False
+
+        # Special handling for labels.
+        label_key = next((k for k in ("label", "label_ids") if k in first and first[k] is not None), None)
+        if label_key is not None:
+            batch["labels"], padded = self._collate("labels", [f[label_key] for f in features])
+
+        # Handling of all other possible keys.
+        # Again, we will use the first element to figure out which key/values are not None for this model.
+        for k, v in first.items():
+            if k not in ("label", "label_ids") and v is not None and not isinstance(v, str):
+                batch[k], key_padded = self._collate(k, [f[k] for f in features])
+                padded = padded or key_padded
 
+        path = "padded" if padded else "stacked"
+        if padded and self.path_counts["padded"] == 0:
+            lengths = [len(f["input_ids"]) for f in features] if "input_ids" in first else []
+            logger.warning(f"Padding a batch of examples of different lengths, input_ids lengths: {lengths}")
+        self.path_counts[path] += 1
+        num_batches = sum(self.path_counts.values())
+        if self.log_steps and num_batches % self.log_steps == 0:
+            logger.info(f"Collated {num_batches} batches: {self.path_counts}")
+        return batch
 
-def compute_metrics(eval_preds):
-    preds, labels = eval_preds
-    # preds have the same shape as the labels, after the argmax(-1) has been calculated
-    # by preprocess_logits_for_metrics, we need to shift the labels
-    labels = labels[:, 1:].reshape(-1)
-    preds = preds[:, :-1].reshape(-1)
-    return accuracy(predictions=preds, references=labels)
-
-
-def preprocess_logits_for_metrics(logits, labels):
-    if isinstance(logits, tuple):
-        # Depending on the model and config, logits may contain extra tensors,
-        # like past_key_values, but logits always come first
-        logits = logits[0]
-    return logits.argmax(dim=-1)
-
-
-def fault_tolerance_data_collator(features: List) -> Dict[str, Any]:
-    if not isinstance(features[0], Mapping):
-        features = [vars(f) for f in features]
-    first = features[0]
-    batch = {}
-
-    # Special handling for labels.
-    # Ensure that tensor is created with the correct type
-    if "label" in first and first["label"] is not None:
-        label = first["label"].item() if isinstance(first["label"], torch.Tensor) else first["label"]
-        dtype = torch.long if isinstance(label, int) else torch.float
-        batch["labels"] = torch.tensor([f["label"] for f in features], dtype=dtype)
-    elif "label_ids" in first and first["label_ids"] is not None:
-        if isinstance(first["label_ids"], torch.Tensor):
-            batch["labels"] = torch.stack([f["label_ids"] for f in features])
-        else:
-            dtype = torch.long if type(first["label_ids"][0]) is int else torch.float
-            batch["labels"] = torch.tensor([f["label_ids"] for f in features], dtype=dtype)
 
-    # Handling of all other possible keys.
-    # Again, we will use the first element to figure out which key/values are not None for this model.
-    try:
-        for k, v in first.items():
-            if k not in ("label", "label_ids") and v is not None and not isinstance(v, str):
-                if isinstance(v, torch.Tensor):
-                    batch[k] = torch.stack([f[k] for f in features])
-                elif isinstance(v, np.ndarray):
-                    batch[k] = torch.tensor(np.stack([f[k] for f in features]))
-                else:
-                    batch[k] = torch.tensor([f[k] for f in features])
-    except ValueError:  # quick fix by simply take the first example
-        for k, v in first.items():
-            if k not in ("label", "label_ids") and v is not None and not isinstance(v, str):
-                if isinstance(v, torch.Tensor):
-                    batch[k] = torch.stack([features[0][k]] * len(features))
-                elif isinstance(v, np.ndarray):
-                    batch[k] = torch.tensor(np.stack([features[0][k]] * len(features)))
-                else:
-                    batch[k] = torch.tensor([features[0][k]] * len(features))
+fault_tolerance_data_collator = FaultTolerantDataCollator()
+
 
-    return batch
+def has_tokens(input_ids) -> List[bool]:
+    """Batched filter of the examples with at least one token, e.g. not the blank lines of a txt corpus."""
+    return [len(ids) > 0 for ids in input_ids]
+
+
+@dataclass
+class PaddingFreeDataCollator:
+    """
+    Pad unpadded examples to the longest one of the batch, padding is masked out of attention_mask and labels.
+    Labels are the input_ids unless the examples have their own. Every log_steps batches the ratio of real tokens
+    to batch tokens collated by this process is logged.
+    """
+    pad_token_id: int = 0
+    label_pad_token_id: int = LabelSmoother.ignore_index
+    pad_to_multiple_of: Optional[int] = None
+    log_steps: int = 100
+    num_tokens: int = field(default=0, init=False)
+    num_batch_tokens: int = field(default=0, init=False)
+    num_batches: int = field(default=0, init=False)
+
+    @property
+    def effective_token_ratio(self) -> float:
+        return self.num_tokens / max(self.num_batch_tokens, 1)
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        lengths = [len(f["input_ids"]) for f in features]
+        max_len = max(lengths)
+        if self.pad_to_multiple_of:
+            max_len = math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = torch.full((len(features), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max_len), dtype=torch.long)
+        labels = torch.full((len(features), max_len), self.label_pad_token_id, dtype=torch.long)
+        for i, (f, n) in enumerate(zip(features, lengths)):
+            input_ids[i, :n] = torch.as_tensor(np.asarray(f["input_ids"]), dtype=torch.long)
+            attention_mask[i, :n] = 1
+            labels[i, :n] = torch.as_tensor(np.asarray(f["labels"]), dtype=torch.long) if "labels" in f \
+                else input_ids[i, :n]
+        self.num_tokens += sum(lengths)
+        self.num_batch_tokens += input_ids.numel()
+        self.num_batches += 1
+        if self.log_steps and self.num_batches % self.log_steps == 0:
+            logger.info(f"Padding free collator: {self.num_batches} batches, effective token ratio "
+                        f"{self.effective_token_ratio:.2%}")
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def flatten_column(column):
+    """
+    Concatenate the token lists of a batch column into one numpy array and return it with the document offsets.
+    A pyarrow list column, see `Dataset.with_format("arrow")`, is flattened without converting it to Python lists.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if isinstance(column, pa.Array):
+        offsets = column.offsets.to_numpy().astype(np.int64)
+        return column.flatten().to_numpy(zero_copy_only=False), offsets - offsets[0]
+    lengths = np.fromiter((len(x) for x in column), dtype=np.int64, count=len(column))
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    if not len(column) or offsets[-1] == 0:
+        return np.zeros(0, dtype=np.int64), offsets
+    return np.concatenate([np.asarray(x, dtype=np.int64) for x in column]), offsets
+
+
+def group_token_ids(ids: np.ndarray, block_size: int, carry: Optional[np.ndarray] = None):
+    """
+    Cut a flat token array, after the carried tokens of the previous batch, into rows of block_size.
+    :return: blocks [num_blocks, block_size] and the remainder to carry to the next batch
+    """
+    if carry is not None and len(carry):
+        ids = np.concatenate([carry, ids])
+    num_blocks = len(ids) // block_size
+    return ids[:num_blocks * block_size].reshape(num_blocks, block_size), ids[num_blocks * block_size:]
+
+
+def _batch_columns(examples) -> Dict[str, Any]:
+    if isinstance(examples, pa.Table):
+        return {k: examples.column(k) for k in examples.column_names}
+    return dict(examples)
+
+
+def group_texts(
+        examples,
+        block_size: int,
+        document_boundaries: bool = False,
+        ignore_index: int = LabelSmoother.ignore_index,
+) -> Dict[str, np.ndarray]:
+    """
+    Concatenate the documents of a batch and cut blocks of block_size, the remainder of the batch is dropped,
+    or kept as one shorter block if the batch has less than block_size tokens.
+    :param examples: batch of tokenized columns, dict of lists or a pyarrow Table
+    :param block_size: number of tokens of a block
+    :param document_boundaries: add position_ids restarting at each document, the first token of a document
+        is not predicted from the end of the previous one
+    :param ignore_index: label of the first token of each document with document_boundaries
+    """
+    result = {}
+    offsets = None
+    for k, column in _batch_columns(examples).items():
+        ids, column_offsets = flatten_column(column)
+        if k == "input_ids":
+            offsets = column_offsets
+        blocks, remainder = group_token_ids(ids, block_size)
+        result[k] = blocks if len(blocks) or not len(remainder) else remainder[None, :]
+    result["labels"] = result["input_ids"].copy()
+    if document_boundaries:
+        doc_starts = np.zeros(offsets[-1], dtype=bool)
+        doc_starts[offsets[:-1][offsets[1:] > offsets[:-1]]] = True
+        blocks, remainder = group_token_ids(doc_starts, block_size)
+        doc_starts = blocks if len(blocks) or not len(remainder) else remainder[None, :]
+        result["position_ids"] = packed_position_ids(doc_starts)
+        result["labels"] = packed_labels(result["input_ids"], doc_starts, ignore_index)
+    return result
 
 
 class GroupTextsBuilder:
@@ -258,19 +429,29 @@ class GroupTextsBuilder:
         self.max_seq_length = max_seq_length
 
     def __call__(self, examples):
-        # Concatenate all texts.
-        firsts = {k: examples[k][0][0] for k in examples.keys()}
-        lasts = {k: examples[k][0][-1] for k in examples.keys()}
-        contents = {k: sum([vi[1:-1] for vi in v], []) for k, v in examples.items()}
-        total_length = len(contents[list(examples.keys())[0]])
-
+        # Concatenate all texts without their first and last token, every block is wrapped by the first and last
+        # token of the first non-empty text, e.g. bos and eos
         content_length = self.max_seq_length - 2
-        if total_length >= content_length:
-            total_length = (total_length // content_length) * content_length
-        # Split by chunks of max_len.
-        result = {
-            k: [[firsts[k]] + t[i: i + content_length] + [lasts[k]] for i in range(0, total_length, content_length)] for
-            k, t in contents.items()}
+        result = {}
+        for k, column in _batch_columns(examples).items():
+            ids, offsets = flatten_column(column)
+            keep = np.ones(len(ids), dtype=bool)
+            nonempty = offsets[1:] > offsets[:-1]
+            keep[offsets[:-1][nonempty]] = False
+            keep[offsets[1:][nonempty] - 1] = False
+            contents = ids[keep]
+            total_length = len(contents)
+            if total_length >= content_length:
+                total_length = (total_length // content_length) * content_length
+            # Split by chunks of max_len, a batch of empty texts has no tokens and gives no blocks
+            result[k] = []
+            if nonempty.any():
+                doc = int(np.argmax(nonempty))
+                first, last = ids[offsets[doc]], ids[offsets[doc + 1] - 1]
+                result[k] = [
+                    np.concatenate([[first], contents[i: i + content_length], [last]])
+                    for i in range(0, total_length, content_length)
+                ]
         return result
 
 
@@ -365,6 +546,11 @@ def main():
             + f" distributed training: {bool(training_args.local_rank != -1)}, 16-bits training: {training_args.fp16}"
         )
 
+    if data_args.document_boundaries and not (model_args.flash_attn and is_flash_attn_2_available):
+        # Without varlen flash attention the packed documents of a block would attend to each other
+        raise ValueError("--document_boundaries requires FlashAttention-2, set `--flash_attn True` and install "
+                         "flash-attn, or disable --document_boundaries.")
+
     # Set seed before initializing model.
     set_seed(training_args.seed)
 
@@ -397,37 +583,19 @@ def main():
 
     # Preprocessing the datasets.
     def tokenize_function(examples):
-        tokenized_inputs = tokenizer(
-            examples["text"],
-            truncation=True,
-            padding='max_length',
-            max_length=block_size
-        )
-        # Copy the input_ids to the labels for language modeling. This is suitable for both
-        # masked language modeling (like BERT) or causal language modeling (like GPT).
-        tokenized_inputs["labels"] = tokenized_inputs["input_ids"].copy()
-
-        return tokenized_inputs
+        # Unpadded ids truncated to block_size, PaddingFreeDataCollator pads each batch to its longest example
+        # and masks the padding out of the labels
+        tokenized_inputs = tokenizer(examples["text"], truncation=True, max_length=block_size)
+        return {"input_ids": tokenized_inputs["input_ids"]}
 
     def tokenize_wo_pad_function(examples):
         return tokenizer(examples["text"])
 
     # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
+    # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
+    # customize this part to your needs.
     def group_text_function(examples):
-        # Concatenate all texts.
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
-        # customize this part to your needs.
-        if total_length >= block_size:
-            total_length = (total_length // block_size) * block_size
-        # Split by chunks of max_len.
-        result = {
-            k: [t[i: i + block_size] for i in range(0, total_length, block_size)]
-            for k, t in concatenated_examples.items()
-        }
-        result["labels"] = result["input_ids"].copy()
-        return result
+        return group_texts(examples, block_size, document_boundaries=data_args.document_boundaries)
 
     # Get the datasets: you can either provide your own CSV/JSON/TXT training and evaluation files (see below)
     # or just provide the name of one of the public datasets available on the hub at https://huggingface.co/datasets/
@@ -438,130 +606,174 @@ def main():
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if data_args.dataset_name is not None:
-        # Downloading and loading a dataset from the hub.
-        raw_datasets = load_dataset(
-            data_args.dataset_name,
-            data_args.dataset_config_name,
-            cache_dir=model_args.cache_dir,
-            streaming=data_args.streaming,
-        )
-        if "validation" not in raw_datasets.keys():
-            raw_datasets["validation"] = load_dataset(
-                data_args.dataset_name,
-                data_args.dataset_config_name,
-                split=f"train[:{data_args.validation_split_percentage}%]",
-                cache_dir=model_args.cache_dir,
-                streaming=data_args.streaming,
-            )
-            raw_datasets["train"] = load_dataset(
+    if data_args.compiled_data_dir is not None:
+        lm_datasets = load_compiled_datasets(data_args.compiled_data_dir, tokenizer, stage="pt")
+        compiled_block_size = lm_datasets[next(iter(lm_datasets))].meta["max_length"]
+        if compiled_block_size != block_size:
+            logger.warning(f"Compiled data has block_size={compiled_block_size}, not {block_size}, using it")
+    elif data_args.streaming and data_args.dataset_name is None:
+        # Bounded memory: documents are read, tokenized and packed on the fly by the dataloader workers
+        if training_args.dataloader_num_workers == 0 and data_args.preprocessing_num_workers:
+            training_args.dataloader_num_workers = data_args.preprocessing_num_workers
+        streaming_kwargs = {
+            "tokenizer": tokenizer,
+            "block_size": block_size,
+            "tokenize_batch_size": data_args.streaming_batch_size,
+            "keep_linebreaks": data_args.keep_linebreaks,
+            "document_boundaries": data_args.document_boundaries,
+        }
+        train_files = list_data_files(data_args.train_file_dir)
+        logger.info(f"train files: {train_files}")
+        lm_datasets = {}
+        if data_args.validation_file_dir is not None and os.path.exists(data_args.validation_file_dir):
+            eval_files = list_data_files(data_args.validation_file_dir)
+            logger.info(f"eval files: {eval_files}")
+            lm_datasets["validation"] = StreamingPackedDataset(
+                eval_files, max_blocks=data_args.max_eval_samples, **streaming_kwargs)
+            holdout_every = None
+        else:
+            # Every holdout_every-th line of each train file is validation data
+            holdout_every = max(1, 100 // max(data_args.validation_split_percentage, 1))
+            lm_datasets["validation"] = StreamingPackedDataset(
+                train_files, holdout_every=holdout_every, holdout=True, max_blocks=data_args.max_eval_samples,
+                **streaming_kwargs)
+        lm_datasets["train"] = StreamingPackedDataset(
+            train_files, holdout_every=holdout_every, max_blocks=data_args.max_train_samples, **streaming_kwargs)
+    else:
+        if data_args.dataset_name is not None:
+            # Downloading and loading a dataset from the hub.
+            raw_datasets = load_dataset(
                 data_args.dataset_name,
                 data_args.dataset_config_name,
-                split=f"train[{data_args.validation_split_percentage}%:]",
                 cache_dir=model_args.cache_dir,
                 streaming=data_args.streaming,
             )
-    else:
-        data_files = {}
-        dataset_args = {}
-        if data_args.train_file_dir is not None and os.path.exists(data_args.train_file_dir):
-            train_data_files = glob(f'{data_args.train_file_dir}/**/*.txt', recursive=True) + glob(
-                f'{data_args.train_file_dir}/**/*.json', recursive=True) + glob(
-                f'{data_args.train_file_dir}/**/*.jsonl', recursive=True)
-            logger.info(f"train files: {train_data_files}")
-            # Train data files must be same type, e.g. all txt or all jsonl
-            types = [f.split('.')[-1] for f in train_data_files]
-            if len(set(types)) > 1:
-                raise ValueError(f"train files must be same type, e.g. all txt or all jsonl, but got {types}")
-            data_files["train"] = train_data_files
-        if data_args.validation_file_dir is not None and os.path.exists(data_args.validation_file_dir):
-            eval_data_files = glob(f'{data_args.validation_file_dir}/**/*.txt', recursive=True) + glob(
-                f'{data_args.validation_file_dir}/**/*.json', recursive=True) + glob(
-                f'{data_args.validation_file_dir}/**/*.jsonl', recursive=True)
-            logger.info(f"eval files: {eval_data_files}")
-            data_files["validation"] = eval_data_files
-            # Train data files must be same type, e.g. all txt or all jsonl
-            types = [f.split('.')[-1] for f in eval_data_files]
-            if len(set(types)) > 1:
-                raise ValueError(f"train files must be same type, e.g. all txt or all jsonl, but got {types}")
-        extension = "text" if data_files["train"][0].endswith('txt') else 'json'
-        if extension == "text":
-            dataset_args["keep_linebreaks"] = data_args.keep_linebreaks
-        raw_datasets = load_dataset(
-            extension,
-            data_files=data_files,
-            cache_dir=model_args.cache_dir,
-            **dataset_args,
-        )
-
-        # If no validation data is there, validation_split_percentage will be used to divide the dataset.
-        if "validation" not in raw_datasets.keys():
-            raw_datasets["validation"] = load_dataset(
-                extension,
-                data_files=data_files,
-                split=f"train[:{data_args.validation_split_percentage}%]",
-                cache_dir=model_args.cache_dir,
-                **dataset_args,
-            )
-            raw_datasets["train"] = load_dataset(
+            if "validation" not in raw_datasets.keys():
+                raw_datasets["validation"] = load_dataset(
+                    data_args.dataset_name,
+                    data_args.dataset_config_name,
+                    split=f"train[:{data_args.validation_split_percentage}%]",
+                    cache_dir=model_args.cache_dir,
+                    streaming=data_args.streaming,
+                )
+                raw_datasets["train"] = load_dataset(
+                    data_args.dataset_name,
+                    data_args.dataset_config_name,
+                    split=f"train[{data_args.validation_split_percentage}%:]",
+                    cache_dir=model_args.cache_dir,
+                    streaming=data_args.streaming,
+                )
+        else:
+            data_files = {}
+            dataset_args = {}
+            if data_args.train_file_dir is not None and os.path.exists(data_args.train_file_dir):
+                train_data_files = glob(f'{data_args.train_file_dir}/**/*.txt', recursive=True) + glob(
+                    f'{data_args.train_file_dir}/**/*.json', recursive=True) + glob(
+                    f'{data_args.train_file_dir}/**/*.jsonl', recursive=True)
+                logger.info(f"train files: {train_data_files}")
+                # Train data files must be same type, e.g. all txt or all jsonl
+                types = [f.split('.')[-1] for f in train_data_files]
+                if len(set(types)) > 1:
+                    raise ValueError(f"train files must be same type, e.g. all txt or all jsonl, but got {types}")
+                data_files["train"] = train_data_files
+            if data_args.validation_file_dir is not None and os.path.exists(data_args.validation_file_dir):
+                eval_data_files = glob(f'{data_args.validation_file_dir}/**/*.txt', recursive=True) + glob(
+                    f'{data_args.validation_file_dir}/**/*.json', recursive=True) + glob(
+                    f'{data_args.validation_file_dir}/**/*.jsonl', recursive=True)
+                logger.info(f"eval files: {eval_data_files}")
+                data_files["validation"] = eval_data_files
+                # Train data files must be same type, e.g. all txt or all jsonl
+                types = [f.split('.')[-1] for f in eval_data_files]
+                if len(set(types)) > 1:
+                    raise ValueError(f"train files must be same type, e.g. all txt or all jsonl, but got {types}")
+            extension = "text" if data_files["train"][0].endswith('txt') else 'json'
+            if extension == "text":
+                dataset_args["keep_linebreaks"] = data_args.keep_linebreaks
+            raw_datasets = load_dataset(
                 extension,
                 data_files=data_files,
-                split=f"train[{data_args.validation_split_percentage}%:]",
                 cache_dir=model_args.cache_dir,
                 **dataset_args,
             )
-    logger.info(f"Raw datasets: {raw_datasets}")
 
-    # Preprocessing the datasets.
-    if training_args.do_train:
-        column_names = list(raw_datasets["train"].features)
-    else:
-        column_names = list(raw_datasets["validation"].features)
-
-    with training_args.main_process_first(desc="Dataset tokenization and grouping"):
-        if not data_args.streaming:
-            if training_args.group_by_length:
-                tokenized_datasets = raw_datasets.map(
-                    tokenize_wo_pad_function,
-                    batched=True,
-                    num_proc=data_args.preprocessing_num_workers,
-                    remove_columns=column_names,
-                    load_from_cache_file=not data_args.overwrite_cache,
-                    desc="Running tokenizer on dataset" if is_main_process else None,
-                )
-                lm_datasets = tokenized_datasets.map(
-                    group_text_function,
-                    batched=True,
-                    num_proc=data_args.preprocessing_num_workers,
-                    load_from_cache_file=not data_args.overwrite_cache,
-                    desc=f"Grouping texts in chunks of {block_size}",
+            # If no validation data is there, validation_split_percentage will be used to divide the dataset.
+            if "validation" not in raw_datasets.keys():
+                raw_datasets["validation"] = load_dataset(
+                    extension,
+                    data_files=data_files,
+                    split=f"train[:{data_args.validation_split_percentage}%]",
+                    cache_dir=model_args.cache_dir,
+                    **dataset_args,
                 )
-            else:
-                lm_datasets = raw_datasets.map(
-                    tokenize_function,
-                    batched=True,
-                    num_proc=data_args.preprocessing_num_workers,
-                    remove_columns=column_names,
-                    load_from_cache_file=not data_args.overwrite_cache,
-                    desc="Running tokenizer on dataset" if is_main_process else None,
+                raw_datasets["train"] = load_dataset(
+                    extension,
+                    data_files=data_files,
+                    split=f"train[{data_args.validation_split_percentage}%:]",
+                    cache_dir=model_args.cache_dir,
+                    **dataset_args,
                 )
+        logger.info(f"Raw datasets: {raw_datasets}")
+
+        # Preprocessing the datasets.
+        if training_args.do_train:
+            column_names = list(raw_datasets["train"].features)
         else:
-            if training_args.group_by_length:
-                tokenized_datasets = raw_datasets.map(
-                    tokenize_wo_pad_function,
-                    batched=True,
-                    remove_columns=column_names,
-                )
-                lm_datasets = tokenized_datasets.map(
-                    group_text_function,
-                    batched=True,
-                )
+            column_names = list(raw_datasets["validation"].features)
+
+        with training_args.main_process_first(desc="Dataset tokenization and grouping"):
+            if not data_args.streaming:
+                if training_args.group_by_length:
+                    tokenized_datasets = raw_datasets.map(
+                        tokenize_wo_pad_function,
+                        batched=True,
+                        num_proc=data_args.preprocessing_num_workers,
+                        remove_columns=column_names,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc="Running tokenizer on dataset" if is_main_process else None,
+                    )
+                    # Arrow batches, group_texts reads the token columns without building Python lists
+                    lm_datasets = tokenized_datasets.with_format("arrow").map(
+                        group_text_function,
+                        batched=True,
+                        num_proc=data_args.preprocessing_num_workers,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc=f"Grouping texts in chunks of {block_size}",
+                    ).with_format(None)
+                else:
+                    lm_datasets = raw_datasets.map(
+                        tokenize_function,
+                        batched=True,
+                        num_proc=data_args.preprocessing_num_workers,
+                        remove_columns=column_names,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc="Running tokenizer on dataset" if is_main_process else None,
+                    ).filter(
+                        has_tokens,
+                        batched=True,
+                        input_columns="input_ids",
+                        num_proc=data_args.preprocessing_num_workers,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc="Dropping empty texts",
+                    )
+                # Rows are numpy arrays of the Arrow buffers, the collators copy them into the batch tensors
+                lm_datasets = lm_datasets.with_format("numpy")
             else:
-                lm_datasets = raw_datasets.map(
-                    tokenize_function,
-                    batched=True,
-                    remove_columns=column_names,
-                )
+                if training_args.group_by_length:
+                    tokenized_datasets = raw_datasets.map(
+                        tokenize_wo_pad_function,
+                        batched=True,
+                        remove_columns=column_names,
+                    )
+                    lm_datasets = tokenized_datasets.map(
+                        group_text_function,
+                        batched=True,
+                    )
+                else:
+                    lm_datasets = raw_datasets.map(
+                        tokenize_function,
+                        batched=True,
+                        remove_columns=column_names,
+                    ).filter(has_tokens, batched=True, input_columns="input_ids")
 
     train_dataset = None
     max_train_samples = 0
@@ -569,13 +781,16 @@ def main():
         if "train" not in lm_datasets:
             raise ValueError("--do_train requires a train dataset")
         train_dataset = lm_datasets['train']
-        max_train_samples = len(train_dataset)
-        if data_args.max_train_samples is not None and data_args.max_train_samples > 0:
-            max_train_samples = min(len(train_dataset), data_args.max_train_samples)
-            train_dataset = train_dataset.select(range(max_train_samples))
-        logger.debug(f"Num train_samples: {len(train_dataset)}")
-        logger.debug("Tokenized training example:")
-        logger.debug(tokenizer.decode(train_dataset[0]['input_ids']))
+        if isinstance(train_dataset, StreamingPackedDataset):
+            max_train_samples = data_args.max_train_samples or 0
+        else:
+            max_train_samples = len(train_dataset)
+            if data_args.max_train_samples is not None and data_args.max_train_samples > 0:
+                max_train_samples = min(len(train_dataset), data_args.max_train_samples)
+                train_dataset = train_dataset.select(range(max_train_samples))
+            logger.debug(f"Num train_samples: {len(train_dataset)}")
+            logger.debug("Tokenized training example:")
+            logger.debug(tokenizer.decode(train_dataset[0]['input_ids']))
 
     eval_dataset = None
     max_eval_samples = 0
@@ -583,13 +798,16 @@ def main():
         if "validation" not in lm_datasets:
             raise ValueError("--do_eval requires a validation dataset")
         eval_dataset = lm_datasets["validation"]
-        max_eval_samples = len(eval_dataset)
-        if data_args.max_eval_samples is not None and data_args.max_eval_samples > 0:
-            max_eval_samples = min(len(eval_dataset), data_args.max_eval_samples)
-            eval_dataset = eval_dataset.select(range(max_eval_samples))
-        logger.debug(f"Num eval_samples: {len(eval_dataset)}")
-        logger.debug("Tokenized eval example:")
-        logger.debug(tokenizer.decode(eval_dataset[0]['input_ids']))
+        if isinstance(eval_dataset, StreamingPackedDataset):
+            max_eval_samples = data_args.max_eval_samples or 0
+        else:
+            max_eval_samples = len(eval_dataset)
+            if data_args.max_eval_samples is not None and data_args.max_eval_samples > 0:
+                max_eval_samples = min(len(eval_dataset), data_args.max_eval_samples)
+                eval_dataset = eval_dataset.select(range(max_eval_samples))
+            logger.debug(f"Num eval_samples: {len(eval_dataset)}")
+            logger.debug("Tokenized eval example:")
+            logger.debug(tokenizer.decode(eval_dataset[0]['input_ids']))
 
     # Load model
     if model_args.model_name_or_path:
@@ -636,6 +854,14 @@ def main():
                         bnb_4bit_compute_dtype=torch_dtype,
                     )
 
+        # Set FlashAttention-2
+        if model_args.flash_attn:
+            if is_flash_attn_2_available:
+                config_kwargs["use_flash_attention_2"] = True
+                logger.info("Using FlashAttention-2 for faster training and inference.")
+            else:
+                logger.warning("FlashAttention-2 is not installed.")
+
         model = AutoModelForCausalLM.from_pretrained(
             model_args.model_name_or_path,
             config=config,
@@ -697,14 +923,39 @@ def main():
         model.is_parallelizable = True
         model.model_parallel = True
 
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    data_collator = FaultTolerantDataCollator(pad_token_id=pad_token_id or 0)
+    padding_free = (
+            not training_args.group_by_length
+            and data_args.compiled_data_dir is None
+            and not (data_args.streaming and data_args.dataset_name is None)
+    )
+    if padding_free:
+        data_collator = PaddingFreeDataCollator(pad_token_id=pad_token_id or 0)
+        if train_dataset is not None and not isinstance(train_dataset, torch.utils.data.IterableDataset):
+            lengths = get_lengths(train_dataset, ["input_ids"])
+            logger.info(f"Padding free train data: {int(lengths.sum())} tokens in {len(lengths)} examples, padding "
+                        f"to block_size={block_size} would give an effective token ratio of "
+                        f"{lengths.sum() / max(len(lengths) * block_size, 1):.2%}")
+    if data_args.document_boundaries:
+        if padding_free or data_args.compiled_data_dir is not None:
+            logger.warning("--document_boundaries only applies to packed blocks, set --group_by_length True or "
+                           "--streaming True to pack documents")
+        else:
+            data_collator = PackedDataCollator(pad_token_id=pad_token_id or 0, unpacked_collator=data_collator)
+
+    if training_args.do_eval and not training_args.batch_eval_metrics:
+        # Token metrics are accumulated step by step, eval predictions and labels are not kept on the host
+        training_args.batch_eval_metrics = True
+
     trainer = SavePeftModelTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
         eval_dataset=eval_dataset if training_args.do_eval else None,
         tokenizer=tokenizer,
-        data_collator=fault_tolerance_data_collator,
-        compute_metrics=compute_metrics if training_args.do_eval and not is_torch_tpu_available() else None,
+        data_collator=data_collator,
+        compute_metrics=TokenMetrics() if training_args.do_eval and not is_torch_tpu_available() else None,
         preprocess_logits_for_metrics=preprocess_logits_for_metrics
         if training_args.do_eval and not is_torch_tpu_available()
         else None,
@@ -10,6 +10,7 @@ from dataclasses import dataclass, field
 from glob import glob
 from typing import Any, List, Union, Optional, Dict
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from datasets import load_dataset
@@ -28,6 +29,8 @@ from transformers import (
 )
 from transformers.trainer import TRAINING_ARGS_NAME
 
+from batch_samplers import LengthBucketSampler, TokenBudgetBatchSampler, build_token_budget_dataloader, get_lengths
+from data_shards import load_compiled_datasets
 from template import get_conv_template
 
 
@@ -134,6 +137,10 @@ class DataArguments:
         default=4,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    compiled_data_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Pre-tokenized data compiled by `python data_shards.py --stage rm`, skips tokenization."},
+    )
 
 
 @dataclass
@@ -146,6 +153,25 @@ class ScriptArguments:
     modules_to_save: Optional[str] = field(default=None)
     peft_path: Optional[str] = field(default=None)
     template_name: Optional[str] = field(default="vicuna", metadata={"help": "The prompt template name."})
+    length_bucketing: bool = field(
+        default=False,
+        metadata={"help": "Whether to batch pairs of similar length together and pad each batch to its longest "
+                          "example instead of max_source_length + max_target_length"}
+    )
+    bucket_size: int = field(
+        default=64,
+        metadata={"help": "Number of batches per length bucket, larger buckets pad less but shuffle less"}
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "Form length bucketed train batches by this budget of padded chosen and rejected tokens "
+                          "instead of per_device_train_batch_size pairs"}
+    )
+    concatenated_forward: bool = field(
+        default=False,
+        metadata={"help": "Whether to pad chosen and rejected to a common length and run them through the model "
+                          "in one forward of 2 * batch size"}
+    )
 
 
 def compute_metrics(eval_preds):
@@ -163,19 +189,59 @@ def compute_metrics(eval_preds):
     return {"mse": mse, "mae": mae}
 
 
+def preprocess_reward_function(examples, tokenizer, prompt_template):
+    """
+    Turn the dataset into pairs of Question + Answer, the prompt of system, history and question is shared by the
+        preferred answer (chosen) and the other (rejected). It is tokenized once into prompt_ids, the answers are
+        tokenized on their own into chosen_ids and rejected_ids, like the query and response of SFT data.
+        RewardDataCollatorWithPadding joins the prompt with each answer.
+    """
+    prompts = []
+    for system, history, question in zip(examples["system"], examples["history"], examples["question"]):
+        messages = history + [[question, ""]] if history else [[question, ""]]
+        prompts.append(prompt_template.get_prompt(messages=messages, system_prompt=system or ""))
+    return {
+        "prompt_ids": tokenizer(prompts)["input_ids"],
+        "chosen_ids": tokenizer(examples["response_chosen"], add_special_tokens=False)["input_ids"],
+        "rejected_ids": tokenizer(examples["response_rejected"], add_special_tokens=False)["input_ids"],
+    }
+
+
+def is_valid_pair(example, max_length: int) -> bool:
+    """Prompt + chosen and prompt + rejected are not empty and at most max_length tokens."""
+    prompt_len = len(example["prompt_ids"])
+    chosen_len, rejected_len = len(example["chosen_ids"]), len(example["rejected_ids"])
+    return 0 < prompt_len + min(chosen_len, rejected_len) and prompt_len + max(chosen_len, rejected_len) <= max_length
+
+
 @dataclass
 class RewardDataCollatorWithPadding:
-    """We need to define a special data collator that batches the data in our chosen vs rejected format"""
+    """
+    We need to define a special data collator that batches the data in our chosen vs rejected format
+    Features of prompt_ids, chosen_ids and rejected_ids are joined into prompt + chosen and prompt + rejected here.
+    With concatenate, chosen and rejected are padded to a common length and stacked into one batch of 2 * B rows,
+    chosen first, so the reward model runs a single forward per step.
+    """
     tokenizer: PreTrainedTokenizerBase
     padding: Union[bool, str] = True
     max_length: Optional[int] = None
     pad_to_multiple_of: Optional[int] = None
     return_tensors: str = "pt"
+    concatenate: bool = False
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
         features_chosen = []
         features_rejected = []
         for feature in features:
+            if "prompt_ids" in feature:
+                prompt_ids = list(feature["prompt_ids"])
+                input_ids_chosen = prompt_ids + list(feature["chosen_ids"])
+                input_ids_rejected = prompt_ids + list(feature["rejected_ids"])
+                features_chosen.append({"input_ids": input_ids_chosen, "attention_mask": [1] * len(input_ids_chosen)})
+                features_rejected.append(
+                    {"input_ids": input_ids_rejected, "attention_mask": [1] * len(input_ids_rejected)}
+                )
+                continue
             features_chosen.append(
                 {
                     "input_ids": feature["input_ids_chosen"],
@@ -188,6 +254,19 @@ class RewardDataCollatorWithPadding:
                     "attention_mask": feature["attention_mask_rejected"],
                 }
             )
+        if self.concatenate:
+            batch = self.tokenizer.pad(
+                features_chosen + features_rejected,
+                padding=self.padding,
+                max_length=self.max_length,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors=self.return_tensors,
+            )
+            return {
+                "input_ids": batch["input_ids"],
+                "attention_mask": batch["attention_mask"],
+                "return_loss": True,
+            }
         batch_chosen = self.tokenizer.pad(
             features_chosen,
             padding=self.padding,
@@ -218,13 +297,85 @@ class RewardTrainer(Trainer):
         Define how to compute the reward loss. Use the InstructGPT pairwise logloss: https://arxiv.org/abs/2203.02155
     """
 
-    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+    def __init__(self, *args, train_lengths=None, bucket_size=64, max_tokens_per_batch=None, **kwargs):
+        """
+        :param train_lengths: lengths of the train examples, batch examples of similar length if set
+        :param bucket_size: number of batches per length bucket
+        :param max_tokens_per_batch: cut the length buckets by this budget of padded tokens
+        """
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+        self.bucket_size = bucket_size
+        self.max_tokens_per_batch = max_tokens_per_batch
+        if max_tokens_per_batch is not None:
+            # compute_loss divides by the pairs of all accumulated micro batches, see get_batch_samples
+            self.model_accepts_loss_kwargs = True
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthBucketSampler(
+            self.train_lengths,
+            batch_size=self._train_batch_size,
+            bucket_size=self.bucket_size,
+            seed=self.args.seed,
+            log_padding=self.is_world_process_zero(),
+        )
+
+    def get_train_dataloader(self):
+        if self.train_lengths is None or self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        batch_sampler = TokenBudgetBatchSampler(
+            self.train_lengths,
+            max_tokens=self.max_tokens_per_batch,
+            bucket_size=self.bucket_size,
+            seed=self.args.seed,
+            log_padding=self.is_world_process_zero(),
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+        return build_token_budget_dataloader(self, batch_sampler)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, *args, **kwargs):
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, *args, **kwargs)
+        if self.max_tokens_per_batch is not None and batch_samples:
+            # Micro batches hold different numbers of pairs, count the pairs of the whole optimizer step
+            num_items_in_batch = torch.tensor(sum(self._num_pairs(b) for b in batch_samples),
+                                              device=self.args.device)
+            if self.args.average_tokens_across_devices:
+                num_items_in_batch = self.accelerator.gather(num_items_in_batch).sum()
+            num_items_in_batch = num_items_in_batch.item()
+        return batch_samples, num_items_in_batch
+
+    @staticmethod
+    def _num_pairs(inputs) -> int:
+        if "input_ids" in inputs:
+            return len(inputs["input_ids"]) // 2
+        return len(inputs["input_ids_chosen"])
+
+    @staticmethod
+    def _forward_rewards(model, inputs):
+        """Rewards of chosen and rejected, one forward over a concatenated batch, else one forward each."""
+        if "input_ids" in inputs:
+            rewards = model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])[0]
+            return rewards.chunk(2)
         rewards_chosen = model(input_ids=inputs["input_ids_chosen"],
                                attention_mask=inputs["attention_mask_chosen"])[0]
         rewards_rejected = model(input_ids=inputs["input_ids_rejected"],
                                  attention_mask=inputs["attention_mask_rejected"])[0]
+        return rewards_chosen, rewards_rejected
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None, **kwargs):
+        rewards_chosen, rewards_rejected = self._forward_rewards(model, inputs)
         # 计算损失：InstructGPT中的pairwise logloss
-        loss = -torch.nn.functional.logsigmoid(rewards_chosen - rewards_rejected).mean()
+        losses = -torch.nn.functional.logsigmoid(rewards_chosen - rewards_rejected)
+        if self.max_tokens_per_batch is not None and num_items_in_batch is not None and model.training:
+            loss = losses.sum() / num_items_in_batch
+            if self.args.average_tokens_across_devices:
+                # DDP averages the gradients of the devices, num_items_in_batch counts the pairs of all of them
+                loss = loss * self.accelerator.num_processes
+        else:
+            loss = losses.mean()
         if return_outputs:
             return loss, {"rewards_chosen": rewards_chosen, "rewards_rejected": rewards_rejected}
         return loss
@@ -240,22 +391,10 @@ class RewardTrainer(Trainer):
         return super().evaluate(eval_dataset=eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
 
     def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None):
-        # Prepare inputs for chosen and rejected separately
         device = model.device
-
-        inputs_chosen = {
-            "input_ids": inputs["input_ids_chosen"].to(device),
-            "attention_mask": inputs["attention_mask_chosen"].to(device),
-        }
-        outputs_chosen = model(**inputs_chosen)
-        rewards_chosen = outputs_chosen.logits.detach()
-
-        inputs_rejected = {
-            "input_ids": inputs["input_ids_rejected"].to(device),
-            "attention_mask": inputs["attention_mask_rejected"].to(device),
-        }
-        outputs_rejected = model(**inputs_rejected)
-        rewards_rejected = outputs_rejected.logits.detach()
+        inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+        with torch.no_grad():
+            rewards_chosen, rewards_rejected = self._forward_rewards(model, inputs)
 
         # Keep the compute_loss method
         loss = -torch.nn.functional.logsigmoid(rewards_chosen - rewards_rejected).mean()
@@ -431,7 +570,13 @@ def main():
         print_trainable_parameters(model)
 
     # Get reward dataset for tuning the reward model.
-    if data_args.dataset_name is not None:
+    full_max_length = data_args.max_source_length + data_args.max_target_length
+    if data_args.compiled_data_dir is not None:
+        raw_datasets = load_compiled_datasets(
+            data_args.compiled_data_dir, tokenizer, stage="rm", template_name=script_args.template_name,
+            max_length=full_max_length,
+        )
+    elif data_args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         raw_datasets = load_dataset(
             data_args.dataset_name,
@@ -485,40 +630,7 @@ def main():
     logger.info(f"Raw datasets: {raw_datasets}")
 
     # Preprocessing the datasets
-    full_max_length = data_args.max_source_length + data_args.max_target_length
-
-    def preprocess_reward_function(examples):
-        """
-        Turn the dataset into pairs of Question + Answer, where input_ids_chosen is the preferred question + answer
-            and text_rejected is the other.
-        """
-        new_examples = {
-            "input_ids_chosen": [],
-            "attention_mask_chosen": [],
-            "input_ids_rejected": [],
-            "attention_mask_rejected": [],
-        }
-        for system, history, question, chosen, rejected in zip(
-                examples["system"],
-                examples["history"],
-                examples["question"],
-                examples["response_chosen"],
-                examples["response_rejected"]
-        ):
-            system_prompt = system or ""
-            chosen_messages = history + [[question, chosen]] if history else [[question, chosen]]
-            chosen_prompt = prompt_template.get_prompt(messages=chosen_messages, system_prompt=system_prompt)
-            rejected_messages = history + [[question, rejected]] if history else [[question, rejected]]
-            rejected_prompt = prompt_template.get_prompt(messages=rejected_messages, system_prompt=system_prompt)
-
-            tokenized_chosen = tokenizer(chosen_prompt)
-            tokenized_rejected = tokenizer(rejected_prompt)
-
-            new_examples["input_ids_chosen"].append(tokenized_chosen["input_ids"])
-            new_examples["attention_mask_chosen"].append(tokenized_chosen["attention_mask"])
-            new_examples["input_ids_rejected"].append(tokenized_rejected["input_ids"])
-            new_examples["attention_mask_rejected"].append(tokenized_rejected["attention_mask"])
-        return new_examples
+    preprocess_kwargs = {"tokenizer": tokenizer, "prompt_template": prompt_template}
 
     train_dataset = None
     max_train_samples = 0
@@ -532,21 +644,24 @@ def main():
             train_dataset = train_dataset.select(range(max_train_samples))
         logger.debug(f"Example train_dataset[0]: {train_dataset[0]}")
         with training_args.main_process_first(desc="Train dataset tokenization"):
-            tokenized_dataset = train_dataset.shuffle().map(
-                preprocess_reward_function,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                remove_columns=train_dataset.column_names,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on dataset",
-            )
-            train_dataset = tokenized_dataset.filter(
-                lambda x: 0 < len(x['input_ids_rejected']) <= full_max_length and 0 < len(
-                    x['input_ids_chosen']) <= full_max_length
-            )
+            if data_args.compiled_data_dir is None:
+                tokenized_dataset = train_dataset.shuffle().map(
+                    preprocess_reward_function,
+                    batched=True,
+                    num_proc=data_args.preprocessing_num_workers,
+                    fn_kwargs=preprocess_kwargs,
+                    remove_columns=train_dataset.column_names,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    desc="Running tokenizer on dataset",
+                )
+                train_dataset = tokenized_dataset.filter(
+                    is_valid_pair,
+                    fn_kwargs={"max_length": full_max_length},
+                    num_proc=data_args.preprocessing_num_workers,
+                )
             logger.debug(f"Num train_samples: {len(train_dataset)}")
             logger.debug("Tokenized training example:")
-            logger.debug(tokenizer.decode(train_dataset[0]['input_ids_chosen']))
+            logger.debug(tokenizer.decode(list(train_dataset[0]['prompt_ids']) + list(train_dataset[0]['chosen_ids'])))
 
     eval_dataset = None
     max_eval_samples = 0
@@ -560,21 +675,24 @@ def main():
                 max_eval_samples = min(len(eval_dataset), data_args.max_eval_samples)
                 eval_dataset = eval_dataset.select(range(max_eval_samples))
             logger.debug(f"Example eval_dataset[0]: {eval_dataset[0]}")
-            tokenized_dataset = eval_dataset.map(
-                preprocess_reward_function,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                remove_columns=eval_dataset.column_names,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on dataset",
-            )
-            eval_dataset = tokenized_dataset.filter(
-                lambda x: 0 < len(x['input_ids_rejected']) <= full_max_length and 0 < len(
-                    x['input_ids_chosen']) <= full_max_length
-            )
+            if data_args.compiled_data_dir is None:
+                tokenized_dataset = eval_dataset.map(
+                    preprocess_reward_function,
+                    batched=True,
+                    num_proc=data_args.preprocessing_num_workers,
+                    fn_kwargs=preprocess_kwargs,
+                    remove_columns=eval_dataset.column_names,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    desc="Running tokenizer on dataset",
+                )
+                eval_dataset = tokenized_dataset.filter(
+                    is_valid_pair,
+                    fn_kwargs={"max_length": full_max_length},
+                    num_proc=data_args.preprocessing_num_workers,
+                )
             logger.debug(f"Num eval_samples: {len(eval_dataset)}")
             logger.debug("Tokenized eval example:")
-            logger.debug(tokenizer.decode(eval_dataset[0]['input_ids_chosen']))
+            logger.debug(tokenizer.decode(list(eval_dataset[0]['prompt_ids']) + list(eval_dataset[0]['chosen_ids'])))
 
     # Initialize our Trainer
     if training_args.gradient_checkpointing:
@@ -587,6 +705,18 @@ def main():
         # Keeps Trainer from trying its own DataParallelism when more than 1 gpu is available
         model.is_parallelizable = True
         model.model_parallel = True
+    train_lengths = None
+    if (script_args.length_bucketing or script_args.max_tokens_per_batch) and training_args.do_train:
+        prompt_lengths, chosen_lengths, rejected_lengths = get_lengths(
+            train_dataset, ["prompt_ids", "chosen_ids", "rejected_ids"]
+        ).T
+        train_lengths = np.stack([prompt_lengths + chosen_lengths, prompt_lengths + rejected_lengths], axis=1)
+        if script_args.concatenated_forward:
+            # Both rows of a pair are padded to the longer one
+            train_lengths = train_lengths.max(axis=1, keepdims=True).repeat(2, axis=1)
+    if script_args.max_tokens_per_batch and hasattr(training_args, "average_tokens_across_devices"):
+        # Batches of different devices hold different numbers of pairs, normalize the loss by the global count
+        training_args.average_tokens_across_devices = True
     trainer = RewardTrainer(
         model=model,
         args=training_args,
@@ -595,8 +725,14 @@ def main():
         tokenizer=tokenizer,
         compute_metrics=compute_metrics,
         data_collator=RewardDataCollatorWithPadding(
-            tokenizer=tokenizer, max_length=full_max_length, padding="max_length"
+            tokenizer=tokenizer,
+            max_length=full_max_length,
+            padding="longest" if train_lengths is not None else "max_length",
+            concatenate=script_args.concatenated_forward,
         ),
+        train_lengths=train_lengths,
+        bucket_size=script_args.bucket_size,
+        max_tokens_per_batch=script_args.max_tokens_per_batch,
     )
 
     # Training
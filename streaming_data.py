@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Bounded memory streaming of pretraining corpora larger than RAM.
+
+StreamingPackedDataset reads the txt/json/jsonl files line by line, tokenizes a batch of documents at a time and
+packs the tokens into block_size sequences through a ring buffer, the remainder of a batch is carried to the next
+one instead of being dropped. The files, or the lines of the files if there are fewer files than workers, are split
+over the data loader workers, so `--dataloader_num_workers` processes read and tokenize in parallel.
+Memory is the ring buffer plus one batch of documents per worker, whatever the size of the corpus.
+
+With document_boundaries the position ids of a block restart at 0 at every document, flash attention takes them as
+sequence boundaries (varlen attention), and the first token of a document is not predicted from the previous one.
+
+usage:
+    python pretraining.py ... --train_file_dir data/pretrain --streaming True --max_steps 10000 \
+        --dataloader_num_workers 8
+"""
+import json
+from glob import glob
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import torch.utils.data
+from loguru import logger
+
+
+def list_data_files(file_dir: str) -> List[str]:
+    """txt, json and jsonl files under file_dir, all of the same type."""
+    files = sorted(sum([glob(f'{file_dir}/**/*.{ext}', recursive=True) for ext in ("txt", "json", "jsonl")], []))
+    types = [f.split('.')[-1] for f in files]
+    if len(set(t if t == "txt" else "json" for t in types)) > 1:
+        raise ValueError(f"data files must be same type, e.g. all txt or all jsonl, but got {types}")
+    return files
+
+
+def iter_documents(path: str, keep_linebreaks: bool = True, text_column: str = "text") -> Iterator[str]:
+    """Lazily yield the texts of a file, a line of txt or a record of jsonl, like the datasets text/json loaders."""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".txt"):
+            for line in f:
+                yield line if keep_linebreaks else line.rstrip("\n")
+            return
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == "[":
+            # A json array can not be read lazily, it is loaded at once
+            logger.warning(f"{path} is a json array and is loaded in memory, use jsonl for large files")
+            records = json.loads(first + f.read())
+        else:
+            records = (json.loads(line) for line in _prepend(first, f) if line.strip())
+        for record in records:
+            text = record.get(text_column)
+            if text is None:
+                text = next((v for v in record.values() if isinstance(v, str)), "")
+            yield text
+
+
+def _prepend(first: str, f) -> Iterator[str]:
+    yield first + f.readline()
+    yield from f
+
+
+def packed_position_ids(doc_starts: np.ndarray) -> np.ndarray:
+    """
+    Position ids of packed blocks, restarting at 0 at each document start and at the start of each block.
+    :param doc_starts: bool [num_blocks, block_size], True at the first token of a document
+    """
+    doc_starts = np.array(doc_starts, dtype=bool, ndmin=2)
+    doc_starts[:, 0] = True
+    positions = np.arange(doc_starts.shape[1])
+    return positions - np.maximum.accumulate(np.where(doc_starts, positions, 0), axis=1)
+
+
+def packed_labels(input_ids: np.ndarray, doc_starts: np.ndarray, ignore_index: int = -100) -> np.ndarray:
+    """Labels of packed blocks, the first token of a document is ignored, it follows an unrelated document."""
+    return np.where(doc_starts, ignore_index, input_ids)
+
+
+class TokenRingBuffer:
+    """Fixed capacity ring buffer of token ids, tokens are pushed at the tail and blocks popped at the head."""
+
+    def __init__(self, capacity: int):
+        self.data = np.zeros(capacity, dtype=np.int64)
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, tokens: np.ndarray) -> int:
+        """Append as many tokens as fit, return their number."""
+        n = min(len(tokens), self.capacity - self.size)
+        tail = (self.head + self.size) % self.capacity
+        first = min(n, self.capacity - tail)
+        self.data[tail: tail + first] = tokens[:first]
+        self.data[: n - first] = tokens[first:n]
+        self.size += n
+        return n
+
+    def pop(self, n: int) -> np.ndarray:
+        """Remove and return the n oldest tokens."""
+        first = min(n, self.capacity - self.head)
+        out = np.concatenate([self.data[self.head: self.head + first], self.data[: n - first]])
+        self.head = (self.head + n) % self.capacity
+        self.size -= n
+        return out
+
+
+class StreamingPackedDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset of block_size examples packed from the documents of text files, see the module docstring.
+    Each data loader worker keeps its own ring buffer, so only the last partial block of each worker is dropped.
+    """
+
+    def __init__(
+            self,
+            files: List[str],
+            tokenizer,
+            block_size: int,
+            tokenize_batch_size: int = 1000,
+            keep_linebreaks: bool = True,
+            holdout_every: Optional[int] = None,
+            holdout: bool = False,
+            max_blocks: Optional[int] = None,
+            buffer_blocks: int = 64,
+            document_boundaries: bool = False,
+            ignore_index: int = -100,
+    ):
+        """
+        :param files: txt or json/jsonl files, read in order
+        :param tokenizer: tokenizer, called on a batch of documents at a time
+        :param block_size: number of tokens of an example
+        :param tokenize_batch_size: number of documents per tokenizer call
+        :param keep_linebreaks: keep the line breaks of txt files
+        :param holdout_every: split off every holdout_every-th line of each file, used as validation data
+        :param holdout: yield only the held out lines instead of all other lines
+        :param max_blocks: stop after this many examples
+        :param buffer_blocks: capacity of the ring buffer in blocks
+        :param document_boundaries: yield position_ids restarting at each document instead of an attention_mask
+        :param ignore_index: label of the first token of each document with document_boundaries
+        """
+        super().__init__()
+        if not files:
+            raise ValueError("StreamingPackedDataset requires at least one data file")
+        self.files = files
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.tokenize_batch_size = tokenize_batch_size
+        self.keep_linebreaks = keep_linebreaks
+        self.holdout_every = holdout_every
+        self.holdout = holdout
+        self.max_blocks = max_blocks if max_blocks is not None and max_blocks > 0 else None
+        self.buffer_blocks = buffer_blocks
+        self.document_boundaries = document_boundaries
+        self.ignore_index = ignore_index
+
+    def _documents(self, worker_id: int, num_workers: int) -> Iterator[str]:
+        shard_files = len(self.files) >= num_workers
+        files = self.files[worker_id::num_workers] if shard_files else self.files
+        for path in files:
+            for i, text in enumerate(iter_documents(path, self.keep_linebreaks)):
+                if not shard_files and i % num_workers != worker_id:
+                    continue
+                if self.holdout_every and (i % self.holdout_every == 0) != self.holdout:
+                    continue
+                if text:
+                    yield text
+
+    def _batches(self, documents: Iterator[str]) -> Iterator[List[str]]:
+        batch = []
+        for text in documents:
+            batch.append(text)
+            if len(batch) == self.tokenize_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _example(self, input_ids: np.ndarray, doc_starts: np.ndarray) -> Dict[str, np.ndarray]:
+        if self.document_boundaries:
+            return {
+                "input_ids": input_ids,
+                "position_ids": packed_position_ids(doc_starts)[0],
+                "labels": packed_labels(input_ids, doc_starts, self.ignore_index),
+            }
+        return {"input_ids": input_ids, "attention_mask": np.ones_like(input_ids), "labels": input_ids.copy()}
+
+    def __iter__(self) -> Iterator[Dict[str, np.ndarray]]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        max_blocks = None
+        if self.max_blocks is not None:
+            max_blocks = self.max_blocks // num_workers + (worker_id < self.max_blocks % num_workers)
+        # Tokens and, in lockstep, 1 at the first token of each document
+        buffer = TokenRingBuffer(self.block_size * self.buffer_blocks)
+        starts = TokenRingBuffer(self.block_size * self.buffer_blocks)
+        num_blocks = 0
+        for texts in self._batches(self._documents(worker_id, num_workers)):
+            for ids in self.tokenizer(texts)["input_ids"]:
+                tokens = np.asarray(ids, dtype=np.int64)
+                doc_starts = np.zeros(len(tokens), dtype=np.int64)
+                doc_starts[:1] = 1
+                while len(tokens):
+                    n = buffer.push(tokens)
+                    starts.push(doc_starts[:n])
+                    tokens, doc_starts = tokens[n:], doc_starts[n:]
+                    while len(buffer) >= self.block_size:
+                        if max_blocks is not None and num_blocks >= max_blocks:
+                            return
+                        yield self._example(buffer.pop(self.block_size), starts.pop(self.block_size).astype(bool))
+                        num_blocks += 1
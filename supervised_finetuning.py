@@ -18,6 +18,7 @@ Fine-tuning the library models for causal language modeling (GPT, LLaMA, Bloom,
 part of code is modified from https://github.com/shibing624/textgen
 """
 
+import bisect
 import math
 import os
 import sys
@@ -26,6 +27,7 @@ from glob import glob
 from types import MethodType
 from typing import Literal, Optional, Tuple
 
+import numpy as np
 import torch
 import torch.utils.data
 from datasets import load_dataset
@@ -57,6 +59,10 @@ try:
 except ImportError:
     is_flash_attn_2_available = False
 
+from batch_samplers import LengthBucketSampler, TokenBudgetBatchSampler, build_token_budget_dataloader, get_lengths
+from data_shards import load_compiled_datasets
+from eval_metrics import TokenMetrics, preprocess_logits_for_metrics
+from packing import PackedDataCollator
 from template import get_conv_template
 
 
@@ -186,6 +192,10 @@ class DataArguments:
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    compiled_data_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Pre-tokenized data compiled by `python data_shards.py --stage sft`, skips tokenization."},
+    )
 
     def __post_init__(self):
         if self.max_train_samples is not None and 0 < self.max_train_samples <= 1000:
@@ -208,17 +218,263 @@ class ScriptArguments:
         metadata={"help": "Maximum model context length. suggest: 8192 * 4, 8192 * 2, 8192, 4096, 2048, 1024, 512"}
     )
     template_name: Optional[str] = field(default="vicuna", metadata={"help": "The prompt template name."})
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Whether to pack tokenized conversations into sequences of model_max_length, "
+                          "requires --flash_attn to keep attention within each conversation"}
+    )
+    packing_batch_size: int = field(
+        default=2000,
+        metadata={"help": "Number of conversations packed together, larger packs tighter"}
+    )
+    length_bucketing: bool = field(
+        default=False,
+        metadata={"help": "Whether to batch conversations of similar length together to reduce padding"}
+    )
+    bucket_size: int = field(
+        default=64,
+        metadata={"help": "Number of batches per length bucket, larger buckets pad less but shuffle less"}
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "Form length bucketed train batches by this budget of padded tokens instead of "
+                          "per_device_train_batch_size examples"}
+    )
 
     def __post_init__(self):
         if self.model_max_length < 60:
             raise ValueError("You must specify a valid model_max_length >= 60 to run training")
 
 
+def get_dialog(examples, prompt_template):
+    """Yield the dialog of each conversation, list of 2 * n texts where the 2k-th is a query with its prompt."""
+    roles = ["human", "gpt"]
+    system_prompts = examples.get("system_prompt", "")
+    for i, source in enumerate(examples['conversations']):
+        system_prompt = ""
+        if len(source) < 2:
+            continue
+        data_role = source[0].get("from", "")
+        if data_role == "system":
+            # Skip the first one if it is from system
+            system_prompt = source[0]["value"]
+            source = source[1:]
+            data_role = source[0].get("from", "")
+        if data_role not in roles or data_role != roles[0]:
+            # Skip the first one if it is not from human
+            source = source[1:]
+        if len(source) < 2:
+            continue
+        messages = []
+        for j, sentence in enumerate(source):
+            data_role = sentence.get("from", "")
+            if data_role not in roles:
+                logger.warning(f"unknown role: {data_role}, {i}. (ignored)")
+                break
+            if data_role == roles[j % 2]:
+                messages.append(sentence["value"])
+        if len(messages) % 2 != 0:
+            continue
+        # Convert the list to pairs of elements
+        history_messages = [[messages[k], messages[k + 1]] for k in range(0, len(messages), 2)]
+        if not system_prompt:
+            system_prompt = system_prompts[i] if system_prompts else ""
+        yield prompt_template.get_dialog(history_messages, system_prompt=system_prompt)
+
+
+def _truncate_turn(source_ids, target_ids, max_length: int, eos_token_id: int):
+    """Truncate a turn in proportion to the lengths of its source and target, drop eos tokens at the ends."""
+    total_len = len(source_ids) + len(target_ids)
+    max_source_len = int(max_length * (len(source_ids) / total_len))
+    max_target_len = int(max_length * (len(target_ids) / total_len))
+
+    if len(source_ids) > max_source_len:
+        source_ids = source_ids[:max_source_len]
+    if len(target_ids) > max_target_len - 1:  # eos token
+        target_ids = target_ids[:max_target_len - 1]
+    if len(source_ids) > 0 and source_ids[0] == eos_token_id:
+        source_ids = source_ids[1:]
+    if len(target_ids) > 0 and target_ids[-1] == eos_token_id:
+        target_ids = target_ids[:-1]
+    return source_ids, target_ids
+
+
+def preprocess_function(
+        examples,
+        tokenizer,
+        prompt_template,
+        max_length: int,
+        ignore_index: int = LabelSmoother.ignore_index,
+        train_on_inputs: bool = False,
+        batched_tokenize: Optional[bool] = None,
+):
+    """
+    Preprocessing the datasets.
+        part of code modified from https://github.com/lm-sys/FastChat
+    batched_tokenize: encode all turns of the batch in one call, see `preprocess_function_batched`,
+        default None is use it for fast tokenizers
+    """
+    if batched_tokenize is None:
+        batched_tokenize = getattr(tokenizer, "is_fast", False)
+    if batched_tokenize:
+        return preprocess_function_batched(examples, tokenizer, prompt_template, max_length, ignore_index,
+                                           train_on_inputs)
+    input_ids_list = []
+    attention_mask_list = []
+    targets_list = []
+    for dialog in get_dialog(examples, prompt_template):
+        input_ids, labels = [], []
+
+        for i in range(len(dialog) // 2):
+            source_ids = tokenizer.encode(text=dialog[2 * i], add_special_tokens=(i == 0))
+            target_ids = tokenizer.encode(text=dialog[2 * i + 1], add_special_tokens=False)
+            source_ids, target_ids = _truncate_turn(source_ids, target_ids, max_length, tokenizer.eos_token_id)
+            if len(input_ids) + len(source_ids) + len(target_ids) + 1 > max_length:
+                break
+
+            input_ids += source_ids + target_ids + [tokenizer.eos_token_id]  # add eos token for each turn
+            if train_on_inputs:
+                labels += source_ids + target_ids + [tokenizer.eos_token_id]
+            else:
+                labels += [ignore_index] * len(source_ids) + target_ids + [tokenizer.eos_token_id]
+
+        input_ids_list.append(input_ids)
+        attention_mask_list.append([1] * len(input_ids))
+        targets_list.append(labels)
+
+    return dict(
+        input_ids=input_ids_list,
+        attention_mask=attention_mask_list,
+        labels=targets_list,
+    )
+
+
+def preprocess_function_batched(
+        examples,
+        tokenizer,
+        prompt_template,
+        max_length: int,
+        ignore_index: int = LabelSmoother.ignore_index,
+        train_on_inputs: bool = False,
+):
+    """
+    Same output as `preprocess_function`, but every text of the batch is tokenized in two tokenizer calls,
+    first queries with special tokens and all other texts without, and each example is assembled with numpy.
+    """
+    dialogs = list(get_dialog(examples, prompt_template))
+    first_texts = [dialog[0] for dialog in dialogs]
+    other_texts = [text for dialog in dialogs for text in dialog[1:]]
+    first_ids = tokenizer(first_texts, add_special_tokens=True)["input_ids"] if first_texts else []
+    other_ids = tokenizer(other_texts, add_special_tokens=False)["input_ids"] if other_texts else []
+
+    eos_token_id = tokenizer.eos_token_id
+    input_ids_list = []
+    attention_mask_list = []
+    targets_list = []
+    pos = 0
+    for dialog, dialog_first_ids in zip(dialogs, first_ids):
+        # token ids of the dialog texts in order, the first query comes from the call with special tokens
+        texts_ids = [dialog_first_ids] + other_ids[pos:pos + len(dialog) - 1]
+        pos += len(dialog) - 1
+        pieces, source_mask, length = [], [], 0
+        for i in range(len(dialog) // 2):
+            source_ids, target_ids = _truncate_turn(texts_ids[2 * i], texts_ids[2 * i + 1], max_length, eos_token_id)
+            if length + len(source_ids) + len(target_ids) + 1 > max_length:
+                break
+            pieces += [source_ids, target_ids, [eos_token_id]]
+            source_mask.append((length, length + len(source_ids)))
+            length += len(source_ids) + len(target_ids) + 1
+        # Each piece is converted in one call, no Python loop over the tokens
+        input_ids = np.concatenate([np.asarray(piece, dtype=np.int64) for piece in pieces] or [np.zeros(0, np.int64)])
+        labels = input_ids.copy()
+        if not train_on_inputs:
+            for start, end in source_mask:
+                labels[start:end] = ignore_index
+        input_ids_list.append(input_ids)
+        attention_mask_list.append(np.ones(length, dtype=np.int64))
+        targets_list.append(labels)
+
+    return dict(
+        input_ids=input_ids_list,
+        attention_mask=attention_mask_list,
+        labels=targets_list,
+    )
+
+
+def pack_examples(examples, max_length: int, ignore_index: int):
+    """
+    Pack tokenized examples into sequences of at most max_length tokens with best-fit decreasing bin packing.
+    Position ids restart at 0 for each example, flash attention uses them as sequence boundaries. The first
+    label of each example is ignored, it would be predicted from the last token of the previous example.
+    """
+    lengths = [len(ids) for ids in examples["input_ids"]]
+    # Sorted (remaining capacity, bin index) of open bins
+    capacities = []
+    bins = []
+    for i in sorted(range(len(lengths)), key=lambda x: -lengths[x]):
+        pos = bisect.bisect_left(capacities, (lengths[i], -1))
+        if pos < len(capacities):
+            remaining, bin_idx = capacities.pop(pos)
+        else:
+            remaining, bin_idx = max_length, len(bins)
+            bins.append([])
+        bins[bin_idx].append(i)
+        bisect.insort(capacities, (remaining - lengths[i], bin_idx))
+
+    input_ids_list, labels_list, position_ids_list = [], [], []
+    for bin_examples in bins:
+        input_ids, labels, position_ids = [], [], []
+        for i in bin_examples:
+            input_ids += examples["input_ids"][i]
+            labels += [ignore_index] + list(examples["labels"][i][1:])
+            position_ids += list(range(lengths[i]))
+        input_ids_list.append(input_ids)
+        labels_list.append(labels)
+        position_ids_list.append(position_ids)
+    return dict(input_ids=input_ids_list, labels=labels_list, position_ids=position_ids_list)
+
+
 class SavePeftModelTrainer(Trainer):
     """
     Trainer for lora models
     """
 
+    def __init__(self, *args, train_lengths=None, bucket_size=64, max_tokens_per_batch=None, **kwargs):
+        """
+        :param train_lengths: lengths of the train examples, batch examples of similar length if set
+        :param bucket_size: number of batches per length bucket
+        :param max_tokens_per_batch: cut the length buckets by this budget of padded tokens
+        """
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+        self.bucket_size = bucket_size
+        self.max_tokens_per_batch = max_tokens_per_batch
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthBucketSampler(
+            self.train_lengths,
+            batch_size=self._train_batch_size,
+            bucket_size=self.bucket_size,
+            seed=self.args.seed,
+            log_padding=self.is_world_process_zero(),
+        )
+
+    def get_train_dataloader(self):
+        if self.train_lengths is None or self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        batch_sampler = TokenBudgetBatchSampler(
+            self.train_lengths,
+            max_tokens=self.max_tokens_per_batch,
+            bucket_size=self.bucket_size,
+            seed=self.args.seed,
+            log_padding=self.is_world_process_zero(),
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+        return build_token_budget_dataloader(self, batch_sampler)
+
     def save_model(self, output_dir=None, _internal_call=False):
         """Save the LoRA model."""
         os.makedirs(output_dir, exist_ok=True)
@@ -315,6 +571,11 @@ def main():
             + f" distributed training: {bool(training_args.local_rank != -1)}, 16-bits training: {training_args.fp16}"
         )
 
+    if script_args.packing and not (model_args.flash_attn and is_flash_attn_2_available):
+        # Without varlen flash attention the packed conversations of a sequence would attend to each other
+        raise ValueError("--packing requires FlashAttention-2, set `--flash_attn True` and install flash-attn, "
+                         "or disable --packing.")
+
     # Set seed before initializing model.
     set_seed(training_args.seed)
 
@@ -348,7 +609,16 @@ def main():
     IGNORE_INDEX = LabelSmoother.ignore_index if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id
 
     # Get datasets
-    if data_args.dataset_name is not None:
+    if data_args.compiled_data_dir is not None:
+        raw_datasets = load_compiled_datasets(
+            data_args.compiled_data_dir, tokenizer, stage="sft", template_name=script_args.template_name,
+            ignore_index=IGNORE_INDEX, max_length=script_args.model_max_length,
+        )
+        compiled_packing = next(iter(raw_datasets.values())).meta["packing"]
+        if compiled_packing != script_args.packing:
+            raise ValueError(f"Compiled data of {data_args.compiled_data_dir} has packing={compiled_packing}, "
+                             f"compile it with the same --packing as training")
+    elif data_args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         raw_datasets = load_dataset(
             data_args.dataset_name,
@@ -396,87 +666,13 @@ def main():
 
     # Preprocessing the datasets
     max_length = script_args.model_max_length
-
-    def preprocess_function(examples):
-        """
-        Preprocessing the datasets.
-            part of code modified from https://github.com/lm-sys/FastChat
-        """
-        input_ids_list = []
-        attention_mask_list = []
-        targets_list = []
-        roles = ["human", "gpt"]
-
-        def get_dialog(examples):
-            system_prompts = examples.get("system_prompt", "")
-            for i, source in enumerate(examples['conversations']):
-                system_prompt = ""
-                if len(source) < 2:
-                    continue
-                data_role = source[0].get("from", "")
-                if data_role == "system":
-                    # Skip the first one if it is from system
-                    system_prompt = source[0]["value"]
-                    source = source[1:]
-                    data_role = source[0].get("from", "")
-                if data_role not in roles or data_role != roles[0]:
-                    # Skip the first one if it is not from human
-                    source = source[1:]
-                if len(source) < 2:
-                    continue
-                messages = []
-                for j, sentence in enumerate(source):
-                    data_role = sentence.get("from", "")
-                    if data_role not in roles:
-                        logger.warning(f"unknown role: {data_role}, {i}. (ignored)")
-                        break
-                    if data_role == roles[j % 2]:
-                        messages.append(sentence["value"])
-                if len(messages) % 2 != 0:
-                    continue
-                # Convert the list to pairs of elements
-                history_messages = [[messages[k], messages[k + 1]] for k in range(0, len(messages), 2)]
-                if not system_prompt:
-                    system_prompt = system_prompts[i] if system_prompts else ""
-                yield prompt_template.get_dialog(history_messages, system_prompt=system_prompt)
-
-        for dialog in get_dialog(examples):
-            input_ids, labels = [], []
-
-            for i in range(len(dialog) // 2):
-                source_ids = tokenizer.encode(text=dialog[2 * i], add_special_tokens=(i == 0))
-                target_ids = tokenizer.encode(text=dialog[2 * i + 1], add_special_tokens=False)
-
-                total_len = len(source_ids) + len(target_ids)
-                max_source_len = int(max_length * (len(source_ids) / total_len))
-                max_target_len = int(max_length * (len(target_ids) / total_len))
-
-                if len(source_ids) > max_source_len:
-                    source_ids = source_ids[:max_source_len]
-                if len(target_ids) > max_target_len - 1:  # eos token
-                    target_ids = target_ids[:max_target_len - 1]
-                if len(source_ids) > 0 and source_ids[0] == tokenizer.eos_token_id:
-                    source_ids = source_ids[1:]
-                if len(target_ids) > 0 and target_ids[-1] == tokenizer.eos_token_id:
-                    target_ids = target_ids[:-1]
-                if len(input_ids) + len(source_ids) + len(target_ids) + 1 > max_length:
-                    break
-
-                input_ids += source_ids + target_ids + [tokenizer.eos_token_id]  # add eos token for each turn
-                if script_args.train_on_inputs:
-                    labels += source_ids + target_ids + [tokenizer.eos_token_id]
-                else:
-                    labels += [IGNORE_INDEX] * len(source_ids) + target_ids + [tokenizer.eos_token_id]
-
-            input_ids_list.append(input_ids)
-            attention_mask_list.append([1] * len(input_ids))
-            targets_list.append(labels)
-
-        return dict(
-            input_ids=input_ids_list,
-            attention_mask=attention_mask_list,
-            labels=targets_list,
-        )
+    preprocess_kwargs = {
+        "tokenizer": tokenizer,
+        "prompt_template": prompt_template,
+        "max_length": max_length,
+        "ignore_index": IGNORE_INDEX,
+        "train_on_inputs": script_args.train_on_inputs,
+    }
 
     def filter_empty_labels(example):
         """Remove empty labels dataset."""
@@ -487,7 +683,9 @@ def main():
     if training_args.do_train:
         if "train" not in raw_datasets:
             raise ValueError("--do_train requires a train dataset")
-        train_dataset = raw_datasets['train'].shuffle(seed=42)
+        train_dataset = raw_datasets['train']
+        if data_args.compiled_data_dir is None:
+            train_dataset = train_dataset.shuffle(seed=42)
         max_train_samples = len(train_dataset)
         if data_args.max_train_samples is not None and data_args.max_train_samples > 0:
             max_train_samples = min(len(train_dataset), data_args.max_train_samples)
@@ -497,18 +695,37 @@ def main():
             logger.debug(f"Example train_dataset[0]: {train_dataset[0]}")
 
         with training_args.main_process_first(desc="Train dataset tokenization"):
-            tokenized_dataset = train_dataset.map(
-                preprocess_function,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                remove_columns=train_dataset.column_names,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on dataset" if is_main_process else None,
-            )
-            train_dataset = tokenized_dataset.filter(
-                filter_empty_labels,
-                num_proc=data_args.preprocessing_num_workers
-            )
+            if data_args.compiled_data_dir is None:
+                tokenized_dataset = train_dataset.map(
+                    preprocess_function,
+                    batched=True,
+                    num_proc=data_args.preprocessing_num_workers,
+                    fn_kwargs=preprocess_kwargs,
+                    remove_columns=train_dataset.column_names,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    desc="Running tokenizer on dataset" if is_main_process else None,
+                )
+                train_dataset = tokenized_dataset.filter(
+                    filter_empty_labels,
+                    num_proc=data_args.preprocessing_num_workers
+                )
+
+                if script_args.packing:
+                    num_train_samples = len(train_dataset)
+                    train_dataset = train_dataset.map(
+                        pack_examples,
+                        batched=True,
+                        batch_size=script_args.packing_batch_size,
+                        num_proc=data_args.preprocessing_num_workers,
+                        remove_columns=train_dataset.column_names,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        fn_kwargs={"max_length": max_length, "ignore_index": IGNORE_INDEX},
+                        desc="Packing dataset" if is_main_process else None,
+                    )
+                    if is_main_process:
+                        num_tokens = sum(len(x) for x in train_dataset["position_ids"])
+                        logger.info(f"Packed {num_train_samples} samples into {len(train_dataset)} sequences, "
+                                    f"token fill ratio: {num_tokens / (len(train_dataset) * max_length):.2%}")
 
             if is_main_process:
                 logger.debug(f"Num train_samples: {len(train_dataset)}")
@@ -532,18 +749,20 @@ def main():
             eval_size = len(eval_dataset)
             logger.debug(f"Num eval_samples: {eval_size}")
             if eval_size > 500:
-                logger.warning(f"Num eval_samples is large: {eval_size}, "
-                               f"training slow, consider reduce it by `--max_eval_samples=50`")
+                logger.warning(f"Num eval_samples is large: {eval_size}, each evaluation takes longer, "
+                               f"reduce it by `--max_eval_samples` if needed")
             logger.debug(f"Example eval_dataset[0]: {eval_dataset[0]}")
-            eval_dataset = eval_dataset.map(
-                preprocess_function,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                remove_columns=eval_dataset.column_names,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on validation dataset",
-            )
-            eval_dataset = eval_dataset.filter(filter_empty_labels, num_proc=data_args.preprocessing_num_workers)
+            if data_args.compiled_data_dir is None:
+                eval_dataset = eval_dataset.map(
+                    preprocess_function,
+                    batched=True,
+                    num_proc=data_args.preprocessing_num_workers,
+                    fn_kwargs=preprocess_kwargs,
+                    remove_columns=eval_dataset.column_names,
+                    load_from_cache_file=not data_args.overwrite_cache,
+                    desc="Running tokenizer on validation dataset",
+                )
+                eval_dataset = eval_dataset.filter(filter_empty_labels, num_proc=data_args.preprocessing_num_workers)
             logger.debug(f"Num eval_samples: {len(eval_dataset)}")
             logger.debug("Tokenized eval example:")
             logger.debug(tokenizer.decode(eval_dataset[0]['input_ids']))
@@ -748,7 +967,22 @@ def main():
         label_pad_token_id=IGNORE_INDEX,
         pad_to_multiple_of=4 if tokenizer.padding_side == "right" else None,  # for shifted sparse attention
     )
+    if script_args.packing:
+        data_collator = PackedDataCollator(
+            pad_token_id=tokenizer.pad_token_id,
+            label_pad_token_id=IGNORE_INDEX,
+            unpacked_collator=data_collator,
+        )
+    train_lengths = None
+    if (script_args.length_bucketing or script_args.max_tokens_per_batch) and training_args.do_train:
+        train_lengths = get_lengths(train_dataset, ["input_ids"])
+    if script_args.max_tokens_per_batch and hasattr(training_args, "average_tokens_across_devices"):
+        # Batches of different devices hold different numbers of tokens, normalize the loss by the global count
+        training_args.average_tokens_across_devices = True
     # Initialize our Trainer
+    if training_args.do_eval and not training_args.batch_eval_metrics:
+        # Token metrics are accumulated step by step, eval predictions and labels are not kept on the host
+        training_args.batch_eval_metrics = True
     trainer = SavePeftModelTrainer(
         model=model,
         args=training_args,
@@ -756,7 +990,15 @@ def main():
         eval_dataset=eval_dataset if training_args.do_eval else None,
         tokenizer=tokenizer,
         data_collator=data_collator,
+        compute_metrics=TokenMetrics() if training_args.do_eval else None,
+        preprocess_logits_for_metrics=preprocess_logits_for_metrics if training_args.do_eval else None,
+        train_lengths=train_lengths,
+        bucket_size=script_args.bucket_size,
+        max_tokens_per_batch=script_args.max_tokens_per_batch,
     )
+    if script_args.max_tokens_per_batch and not trainer.model_accepts_loss_kwargs:
+        logger.warning("The model does not take num_items_in_batch, the loss of each micro batch is averaged "
+                       "on its own and token budget batches of different sizes are weighted equally.")
 
     # Training
     if training_args.do_train:
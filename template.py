@@ -4,7 +4,10 @@
 @description: 
 """
 
-from dataclasses import dataclass
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from typing import Optional, List, Dict, Sequence
 
 __all__ = ['Conversation', 'register_conv_template', 'get_conv_template']
@@ -28,6 +31,12 @@ class Conversation:
     sep: str
     # Stop token, default is tokenizer.eos_token
     stop_str: Optional[str] = "</s>"
+    # Max number of tokenized turns kept by get_prompt_ids, per tokenizer
+    max_cached_turns: int = 4096
+    # Token ids of tokenized turns per tokenizer, dropped with the tokenizer, key: (turn text, add_special_tokens)
+    _token_caches: weakref.WeakKeyDictionary = field(
+        default_factory=weakref.WeakKeyDictionary, repr=False, compare=False)
+    _token_cache_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
     def get_prompt(
             self,
@@ -49,6 +58,47 @@ class Conversation:
         """
         return self._format_example(messages, system_prompt)
 
+    def get_prompt_ids(
+            self,
+            tokenizer,
+            messages: Optional[List[Sequence[str]]] = None,
+            system_prompt: Optional[str] = ""
+    ) -> List[int]:
+        """
+        Returns token ids of the prompt without response, built like the SFT training data: each query and
+        response is tokenized on its own, and every answered turn ends with the eos token. Token ids of every turn
+        are cached, so a growing conversation only tokenizes the newly appended turn.
+        """
+        eos_token_id = tokenizer.eos_token_id
+        input_ids = []
+        for i, text in enumerate(self._format_example(messages, system_prompt)):
+            if not text:
+                continue
+            ids = self._encode(tokenizer, text, add_special_tokens=(i == 0))
+            if i % 2 == 0:
+                # Like the SFT truncation, an eos at the start of a query or the end of a response is dropped
+                input_ids += ids[1:] if ids and ids[0] == eos_token_id else ids
+            else:
+                input_ids += ids[:-1] if ids and ids[-1] == eos_token_id else ids
+                if eos_token_id is not None:
+                    input_ids.append(eos_token_id)
+        return input_ids
+
+    def _encode(self, tokenizer, text: str, add_special_tokens: bool) -> List[int]:
+        key = (text, add_special_tokens)
+        with self._token_cache_lock:
+            cache = self._token_caches.setdefault(tokenizer, OrderedDict())
+            ids = cache.get(key)
+            if ids is not None:
+                cache.move_to_end(key)
+                return ids
+        ids = tokenizer.encode(text, add_special_tokens=add_special_tokens)
+        with self._token_cache_lock:
+            cache[key] = ids
+            while len(cache) > self.max_cached_turns:
+                cache.popitem(last=False)
+        return ids
+
     def _format_example(
             self,
             messages: Optional[List[Sequence[str]]] = None,
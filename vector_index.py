@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+"""
+@author:XuMing(xuming624@qq.com)
+@description: Vector index for dense retrieval, exhaustive (flat) and inverted file (IVF) search with numpy.
+
+Vectors are L2 normalized, the score is the inner product, i.e. cosine similarity. IVF clusters the corpus with
+k-means and stores the vectors of each cluster contiguously, a query only scans the `nprobe` clusters closest to
+it. Vectors added later are appended to the lists of their clusters, k-means is trained again when the corpus has
+outgrown the number of clusters. Indexes are saved as .npy files and loaded memory-mapped, so opening a large index
+does not read it. TextStore keeps the texts of the indexed chunks the same way, in one memory-mapped file.
+
+usage:
+    # recall@k and latency of IVF vs exhaustive search on random clustered vectors
+    python vector_index.py --num_vectors 1000000 --dim 256 --topk 10
+    # the same with the IVF index grown by 100 adds, like incremental ingestion
+    python vector_index.py --num_vectors 1000000 --dim 256 --topk 10 --num_adds 100
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores of a 1-D array, sorted by score."""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class FlatIndex:
+    """Exhaustive inner product search."""
+    index_type = "flat"
+
+    def __init__(self, dim: int, dtype: str = "float32"):
+        """
+        Init flat index.
+        :param dim: vector dimension
+        :param dtype: storage dtype, float16 halves the memory at a small cost of precision
+        """
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.vectors = np.zeros((0, dim), dtype=self.dtype)
+        self.ids = np.zeros((0,), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        """Add normalized vectors with their int ids."""
+        self.vectors = np.concatenate([self.vectors, np.asarray(vectors, dtype=self.dtype)])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+
+    def remove_ids(self, ids: np.ndarray):
+        """Remove the vectors of the given ids."""
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.vectors = np.asarray(self.vectors)[keep]
+        self.ids = self.ids[keep]
+
+    def search(self, queries: np.ndarray, topk: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search the topk most similar vectors of each query.
+        :param queries: normalized query vectors, [num_queries, dim]
+        :param topk: number of results per query
+        :return: scores and ids, both [num_queries, topk], padded with -inf and -1 if the index is smaller
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        all_scores = np.full((len(queries), topk), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), topk), -1, dtype=np.int64)
+        if not len(self):
+            return all_scores, all_ids
+        scores = queries @ self.vectors.T.astype(np.float32, copy=False)
+        for i, row in enumerate(scores):
+            idx = _topk(row, topk)
+            all_scores[i, :len(idx)] = row[idx]
+            all_ids[i, :len(idx)] = self.ids[idx]
+        return all_scores, all_ids
+
+    def _meta(self) -> dict:
+        return {"index_type": self.index_type, "dim": self.dim, "dtype": self.dtype.name, "ntotal": len(self)}
+
+    def _save_meta(self, index_dir: str):
+        with open(os.path.join(index_dir, "index_meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self._meta(), f, ensure_ascii=False, indent=2)
+
+    def save(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "vectors.npy"), self.vectors)
+        np.save(os.path.join(index_dir, "ids.npy"), self.ids)
+        self._save_meta(index_dir)
+
+    @classmethod
+    def _load(cls, index_dir: str, meta: dict, mmap: bool):
+        index = cls(meta["dim"], dtype=meta["dtype"])
+        index.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r" if mmap else None)
+        index.ids = np.load(os.path.join(index_dir, "ids.npy"))
+        return index
+
+
+class IVFIndex(FlatIndex):
+    """
+    Inverted file index: k-means clusters with the vectors of each cluster stored contiguously.
+    Vectors added after the clusters are trained go to per cluster lists, removed vectors keep their row with id -1,
+    save writes every cluster contiguously again. k-means is trained again once the index has grown to twice the
+    number of clusters it asks for, so the clusters scanned per query stay small as the corpus grows.
+    """
+    index_type = "ivf"
+
+    def __init__(
+            self,
+            dim: int,
+            nlist: Optional[int] = None,
+            nprobe: int = 16,
+            dtype: str = "float32",
+            kmeans_iters: int = 10,
+            seed: int = 42,
+    ):
+        """
+        Init ivf index.
+        :param dim: vector dimension
+        :param nlist: number of clusters, default None, 4 * sqrt(number of vectors) when the index is built
+        :param nprobe: number of clusters scanned per query, higher is more accurate and slower
+        :param dtype: storage dtype, float16 halves the memory at a small cost of precision
+        :param kmeans_iters: k-means iterations
+        :param seed: random seed of k-means
+        """
+        super().__init__(dim, dtype=dtype)
+        self.target_nlist = nlist
+        self.nlist = None
+        self.nprobe = nprobe
+        self.kmeans_iters = kmeans_iters
+        self.seed = seed
+        self.centroids = None
+        # vectors and ids are sorted by cluster, cluster i is [offsets[i], offsets[i + 1])
+        self.offsets = None
+        self.num_removed = 0
+        # cluster -> (vectors, ids) added since the clusters were laid out
+        self.appended = {}
+        self._pending_vectors = []
+        self._pending_ids = []
+
+    def __len__(self):
+        return (len(self.ids) - self.num_removed + sum(len(x[1]) for x in self.appended.values())
+                + sum(len(x) for x in self._pending_ids))
+
+    def _wanted_nlist(self, num_vectors: int) -> int:
+        return max(1, min(self.target_nlist or int(4 * np.sqrt(num_vectors)), num_vectors))
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        """Add normalized vectors with their int ids, they are assigned to clusters on the next search."""
+        self._pending_vectors.append(np.asarray(vectors, dtype=np.float32))
+        self._pending_ids.append(np.asarray(ids, dtype=np.int64))
+
+    def remove_ids(self, ids: np.ndarray):
+        """Remove the vectors of the given ids, rows of the clusters are marked with id -1 until the next save."""
+        ids = np.asarray(ids, dtype=np.int64)
+        for i, pending_ids in enumerate(self._pending_ids):
+            keep = ~np.isin(pending_ids, ids)
+            self._pending_vectors[i], self._pending_ids[i] = self._pending_vectors[i][keep], pending_ids[keep]
+        for c, (vectors, cluster_ids) in list(self.appended.items()):
+            keep = ~np.isin(cluster_ids, ids)
+            self.appended[c] = (vectors[keep], cluster_ids[keep])
+        removed = np.isin(self.ids, ids) & (self.ids >= 0)
+        if removed.any():
+            if not self.ids.flags.writeable:
+                self.ids = self.ids.copy()
+            self.ids[removed] = -1
+            self.num_removed += int(removed.sum())
+
+    def _assign(self, vectors: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+            labels[start:start + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return labels
+
+    def train(self, vectors: np.ndarray):
+        """Spherical k-means on a sample of the vectors."""
+        rng = np.random.default_rng(self.seed)
+        nlist = self._wanted_nlist(len(vectors))
+        # 64 points per cluster are plenty to place the centroids
+        sample_size = min(len(vectors), nlist * 64)
+        sample = np.asarray(vectors[rng.choice(len(vectors), sample_size, replace=False)], dtype=np.float32)
+        self.centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            labels = self._assign(sample)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            # Sum the points of each cluster as contiguous segments of the sample sorted by cluster
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(self.centroids)
+            sums[~empty] = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts[~empty], axis=0)
+            # Restart empty clusters from random points
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            self.centroids = normalize(sums)
+        self.nlist = nlist
+
+    def _live_clusters(self):
+        """Yield (cluster, vectors, ids) of the laid out and appended vectors of each cluster, without removed rows."""
+        for c in range(self.nlist):
+            start, end = self.offsets[c], self.offsets[c + 1]
+            vectors, ids = self.vectors[start:end], self.ids[start:end]
+            if self.num_removed:
+                live = ids >= 0
+                vectors, ids = vectors[live], ids[live]
+            if c in self.appended:
+                appended_vectors, appended_ids = self.appended[c]
+                vectors = np.concatenate([np.asarray(vectors, dtype=self.dtype), appended_vectors])
+                ids = np.concatenate([ids, appended_ids])
+            yield c, vectors, ids
+
+    def _retrain(self, new_vectors: np.ndarray, new_ids: np.ndarray):
+        """Train k-means on all vectors and lay out the clusters again."""
+        vectors, ids = [new_vectors], [new_ids]
+        if self.centroids is not None:
+            for _, cluster_vectors, cluster_ids in self._live_clusters():
+                vectors.append(np.asarray(cluster_vectors, dtype=np.float32))
+                ids.append(cluster_ids)
+        vectors, ids = np.concatenate(vectors), np.concatenate(ids)
+        old_nlist = self.nlist
+        self.train(vectors)
+        labels = self._assign(vectors)
+        order = np.argsort(labels, kind="stable")
+        self.vectors = vectors[order].astype(self.dtype)
+        self.ids = ids[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.nlist))]).astype(np.int64)
+        self.appended, self.num_removed = {}, 0
+        logger.debug(f"Trained ivf index on {len(ids)} vectors, nlist: {old_nlist} -> {self.nlist}")
+
+    def build(self):
+        """
+        Assign pending vectors to clusters, appended to the lists of their clusters, the clusters are trained
+        again on all vectors once the index has grown to twice the nlist they were trained with.
+        """
+        new_vectors = np.concatenate(self._pending_vectors) if self._pending_vectors else None
+        new_ids = np.concatenate(self._pending_ids) if self._pending_ids else np.zeros(0, dtype=np.int64)
+        self._pending_vectors, self._pending_ids = [], []
+        if not len(new_ids):
+            return
+        if self.centroids is None or self._wanted_nlist(len(self) + len(new_ids)) >= 2 * self.nlist:
+            self._retrain(new_vectors, new_ids)
+            return
+        labels = self._assign(new_vectors)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=self.nlist)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        for c in np.nonzero(counts)[0]:
+            idx = order[starts[c]:starts[c + 1]]
+            vectors, ids = new_vectors[idx].astype(self.dtype), new_ids[idx]
+            if c in self.appended:
+                vectors = np.concatenate([self.appended[c][0], vectors])
+                ids = np.concatenate([self.appended[c][1], ids])
+            self.appended[int(c)] = (vectors, ids)
+
+    def search(self, queries: np.ndarray, topk: int = 10, nprobe: Optional[int] = None):
+        """
+        Search the topk most similar vectors of each query in its nprobe closest clusters.
+        :param queries: normalized query vectors, [num_queries, dim]
+        :param topk: number of results per query
+        :param nprobe: number of clusters scanned per query, default self.nprobe
+        :return: scores and ids, both [num_queries, topk], padded with -inf and -1 if fewer are found
+        """
+        self.build()
+        queries = np.asarray(queries, dtype=np.float32)
+        all_scores = np.full((len(queries), topk), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), topk), -1, dtype=np.int64)
+        if self.centroids is None:
+            return all_scores, all_ids
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        centroid_scores = queries @ self.centroids.T
+        for i, query in enumerate(queries):
+            probe = _topk(centroid_scores[i], nprobe)
+            scores, ids = [], []
+            for c in probe:
+                start, end = self.offsets[c], self.offsets[c + 1]
+                if start < end:
+                    scores.append(np.asarray(self.vectors[start:end], dtype=np.float32) @ query)
+                    ids.append(self.ids[start:end])
+                if c in self.appended:
+                    scores.append(self.appended[c][0].astype(np.float32, copy=False) @ query)
+                    ids.append(self.appended[c][1])
+            if not scores:
+                continue
+            scores, ids = np.concatenate(scores), np.concatenate(ids)
+            if self.num_removed:
+                scores[ids < 0] = -np.inf
+            idx = _topk(scores, topk)
+            idx = idx[ids[idx] >= 0]
+            all_scores[i, :len(idx)] = scores[idx]
+            all_ids[i, :len(idx)] = ids[idx]
+        return all_scores, all_ids
+
+    def _meta(self) -> dict:
+        meta = super()._meta()
+        meta.update({"nlist": self.nlist, "target_nlist": self.target_nlist, "nprobe": self.nprobe})
+        return meta
+
+    def save(self, index_dir: str):
+        """
+        Save the clusters laid out contiguously, written cluster by cluster, so a memory-mapped index is not read in
+        memory at once. The index then memory-maps the saved vectors.
+        """
+        self.build()
+        if self.centroids is None:
+            super().save(index_dir)
+            return
+        os.makedirs(index_dir, exist_ok=True)
+        vectors_path = os.path.join(index_dir, "vectors.npy")
+        tmp_path = os.path.join(index_dir, "vectors.tmp.npy")
+        ids, counts, pos = [], np.zeros(self.nlist, dtype=np.int64), 0
+        if len(self):
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(len(self), self.dim))
+            for c, vectors, cluster_ids in self._live_clusters():
+                out[pos:pos + len(cluster_ids)] = vectors
+                ids.append(cluster_ids)
+                counts[c] = len(cluster_ids)
+                pos += len(cluster_ids)
+            out.flush()
+            del out
+        else:
+            np.save(tmp_path, np.zeros((0, self.dim), dtype=self.dtype))
+        os.replace(tmp_path, vectors_path)
+        self.ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.vectors = np.load(vectors_path, mmap_mode="r")
+        self.appended, self.num_removed = {}, 0
+        np.save(os.path.join(index_dir, "ids.npy"), self.ids)
+        np.save(os.path.join(index_dir, "centroids.npy"), self.centroids)
+        np.save(os.path.join(index_dir, "offsets.npy"), self.offsets)
+        self._save_meta(index_dir)
+
+    @classmethod
+    def _load(cls, index_dir: str, meta: dict, mmap: bool):
+        index = cls(meta["dim"], nlist=meta.get("target_nlist", meta["nlist"]), nprobe=meta["nprobe"],
+                    dtype=meta["dtype"])
+        if os.path.exists(os.path.join(index_dir, "centroids.npy")):
+            index.nlist = meta["nlist"]
+            index.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r" if mmap else None)
+            index.ids = np.load(os.path.join(index_dir, "ids.npy"))
+            index.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+            index.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        return index
+
+
+INDEX_CLASSES = {"flat": FlatIndex, "ivf": IVFIndex}
+
+
+def create_index(index_type: str, dim: int, **kwargs) -> FlatIndex:
+    if index_type not in INDEX_CLASSES:
+        raise ValueError(f"Unknown index type: {index_type}, must be one of {list(INDEX_CLASSES)}")
+    return INDEX_CLASSES[index_type](dim, **kwargs)
+
+
+def load_index(index_dir: str, mmap: bool = True) -> FlatIndex:
+    """Load an index saved by `index.save(index_dir)`, vectors are memory-mapped by default."""
+    with open(os.path.join(index_dir, "index_meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return INDEX_CLASSES[meta["index_type"]]._load(index_dir, meta, mmap)
+
+
+def _text_hashes(encoded) -> np.ndarray:
+    """64-bit hashes of utf-8 texts, to find duplicate texts without keeping the texts as Python objects."""
+    return np.fromiter((int.from_bytes(hashlib.md5(b).digest()[:8], "little") for b in encoded),
+                       dtype=np.uint64, count=len(encoded))
+
+
+class TextStore:
+    """
+    Texts keyed by int id with the mapping interface of a dict, stored as utf-8 bytes in one append-only file and
+    located through id sorted numpy arrays of offsets. Saved texts are memory-mapped, a text is decoded when it is
+    read, so a corpus of millions of chunks is not held in Python strings. Removed texts leave their bytes in the
+    file until a save finds more removed than live bytes and rewrites it.
+    """
+    data_name = "texts.bin"
+    offsets_name = "text_offsets.npy"
+
+    def __init__(self):
+        # ids sorted, the text of ids[i] is bytes [starts[i], ends[i]) of saved data followed by tail
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.data = np.zeros(0, dtype=np.uint8)
+        self.data_path = None
+        self.tail = bytearray()
+        self._pending = []
+
+    def _size(self) -> int:
+        return len(self.data) + len(self.tail)
+
+    def _merge(self):
+        """Merge the pending texts into the sorted arrays, a later text of an id replaces the earlier one."""
+        if not self._pending:
+            return
+        columns = [np.concatenate([c] + [p[i] for p in self._pending])
+                   for i, c in enumerate((self.ids, self.starts, self.ends, self.hashes))]
+        self._pending = []
+        order = np.argsort(columns[0], kind="stable")
+        ids = columns[0][order]
+        last = np.append(ids[1:] != ids[:-1], True)
+        self.ids, self.starts, self.ends, self.hashes = (c[order][last] for c in columns)
+
+    def update(self, texts: Dict[int, str]):
+        """Add texts by id."""
+        if not texts:
+            return
+        encoded = [t.encode("utf-8") for t in texts.values()]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        ends = self._size() + np.cumsum(lengths)
+        self.tail += b"".join(encoded)
+        ids = np.fromiter(texts.keys(), dtype=np.int64, count=len(texts))
+        self._pending.append((ids, ends - lengths, ends, _text_hashes(encoded)))
+
+    def remove(self, ids):
+        """Remove the texts of the given ids."""
+        self._merge()
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.ids, self.starts, self.ends, self.hashes = (c[keep] for c in (self.ids, self.starts, self.ends,
+                                                                           self.hashes))
+
+    def _find(self, corpus_id) -> int:
+        self._merge()
+        i = int(np.searchsorted(self.ids, corpus_id))
+        return i if i < len(self.ids) and self.ids[i] == corpus_id else -1
+
+    def _bytes(self, start: int, end: int) -> bytes:
+        n = len(self.data)
+        if end <= n:
+            return self.data[start:end].tobytes()
+        return self.data[start:].tobytes() + bytes(self.tail[max(start - n, 0):end - n])
+
+    def _text(self, start: int, end: int) -> str:
+        return self._bytes(start, end).decode("utf-8")
+
+    def __getitem__(self, corpus_id) -> str:
+        i = self._find(corpus_id)
+        if i < 0:
+            raise KeyError(corpus_id)
+        return self._text(self.starts[i], self.ends[i])
+
+    def __delitem__(self, corpus_id):
+        if self._find(corpus_id) < 0:
+            raise KeyError(corpus_id)
+        self.remove([corpus_id])
+
+    def __contains__(self, corpus_id) -> bool:
+        return self._find(corpus_id) >= 0
+
+    def __len__(self):
+        self._merge()
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self) -> List[int]:
+        self._merge()
+        return self.ids.tolist()
+
+    def values(self) -> Iterator[str]:
+        """Lazily decoded texts in id order."""
+        self._merge()
+        return (self._text(start, end) for start, end in zip(self.starts.tolist(), self.ends.tolist()))
+
+    def items(self) -> Iterator[Tuple[int, str]]:
+        return zip(self.keys(), self.values())
+
+    def max_id(self) -> int:
+        """Largest id, -1 if the store is empty."""
+        self._merge()
+        return int(self.ids[-1]) if len(self.ids) else -1
+
+    def contains_texts(self, texts: List[str]) -> np.ndarray:
+        """Bool array, True for the texts already in the store, compared by hash."""
+        self._merge()
+        return np.isin(_text_hashes([t.encode("utf-8") for t in texts]), self.hashes)
+
+    def save(self, save_dir: str):
+        """
+        Save the texts to save_dir. New texts are appended to the data file the store was loaded from, or to a
+        copy of it in another save_dir, the file is only rewritten with the live texts if most of it is removed texts.
+        """
+        self._merge()
+        os.makedirs(save_dir, exist_ok=True)
+        data_path = os.path.join(save_dir, self.data_name)
+        tmp_path = data_path + ".tmp"
+        lengths = self.ends - self.starts
+        same_file = self.data_path is not None and os.path.abspath(self.data_path) == os.path.abspath(data_path)
+        if 2 * int(lengths.sum()) < self._size():
+            with open(tmp_path, "wb") as f:
+                for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+                    f.write(self._bytes(start, end))
+            os.replace(tmp_path, data_path)
+            self.ends = np.cumsum(lengths)
+            self.starts = self.ends - lengths
+        elif same_file:
+            with open(data_path, "ab") as f:
+                f.write(self.tail)
+        else:
+            if self.data_path is not None:
+                shutil.copyfile(self.data_path, tmp_path)
+            with open(tmp_path, "ab") as f:
+                f.write(self.tail)
+            os.replace(tmp_path, data_path)
+        np.save(os.path.join(save_dir, self.offsets_name), np.stack([self.ids, self.starts, self.ends,
+                                                                     self.hashes.view(np.int64)], axis=1))
+        self._open(data_path)
+
+    def _open(self, data_path: str):
+        self.data_path = data_path
+        self.data = (np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path)
+                     else np.zeros(0, dtype=np.uint8))
+        self.tail = bytearray()
+
+    @classmethod
+    def exists(cls, save_dir: str) -> bool:
+        return os.path.exists(os.path.join(save_dir, cls.offsets_name))
+
+    @classmethod
+    def load(cls, save_dir: str) -> "TextStore":
+        """Load a store saved by `store.save(save_dir)`, the texts are memory-mapped."""
+        store = cls()
+        offsets = np.load(os.path.join(save_dir, cls.offsets_name))
+        store.ids, store.starts, store.ends = offsets[:, 0].copy(), offsets[:, 1].copy(), offsets[:, 2].copy()
+        store.hashes = offsets[:, 3].copy().view(np.uint64)
+        store._open(os.path.join(save_dir, cls.data_name))
+        return store
+
+
+def benchmark(num_vectors: int, dim: int, num_queries: int, topk: int, nlist: Optional[int], num_adds: int = 1):
+    """Recall@k and per query latency of IVF at several nprobe, against exhaustive search."""
+    rng = np.random.default_rng(0)
+    # Clustered data, like sentence embeddings of a corpus on a limited number of topics
+    num_topics = max(1, num_vectors // 1000)
+    topics = normalize(rng.standard_normal((num_topics, dim)))
+    labels = rng.integers(0, num_topics, num_vectors)
+    vectors = normalize(topics[labels] + rng.standard_normal((num_vectors, dim)) / np.sqrt(dim))
+    queries = normalize(topics[rng.integers(0, num_topics, num_queries)]
+                        + rng.standard_normal((num_queries, dim)) / np.sqrt(dim))
+    ids = np.arange(num_vectors)
+
+    flat = FlatIndex(dim)
+    flat.add(vectors, ids)
+    t0 = time.time()
+    gold_ids = np.concatenate([flat.search(q[None, :], topk)[1] for q in queries])
+    flat_ms = (time.time() - t0) / num_queries * 1000
+    logger.info(f"flat (exhaustive), {num_vectors} vectors: {flat_ms:.2f}ms/query")
+
+    ivf = IVFIndex(dim, nlist=nlist)
+    t0 = time.time()
+    for batch in np.array_split(np.arange(num_vectors), num_adds):
+        ivf.add(vectors[batch], ids[batch])
+        ivf.build()
+    logger.info(f"ivf build, nlist: {ivf.nlist}, {time.time() - t0:.1f}s")
+    for nprobe in [1, 4, 8, 16, 32, 64]:
+        if nprobe > ivf.nlist:
+            break
+        t0 = time.time()
+        found = np.concatenate([ivf.search(q[None, :], topk, nprobe=nprobe)[1] for q in queries])
+        ivf_ms = (time.time() - t0) / num_queries * 1000
+        recall = np.mean([len(set(a) & set(b)) / topk for a, b in zip(found, gold_ids)])
+        logger.info(f"ivf nprobe: {nprobe}, recall@{topk}: {recall:.4f}, {ivf_ms:.2f}ms/query, "
+                    f"speedup: {flat_ms / ivf_ms:.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_vectors', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None, help='Number of IVF clusters, default 4 * sqrt(N)')
+    parser.add_argument('--num_adds', type=int, default=1, help='Build the IVF index by this many adds')
+    args = parser.parse_args()
+    logger.info(args)
+    benchmark(args.num_vectors, args.dim, args.num_queries, args.topk, args.nlist, args.num_adds)